@@ -8,7 +8,7 @@ from caput import mpiarray, config
 from cora.util import units
 
 from ..core import containers, task, io
-from ..util import random
+from ..util import decomp, random
 
 
 class DelayFilter(task.SingleTask):
@@ -50,6 +50,8 @@ class DelayFilter(task.SingleTask):
     telescope_orientation = config.enum(["NS", "EW", "none"], default="NS")
     window = config.Property(proptype=bool, default=False)
 
+    _input_distributed_axis = ["input", "prod", "stack"]
+
     def setup(self, telescope):
         """Set the telescope needed to obtain baselines.
 
@@ -87,7 +89,9 @@ class DelayFilter(task.SingleTask):
         )
         ubase = ubase.view(np.float64).reshape(-1, 2)
 
-        for lbi, bi in ss.vis[:].enumerate(axis=1):
+        # Use the index into the full set of baselines, in case the data has been
+        # split over them
+        for lbi, bi in decomp.enumerate_axis(ss, ss.vis, axis=1):
 
             # Select the baseline length to use
             baseline = ubase[uinv[bi]]
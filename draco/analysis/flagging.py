@@ -17,16 +17,21 @@ Tasks
     ThresholdVisWeight
     RFIMask
     RFISensitivityMask
+    ApplyMasks
+    ApplyMasksRFI
 """
 
 import numpy as np
 from scipy.ndimage import median_filter
 
-from caput import config, weighted_median, mpiarray
+from caput import config, weighted_median, mpiarray, mpiutil
 
 from ..core import task, containers, io
 from ..util import tools
 from ..util import rfi
+from ..util import encoding
+from ..util import decomp
+from ..util import masking
 
 
 class DayMask(task.SingleTask):
@@ -55,6 +60,8 @@ class DayMask(task.SingleTask):
     zero_data = config.Property(proptype=bool, default=True)
     remove_average = config.Property(proptype=bool, default=True)
 
+    _input_distributed_axis = "freq"
+
     def process(self, sstream):
         """Apply a day time mask.
 
@@ -71,25 +78,7 @@ class DayMask(task.SingleTask):
 
         sstream.redistribute("freq")
 
-        ra_shift = (sstream.ra[:] - self.start) % 360.0
-        end_shift = (self.end - self.start) % 360.0
-
-        # Crudely mask the on and off regions
-        mask_bool = ra_shift > end_shift
-
-        # Put in the transition at the start of the day
-        mask = np.where(
-            ra_shift < self.width,
-            0.5 * (1 + np.cos(np.pi * (ra_shift / self.width))),
-            mask_bool,
-        )
-
-        # Put the transition at the end of the day
-        mask = np.where(
-            np.logical_and(ra_shift > end_shift - self.width, ra_shift <= end_shift),
-            0.5 * (1 + np.cos(np.pi * ((ra_shift - end_shift) / self.width))),
-            mask,
-        )
+        mask, mask_bool = _day_mask(sstream.ra[:], self.start, self.end, self.width)
 
         if self.remove_average:
             # Estimate the mean level from unmasked data
@@ -132,6 +121,8 @@ class MaskData(task.SingleTask):
     positive_m = config.Property(proptype=bool, default=True)
     negative_m = config.Property(proptype=bool, default=True)
 
+    _input_distributed_axis = "freq"
+
     def process(self, mmodes):
         """Mask out unwanted datain the m-modes.
 
@@ -190,7 +181,8 @@ class MaskBaselines(task.SingleTask):
         Which datasets should we share with the input. If "none" we create a
         full copy of the data, if "vis" we create a copy only of the modified
         weight dataset and the unmodified vis dataset is shared, if "all" we
-        modify in place and return the input container.
+        modify in place and return the input container. Copies are made
+        copy-on-write, so datasets that aren't modified don't use extra memory.
     """
 
     mask_long_ns = config.Property(proptype=float, default=None)
@@ -201,6 +193,8 @@ class MaskBaselines(task.SingleTask):
 
     share = config.enum(["none", "vis", "all"], default="all")
 
+    _input_distributed_axis = "freq"
+
     def setup(self, telescope):
         """Set the telescope model.
 
@@ -227,27 +221,21 @@ class MaskBaselines(task.SingleTask):
 
         ss.redistribute("freq")
 
-        baselines = self.telescope.baselines
-        mask = np.ones_like(ss.weight[:], dtype=bool)
-
-        if self.mask_long_ns is not None:
-            long_ns_mask = np.abs(baselines[:, 1]) < self.mask_long_ns
-            mask *= long_ns_mask[np.newaxis, :, np.newaxis]
-
-        if self.mask_short is not None:
-            short_mask = np.sum(baselines ** 2, axis=1) ** 0.5 > self.mask_short
-            mask *= short_mask[np.newaxis, :, np.newaxis]
-
-        if self.mask_short_ew is not None:
-            short_ew_mask = baselines[:, 0] > self.mask_short_ew
-            mask *= short_ew_mask[np.newaxis, :, np.newaxis]
+        # Build the mask per baseline, and broadcast it against the data
+        mask = _baseline_mask(
+            self.telescope.baselines,
+            self.mask_long_ns,
+            self.mask_short,
+            self.mask_short_ew,
+        )
+        mask = mask[np.newaxis, :, np.newaxis]
 
         if self.share == "all":
             ssc = ss
         elif self.share == "vis":
-            ssc = ss.copy(shared=("vis",))
-        else:  # self.share == "all"
-            ssc = ss.copy()
+            ssc = ss.copy(shared=("vis",), copy_on_write=True)
+        else:  # self.share == "none"
+            ssc = ss.copy(copy_on_write=True)
 
         # Apply the mask to the weight
         ssc.weight[:] *= mask
@@ -394,6 +382,8 @@ class ThresholdVisWeight(task.SingleTask):
     absolute_threshold = config.Property(proptype=float, default=1e-7)
     relative_threshold = config.Property(proptype=float, default=0.0)
 
+    _input_distributed_axis = ["prod", "stack"]
+
     def process(self, timestream):
         """Apply threshold to `weight` dataset.
 
@@ -408,11 +398,25 @@ class ThresholdVisWeight(task.SingleTask):
         """
         timestream.redistribute(["prod", "stack"])
 
-        weight = timestream.weight[:]
+        # Compactly encoded weights are thresholded on their decoded values. They
+        # can only be accessed through `datasets`, as `weight` refuses them
+        weight_dset = timestream.datasets["vis_weight"]
+        encoded = encoding.encoding_of(weight_dset) is not None
+        weight = encoding.decode(weight_dset)
 
         # Average over the frequency and time axes to get a per baseline
-        # average
-        mean_weight = weight.mean(axis=2).mean(axis=0)
+        # average. If the data has been split over time, combine the sums of each
+        # part, which are held by the same ranks in each group of the grid
+        grid = decomp.grid_of(timestream, self.comm)
+        time_axis = weight_dset.attrs["axis"][2]
+
+        if grid is not None and decomp.axis_of(timestream) == time_axis:
+            ntime = decomp.axis_length(timestream, time_axis)
+            mean_weight = (
+                grid.cross_comm.allreduce(weight.sum(axis=2).mean(axis=0)) / ntime
+            )
+        else:
+            mean_weight = weight.mean(axis=2).mean(axis=0)
 
         # Figure out which entries to keep
         threshold = np.maximum(
@@ -420,15 +424,22 @@ class ThresholdVisWeight(task.SingleTask):
         )
         keep = weight > threshold[np.newaxis, :, np.newaxis]
 
-        keep_total = timestream.comm.allreduce(np.sum(keep))
-        keep_frac = keep_total / float(np.prod(weight.global_shape))
+        comm = timestream.comm if grid is None else grid.comm
+        keep_total = comm.allreduce(np.sum(keep))
+        keep_frac = keep_total / float(
+            np.prod(decomp.global_shape(timestream, weight_dset))
+        )
 
         self.log.info(
             "%0.5f%% of data is below the weight threshold"
             % (100.0 * (1.0 - keep_frac))
         )
 
-        timestream.weight[:] = np.where(keep, weight, 0.0)
+        if encoded:
+            # Zero is encoded exactly, so just zero the codes
+            weight_dset[:].view(np.ndarray)[~keep] = 0
+        else:
+            weight_dset[:] = np.where(keep, weight, 0.0)
 
         return timestream
 
@@ -512,84 +523,87 @@ class RFISensitivityMask(task.SingleTask):
         # in the sumthreshold algorithm (n**log2(1.5))
         RMS_SCALING_DIFF = np.log2(1.5) - 0.5
 
-        # Distribute over polarisation as we need all times and frequencies
-        # available simultaneously
-        sensitivity.redistribute("pol")
-
-        # Divide sensitivity to get a radiometer test
-        radiometer = sensitivity.measured[:] * tools.invert_no_zero(
-            sensitivity.radiometer[:]
-        )
-        radiometer = mpiarray.MPIArray.wrap(radiometer, axis=1)
-
         freq = sensitivity.freq
         npol = len(sensitivity.pol)
         nfreq = len(freq)
+        ntime = len(sensitivity.time)
 
         static_flag = ~self._static_rfi_mask_hook(freq)
 
-        madmask = mpiarray.MPIArray(
-            (npol, nfreq, len(sensitivity.time)), axis=0, dtype=np.bool
-        )
-        madmask[:] = False
-        stmask = mpiarray.MPIArray(
-            (npol, nfreq, len(sensitivity.time)), axis=0, dtype=np.bool
+        # The masks are distributed over polarisation
+        _, pstart, pend = mpiutil.split_local(npol, comm=sensitivity.comm)
+        madmask = np.zeros((pend - pstart, nfreq, ntime), dtype=bool)
+        stmask = np.zeros((pend - pstart, nfreq, ntime), dtype=bool)
+
+        # We need all times and frequencies available simultaneously for each
+        # polarisation. Rather than redistributing the whole container over
+        # polarisation, work on blocks of polarisations as they arrive.
+        blocks = sensitivity.iter_redistribute(
+            ["measured", "radiometer", "weight"], "pol"
         )
-        stmask[:] = False
 
-        for li, ii in madmask.enumerate(axis=0):
+        for (start, end), (measured, radiometer, weight) in blocks:
 
-            # Only process this polarisation if we should be including it,
-            # otherwise skip and let it be implicitly set to False (i.e. not
-            # masked)
-            if self.include_pol and sensitivity.pol[ii] not in self.include_pol:
-                continue
+            # Divide sensitivity to get a radiometer test
+            radiometer = measured * tools.invert_no_zero(radiometer)
 
-            # Initial flag on weights equal to zero.
-            origflag = sensitivity.weight[:, ii] == 0.0
+            for bi, ii in enumerate(range(start, end)):
 
-            # Remove median at each frequency, if asked.
-            if self.remove_median:
-                for ff in range(nfreq):
-                    radiometer[ff, li] -= np.median(
-                        radiometer[ff, li][~origflag[ff]].view(np.ndarray)
-                    )
+                li = ii - pstart
 
-            # Combine weights with static flag
-            start_flag = origflag | static_flag[:, None]
+                # Only process this polarisation if we should be including it,
+                # otherwise skip and let it be implicitly set to False (i.e. not
+                # masked)
+                if self.include_pol and sensitivity.pol[ii] not in self.include_pol:
+                    continue
 
-            # Obtain MAD and TV masks
-            this_madmask, tvmask = self._mad_tv_mask(
-                radiometer[:, li], start_flag, freq
-            )
+                # Initial flag on weights equal to zero.
+                origflag = weight[:, bi] == 0.0
 
-            # combine MAD and TV masks
-            madmask[li] = this_madmask | tvmask
+                # Remove median at each frequency, if asked.
+                if self.remove_median:
+                    for ff in range(nfreq):
+                        radiometer[ff, bi] -= np.median(
+                            radiometer[ff, bi][~origflag[ff]]
+                        )
 
-            # Add TV channels to ST start flag.
-            start_flag = start_flag | tvmask
+                # Combine weights with static flag
+                start_flag = origflag | static_flag[:, None]
 
-            # Determine initial threshold
-            med = np.median(radiometer[:, li][~start_flag].view(np.ndarray))
-            mad = np.median(abs(radiometer[:, li][~start_flag].view(np.ndarray) - med))
-            threshold1 = (
-                mad
-                * MAD_TO_RMS
-                * self.start_threshold_sigma
-                * self.max_m ** RMS_SCALING_DIFF
-            )
+                # Obtain MAD and TV masks
+                this_madmask, tvmask = self._mad_tv_mask(
+                    radiometer[:, bi], start_flag, freq
+                )
 
-            # SumThreshold mask
-            stmask[li] = rfi.sumthreshold(
-                radiometer[:, li],
-                self.max_m,
-                start_flag=start_flag,
-                threshold1=threshold1,
-                correct_for_missing=True,
-            )
+                # combine MAD and TV masks
+                madmask[li] = this_madmask | tvmask
+
+                # Add TV channels to ST start flag.
+                start_flag = start_flag | tvmask
+
+                # Determine initial threshold
+                med = np.median(radiometer[:, bi][~start_flag])
+                mad = np.median(abs(radiometer[:, bi][~start_flag] - med))
+                threshold1 = (
+                    mad
+                    * MAD_TO_RMS
+                    * self.start_threshold_sigma
+                    * self.max_m ** RMS_SCALING_DIFF
+                )
+
+                # SumThreshold mask
+                stmask[li] = rfi.sumthreshold(
+                    radiometer[:, bi],
+                    self.max_m,
+                    start_flag=start_flag,
+                    threshold1=threshold1,
+                    correct_for_missing=True,
+                )
 
         # Perform an OR (.any) along the pol axis and reform into an MPIArray
         # along the freq axis
+        madmask = mpiarray.MPIArray.wrap(madmask, 0, comm=sensitivity.comm)
+        stmask = mpiarray.MPIArray.wrap(stmask, 0, comm=sensitivity.comm)
         madmask = mpiarray.MPIArray.wrap(madmask.redistribute(1).any(0), 0)
         stmask = mpiarray.MPIArray.wrap(stmask.redistribute(1).any(0), 0)
 
@@ -796,6 +810,8 @@ class ApplyRFIMask(task.SingleTask):
     Mask out all inputs at times and frequencies contaminated by RFI.
     """
 
+    _input_distributed_axis = "freq"
+
     def process(self, tstream, rfimask):
         """Flag out RFI by zeroing the weights.
 
@@ -823,24 +839,306 @@ class ApplyRFIMask(task.SingleTask):
         # Ensure we are frequency distributed
         tstream.redistribute("freq")
 
+        # Either dataset may be compactly encoded, so get them from `datasets`
+        weight_dset = tstream.datasets["vis_weight"]
+        mask_dset = rfimask.datasets["mask"]
+
         # Create a slice that broadcasts the mask to the final shape
-        t_axes = tstream.weight.attrs["axis"]
-        m_axes = rfimask.mask.attrs["axis"]
+        t_axes = weight_dset.attrs["axis"]
+        m_axes = mask_dset.attrs["axis"]
         bcast_slice = tuple(
             slice(None) if ax in m_axes else np.newaxis for ax in t_axes
         )
 
         # RFI Mask is not distributed, so we need to cut out the frequencies
         # that are local for the tstream
-        sf = tstream.weight.local_offset[0]
-        ef = sf + tstream.weight.local_shape[0]
+        sf = weight_dset.local_offset[0]
+        ef = sf + weight_dset.local_shape[0]
+
+        # Decode the local part of the mask if it is bit packed
+        mask = encoding.decode_array(mask_dset[sf:ef], mask_dset.attrs)
 
-        # Mask the data
-        tstream.weight[:] *= (~rfimask.mask[sf:ef][bcast_slice]).astype(np.float32)
+        # Mask the data. Zero is exact for both plain and compactly encoded weights
+        weight = weight_dset[:]
+        weight *= (~mask[bcast_slice]).astype(weight.dtype)
 
         return tstream
 
 
+class ApplyMasks(task.SingleTask):
+    """Apply the baseline, weight threshold, RFI and day masks in a single pass.
+
+    This combines the masks of :class:`MaskBaselines`, :class:`ThresholdVisWeight`,
+    :class:`ApplyRFIMask` and :class:`DayMask` into one multiplicative mask and
+    applies it in a single blocked pass over the weights (and optionally the
+    visibilities), rather than each task sweeping over the full datasets in turn.
+    The mask is never built at the full size of the data. Each mask is only
+    applied if its parameters are set, and the thresholds are evaluated on the
+    weights before any of the masks are applied. To also apply an RFI mask use
+    :class:`ApplyMasksRFI`.
+
+    Attributes
+    ----------
+    mask_long_ns : float, optional
+        Mask out baselines longer than a given distance in the N/S direction.
+    mask_short : float, optional
+        Mask out baselines shorter than a given distance.
+    mask_short_ew : float, optional
+        Mask out baselines shorter then a given distance in the East-West
+        direction.
+    absolute_threshold : float, optional
+        Mask out weights with values less than this number.
+    relative_threshold : float, optional
+        Mask out weights less than this number times the average weight of
+        their baseline.
+    day_start, day_end : float, optional
+        Start and end in RA of the day time region to mask out. Only used for
+        data with an RA axis.
+    day_width : float, optional
+        Width of the smooth transition into the day time region. Default is 60.
+    zero_data : bool, optional
+        Mask the visibilities as well as the weights. Default is False.
+    block_size : float, optional
+        Size of the blocks of weights to process at once in MB. Default is 1.
+    """
+
+    mask_long_ns = config.Property(proptype=float, default=None)
+    mask_short = config.Property(proptype=float, default=None)
+    mask_short_ew = config.Property(proptype=float, default=None)
+
+    absolute_threshold = config.Property(proptype=float, default=None)
+    relative_threshold = config.Property(proptype=float, default=None)
+
+    day_start = config.Property(proptype=float, default=None)
+    day_end = config.Property(proptype=float, default=None)
+    day_width = config.Property(proptype=float, default=60.0)
+
+    zero_data = config.Property(proptype=bool, default=False)
+    block_size = config.Property(proptype=float, default=1.0)
+
+    _input_distributed_axis = "freq"
+
+    def setup(self, telescope=None):
+        """Set the telescope model, needed for masking baselines.
+
+        Parameters
+        ----------
+        telescope : TransitTelescope, optional
+        """
+        self.telescope = io.get_telescope(telescope) if telescope is not None else None
+
+    def process(self, data):
+        """Mask the data.
+
+        Parameters
+        ----------
+        data : SiderealStream or TimeStream
+            Data to mask. Applied in place.
+
+        Returns
+        -------
+        data : SiderealStream or TimeStream
+            The masked data.
+        """
+        return self._apply(data)
+
+    def _apply(self, data, rfimask=None):
+        # Build the combined mask and apply it to the data
+
+        data.redistribute("freq")
+
+        weight_dset = data.datasets["vis_weight"]
+        weight = weight_dset[:].view(np.ndarray)
+        axes = list(weight_dset.attrs["axis"])
+        encoded = encoding.encoding_of(weight_dset) is not None
+
+        # The range of the full data held locally, which differs from the local
+        # section of the container only if it's been split over a process grid
+        box = decomp.tile(data, weight_dset)
+
+        mask = masking.MaskProduct(axes, weight.shape)
+
+        if self._mask_baselines:
+            if self.telescope is None:
+                raise RuntimeError("Masking baselines needs a telescope.")
+
+            keep = _baseline_mask(
+                self.telescope.baselines[slice(*box[1])],
+                self.mask_long_ns,
+                self.mask_short,
+                self.mask_short_ew,
+            )
+            mask.multiply([axes[1]], keep)
+
+        if self._threshold:
+            mask.threshold([axes[1]], self._weight_threshold(data, weight, axes))
+
+        if rfimask is not None:
+            mask.multiply(*self._rfi_mask(data, rfimask, axes, box))
+
+        if self.day_start is not None and self.day_end is not None and "ra" in axes:
+            day, _ = _day_mask(data.ra[:], self.day_start, self.day_end, self.day_width)
+            mask.multiply(["ra"], day)
+
+        if not len(mask):
+            return data
+
+        nmasked = mask.apply(
+            weight,
+            vis=data.vis[:].view(np.ndarray) if self.zero_data else None,
+            attrs=weight_dset.attrs if encoded else None,
+            block_size=int(self.block_size * 2 ** 20),
+        )
+
+        if self._threshold:
+            # The count is divided by the size of the full data, so sum it over
+            # the whole process grid if the data has been split
+            grid = decomp.grid_of(data, self.comm)
+            comm = data.comm if grid is None else grid.comm
+            nmasked = comm.allreduce(nmasked)
+            frac = nmasked / float(np.prod(decomp.global_shape(data, weight_dset)))
+            self.log.info(
+                "%0.5f%% of data is below the weight threshold" % (100.0 * frac)
+            )
+
+        return data
+
+    @property
+    def _mask_baselines(self):
+        return any(
+            x is not None
+            for x in [self.mask_long_ns, self.mask_short, self.mask_short_ew]
+        )
+
+    @property
+    def _threshold(self):
+        return (
+            self.absolute_threshold is not None or self.relative_threshold is not None
+        )
+
+    def _weight_threshold(self, data, weight, axes):
+        # The threshold for each baseline, from the mean weight over frequency and
+        # time. This sums row by row so encoded weights are never fully decoded.
+
+        attrs = data.datasets["vis_weight"].attrs
+        total = np.zeros(weight.shape[1], dtype=np.float64)
+        for row in weight:
+            total += encoding.decode_array(row, attrs).sum(axis=-1)
+
+        total = self._full_comm(data, axes[2]).allreduce(total)
+        count = decomp.axis_length(data, axes[0]) * decomp.axis_length(data, axes[2])
+
+        absolute = self.absolute_threshold or 0.0
+        relative = self.relative_threshold or 0.0
+
+        return np.maximum(absolute, relative * total / count)
+
+    def _full_comm(self, data, axis):
+        # The communicator over which sums over frequency and `axis` are complete.
+        # This is the whole process grid if the data has been split over `axis`.
+
+        grid = decomp.grid_of(data, self.comm)
+
+        if grid is not None and decomp.axis_of(data) == axis:
+            return grid.comm
+
+        return data.comm
+
+    def _rfi_mask(self, data, rfimask, axes, box):
+        # The local part of an RFI mask, as the samples to keep
+
+        if not np.array_equal(data.time, rfimask.time):
+            raise ValueError("timestream and mask data have different time axes.")
+
+        if not np.array_equal(data.freq, rfimask.freq):
+            raise ValueError("timestream and mask data have different freq axes.")
+
+        mask_dset = rfimask.datasets["mask"]
+        m_axes = list(mask_dset.attrs["axis"])
+
+        # Cut out the local frequencies, then decode, which is only possible for
+        # the leading axes of bit packed masks
+        fs, fe = box[axes.index(m_axes[0])]
+        rmask = encoding.decode_array(mask_dset[fs:fe], mask_dset.attrs)
+
+        sl = tuple(
+            slice(None) if i == 0 else slice(*box[axes.index(ax)])
+            for i, ax in enumerate(m_axes)
+        )
+
+        return m_axes, ~rmask[sl]
+
+
+class ApplyMasksRFI(ApplyMasks):
+    """Apply an RFI mask along with the masks of :class:`ApplyMasks`.
+
+    This takes the same parameters as :class:`ApplyMasks`, and applies the RFI
+    mask as :class:`ApplyRFIMask` would in the same single pass over the weights.
+    """
+
+    def process(self, data, rfimask):
+        """Mask the data.
+
+        Parameters
+        ----------
+        data : SiderealStream or TimeStream
+            Data to mask. Applied in place.
+        rfimask : containers.RFIMask
+            An RFI mask for the same period of time.
+
+        Returns
+        -------
+        data : SiderealStream or TimeStream
+            The masked data.
+        """
+        return self._apply(data, rfimask)
+
+
+def _baseline_mask(baselines, long_ns=None, short=None, short_ew=None):
+    # The baselines to keep given the cuts on their lengths, see `MaskBaselines`
+
+    keep = np.ones(len(baselines), dtype=bool)
+
+    if long_ns is not None:
+        keep &= np.abs(baselines[:, 1]) < long_ns
+
+    if short is not None:
+        keep &= np.sum(baselines ** 2, axis=1) ** 0.5 > short
+
+    if short_ew is not None:
+        keep &= baselines[:, 0] > short_ew
+
+    return keep
+
+
+def _day_mask(ra, start, end, width):
+    # Calculate a mask for the day time data between `start` and `end` with cosine
+    # transitions of `width` inside the region. Returns the mask and a boolean
+    # version without the transitions.
+
+    ra_shift = (ra - start) % 360.0
+    end_shift = (end - start) % 360.0
+
+    # Crudely mask the on and off regions
+    mask_bool = ra_shift > end_shift
+
+    # Put in the transition at the start of the day
+    mask = np.where(
+        ra_shift < width,
+        0.5 * (1 + np.cos(np.pi * (ra_shift / width))),
+        mask_bool,
+    )
+
+    # Put the transition at the end of the day
+    mask = np.where(
+        np.logical_and(ra_shift > end_shift - width, ra_shift <= end_shift),
+        0.5 * (1 + np.cos(np.pi * ((ra_shift - end_shift) / width))),
+        mask,
+    )
+
+    return mask, mask_bool
+
+
 def medfilt(x, mask, size, *args):
     """Apply a moving median filter to masked data.
 
@@ -46,17 +46,30 @@ class SiderealGrouper(task.SingleTask):
         should set this quantity to `240 * (source_ra - 180)`.
     min_day_length : float
         Require at least this fraction of a full sidereal day to process.
+    incremental : bool
+        Assemble each day as its files arrive, rather than holding on to them
+        and concatenating them at the end of the day. The day's timestream is
+        allocated when its first file arrives, on a regular time grid with the
+        cadence of that file running up to the end of the padded LSD, and each
+        file is copied into place and released. This halves the peak memory,
+        but samples missing from the grid are left with zero weight, and the
+        day is cut off at the end of the padded LSD. Only supported for
+        `draco` containers. Default is False.
     """
 
     padding = config.Property(proptype=float, default=0.0)
     offset = config.Property(proptype=float, default=0.0)
     min_day_length = config.Property(proptype=float, default=0.10)
+    incremental = config.Property(proptype=bool, default=False)
 
     def __init__(self):
         super(SiderealGrouper, self).__init__()
 
         self._timestream_list = []
         self._current_lsd = None
+        self._day = None
+        self._cadence = None
+        self._span = None
 
     def setup(self, manager):
         """Set the local observers position.
@@ -101,14 +114,14 @@ class SiderealGrouper(task.SingleTask):
         if self._current_lsd is None:
             self._current_lsd = lsd_start
 
-        # If this file started during the current lsd add it onto the list
+        # If this file started during the current lsd add it onto the group
         if self._current_lsd == lsd_start:
-            self._timestream_list.append(tstream)
+            self._add(tstream)
 
         self.log.info("Adding file into group for LSD:%i", lsd_start)
 
         # If this file ends during a later LSD then we need to process the
-        # current list and restart the system
+        # current group and restart the system
         if self._current_lsd < lsd_end:
             self.log.info("Concatenating files for LSD:%i", self._current_lsd)
 
@@ -116,9 +129,10 @@ class SiderealGrouper(task.SingleTask):
             # could get returned as None if there wasn't enough data
             tstream_all = self._process_current_lsd()
 
-            # Reset list and current LSD for the new file
-            self._timestream_list = [tstream]
+            # Reset the group and current LSD for the new file
+            self._reset()
             self._current_lsd = lsd_end
+            self._add(tstream)
 
             return tstream_all
         else:
@@ -134,7 +148,106 @@ class SiderealGrouper(task.SingleTask):
             enough, otherwise returns :obj:`None`.
         """
         # If we are here there is no more data coming, we just need to process any remaining data
-        return self._process_current_lsd() if self._timestream_list else None
+        return self._process_current_lsd() if self._span is not None else None
+
+    def _add(self, tstream):
+        # Add a file to the current group
+
+        start, end = tstream.time[0], tstream.time[-1]
+        self._span = (start, end) if self._span is None else (self._span[0], end)
+
+        if self.incremental and not isinstance(tstream, containers.ContainerBase):
+            self.log.warning(
+                "Incremental assembly is only supported for draco containers. "
+                "Concatenating files instead."
+            )
+            self.incremental = False
+
+        if not self.incremental:
+            self._timestream_list.append(tstream)
+            return
+
+        if self._day is None:
+            self._allocate_day(tstream)
+
+        self._insert(tstream)
+
+    def _reset(self):
+        # Drop the current group
+
+        self._timestream_list = []
+        self._day = None
+        self._span = None
+
+    def _allocate_day(self, tstream):
+        # Create the timestream for the current LSD, on a regular grid starting
+        # at the first file's first sample and running to the end of the padded
+        # LSD
+
+        times = tstream.time[:]
+
+        if len(times) < 2:
+            raise RuntimeError("Can't determine the cadence from a single sample.")
+
+        self._cadence = np.median(np.diff(times))
+
+        end = (
+            self.observer.lsd_to_unix(self._current_lsd + 1)
+            + self.offset
+            + self.padding
+        )
+        ntime = max(int(np.floor((end - times[0]) / self._cadence)) + 1, len(times))
+        grid = times[0] + self._cadence * np.arange(ntime)
+
+        day = containers.empty_like(tstream, time=grid, comm=tstream.comm)
+
+        for name in tstream.datasets:
+            if name not in day.datasets and name in day.dataset_spec:
+                day.add_dataset(name)
+
+        day.redistribute("freq")
+
+        # Samples that never arrive must have zero weight
+        for dset in day.datasets.values():
+            if "time" in dset.attrs.get("axis", ()):
+                dset[:] = 0
+
+        self.log.info("Allocated %i samples for LSD:%i", ntime, self._current_lsd)
+
+        self._day = day
+
+    def _insert(self, tstream):
+        # Copy a file into its place in the day's timestream
+
+        from ..util import encoding
+
+        day = self._day
+        tstream.redistribute("freq")
+
+        # Find the slot of each sample, dropping any off the end of the day
+        index = np.rint((tstream.time[:] - day.time[0]) / self._cadence).astype(int)
+        valid = np.flatnonzero((index >= 0) & (index < len(day.time)))
+
+        for name, dset in tstream.datasets.items():
+
+            axes = list(dset.attrs.get("axis", ()))
+
+            if name not in day.datasets or "time" not in axes:
+                continue
+
+            if encoding.encoding_of(dset) is not None:
+                raise ValueError(
+                    f"Can't assemble encoded dataset {name} incrementally."
+                )
+
+            src = [slice(None)] * len(axes)
+            dst = [slice(None)] * len(axes)
+            src[axes.index("time")] = valid
+            dst[axes.index("time")] = index[valid]
+
+            src_arr = dset[:].view(np.ndarray)
+            dst_arr = day.datasets[name][:].view(np.ndarray)
+            dst_arr[tuple(dst)] = src_arr[tuple(src)]
 
     def _process_current_lsd(self):
         # Combine the current set of files into a timestream
@@ -142,18 +255,24 @@ class SiderealGrouper(task.SingleTask):
         lsd = self._current_lsd
 
         # Calculate the length of data in this current LSD
-        start = self.observer.unix_to_lsd(self._timestream_list[0].time[0])
-        end = self.observer.unix_to_lsd(self._timestream_list[-1].time[-1])
+        start = self.observer.unix_to_lsd(self._span[0])
+        end = self.observer.unix_to_lsd(self._span[1])
         day_length = min(end, lsd + 1) - max(start, lsd)
 
         # If the amount of data for this day is too small, then just skip
         if day_length < self.min_day_length:
             return None
 
-        self.log.info("Constructing LSD:%i [%i files]", lsd, len(self._timestream_list))
+        if self.incremental:
+            self.log.info("Constructing LSD:%i", lsd)
+            ts = self._day
+        else:
+            self.log.info(
+                "Constructing LSD:%i [%i files]", lsd, len(self._timestream_list)
+            )
 
-        # Construct the combined timestream
-        ts = tod.concatenate(self._timestream_list)
+            # Construct the combined timestream
+            ts = tod.concatenate(self._timestream_list)
 
         # Add attributes for the LSD and a tag for labelling saved files
         ts.attrs["tag"] = "lsd_%i" % lsd
@@ -251,7 +370,9 @@ class SiderealRegridder(Regridder):
 
         # FYI this whole process creates an extra copy of the sidereal stack.
         # This could probably be optimised out with a little work.
-        sdata = containers.SiderealStream(axes_from=data, ra=self.samples)
+        sdata = containers.SiderealStream(
+            axes_from=data, ra=self.samples, pool=self.buffer_pool
+        )
         sdata.redistribute("freq")
         sdata.vis[:] = sts
         sdata.weight[:] = ni
@@ -540,7 +661,9 @@ class SiderealStacker(task.SingleTask):
 
         if self.stack is None:
 
-            self.stack = containers.empty_like(sdata)
+            # Use the same communicator so the stack lines up with the data if it
+            # has been split over a process grid
+            self.stack = containers.empty_like(sdata, comm=sdata.comm)
             self.stack.redistribute("freq")
 
             self.stack.vis[:] = sdata.vis[:] * sdata.weight[:]
@@ -32,33 +32,31 @@ class SVDSpectrumEstimator(task.SingleTask):
         spectrum : containers.SVDSpectrum
         """
 
-        mmodes.redistribute("m")
+        vshape = mmodes.vis[:].global_shape
 
-        vis = mmodes.vis[:]
-        weight = mmodes.weight[:]
-
-        nmode = min(vis.shape[1] * vis.shape[3], vis.shape[2])
+        nmode = min(vshape[1] * vshape[3], vshape[2])
 
         spec = containers.SVDSpectrum(singularvalue=nmode, axes_from=mmodes)
         spec.spectrum[:] = 0.0
 
-        for mi, m in vis.enumerate(axis=0):
-            self.log.debug("Calculating SVD spectrum of m=%i", m)
+        # Get the m-modes in blocks of m, so we can start on the first m's while
+        # the rest are still being exchanged, and without redistributing the
+        # whole container
+        for (mstart, _), (vis, weight) in mmodes.iter_redistribute(
+            ["vis", "vis_weight"], "m"
+        ):
+            for mi in range(vis.shape[0]):
+                m = mstart + mi
 
-            vis_m = (
-                vis[mi].view(np.ndarray).transpose((1, 0, 2)).reshape(vis.shape[2], -1)
-            )
-            weight_m = (
-                weight[mi]
-                .view(np.ndarray)
-                .transpose((1, 0, 2))
-                .reshape(vis.shape[2], -1)
-            )
-            mask_m = weight_m == 0.0
+                self.log.debug("Calculating SVD spectrum of m=%i", m)
 
-            u, sig, vh = svd_em(vis_m, mask_m, niter=self.niter)
+                vis_m = vis[mi].transpose((1, 0, 2)).reshape(vshape[2], -1)
+                weight_m = weight[mi].transpose((1, 0, 2)).reshape(vshape[2], -1)
+                mask_m = weight_m == 0.0
+
+                u, sig, vh = svd_em(vis_m, mask_m, niter=self.niter)
 
-            spec.spectrum[m] = sig
+                spec.spectrum[m] = sig
 
         return spec
 
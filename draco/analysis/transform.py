@@ -33,6 +33,8 @@ class FrequencyRebin(task.SingleTask):
 
     channel_bin = config.Property(proptype=int, default=1)
 
+    _input_distributed_axis = ["time", "ra"]
+
     def process(self, ss):
         """Take the input dataset and rebin the frequencies.
 
@@ -66,7 +68,7 @@ class FrequencyRebin(task.SingleTask):
         freq_map["width"] = fw
 
         # Create new container for rebinned stream
-        sb = containers.empty_like(ss, freq=freq_map)
+        sb = containers.empty_like(ss, freq=freq_map, pool=self.buffer_pool)
 
         # Get all frequencies onto same node
         sb.redistribute(["time", "ra"])
@@ -88,7 +90,8 @@ class FrequencyRebin(task.SingleTask):
             if (fi + 1) % self.channel_bin == 0:
                 sb.vis[ri] *= tools.invert_no_zero(sb.weight[ri])
 
-        sb.redistribute("freq")
+        # Switch back to frequency distribution once needed
+        sb.defer_redistribute("freq")
 
         return sb
 
@@ -118,6 +121,8 @@ class CollateProducts(task.SingleTask):
 
     weight = config.Property(proptype=str, default="natural")
 
+    _input_distributed_axis = ["ra", "time"]
+
     def setup(self, tel):
         """Set the Telescope instance to use.
 
@@ -231,6 +236,7 @@ class CollateProducts(task.SingleTask):
             attrs_from=ss,
             distributed=True,
             comm=ss.comm,
+            pool=self.buffer_pool,
             **output_kwargs
         )
 
@@ -321,9 +327,10 @@ class CollateProducts(task.SingleTask):
         sp.vis[:] *= tools.invert_no_zero(counter)
         sp.weight[:] = counter ** 2 * tools.invert_no_zero(sp.weight[:])
 
-        # Switch back to frequency distribution
+        # Switch the input back to frequency distribution, as other tasks may be
+        # using it, and the output once needed
         ss.redistribute("freq")
-        sp.redistribute("freq")
+        sp.defer_redistribute("freq")
 
         return sp
 
@@ -353,6 +360,8 @@ class SelectFreq(task.SingleTask):
     channel_range = config.Property(proptype=list, default=[])
     channel_index = config.Property(proptype=list, default=[])
 
+    _input_distributed_axis = ["ra", "time", "pixel"]
+
     def process(self, data):
         """Selet a subset of the frequencies.
 
@@ -404,7 +413,7 @@ class SelectFreq(task.SingleTask):
         data.redistribute(["ra", "time", "pixel"])
 
         # Create new container with subset of frequencies.
-        newdata = containers.empty_like(data, freq=freq_map)
+        newdata = containers.empty_like(data, freq=freq_map, pool=self.buffer_pool)
 
         # Make sure all datasets are initialised
         for name in data.datasets.keys():
@@ -434,9 +443,10 @@ class SelectFreq(task.SingleTask):
 
             newdata.input_flags[:] = data.input_flags[:]
 
-        # Switch back to frequency distribution
+        # Switch the input back to frequency distribution, as other tasks may be
+        # using it, and the output once needed
         data.redistribute("freq")
-        newdata.redistribute("freq")
+        newdata.defer_redistribute("freq")
 
         return newdata
 
@@ -479,11 +489,17 @@ class MModeTransform(task.SingleTask):
         mmodes : containers.MModes
         """
 
+        from ..util import blockdist
+
         sstream.redistribute("freq")
 
         # Sum the noise variance over time samples, this will become the noise
-        # variance for the m-modes
-        weight_sum = sstream.weight[:].sum(axis=-1)
+        # variance for the m-modes. It has no time axis, so is small enough for
+        # every rank to take all of it.
+        weight_sum = sstream.weight[:].view(np.ndarray).sum(axis=-1)
+        weight_sum = mpiarray.MPIArray.wrap(
+            weight_sum, axis=0, comm=sstream.comm
+        ).allgather()
 
         if self.telescope is not None:
             mmax = self.telescope.mmax
@@ -494,16 +510,26 @@ class MModeTransform(task.SingleTask):
         marray = _make_marray(sstream.vis[:], mmax)
         marray = mpiarray.MPIArray.wrap(marray[:], axis=2, comm=sstream.comm)
 
-        # Create the container to store the modes in
+        # Create the container to store the modes in, distributed over m
         mmax = marray.shape[0] - 1
-        ma = containers.MModes(mmax=mmax, axes_from=sstream, comm=sstream.comm)
-        ma.redistribute("freq")
+        ma = containers.MModes(
+            mmax=mmax, axes_from=sstream, comm=sstream.comm, pool=self.buffer_pool
+        )
+        ma.redistribute("m")
 
-        # Assign the visibilities and weights into the container
-        ma.vis[:] = marray
-        ma.weight[:] = weight_sum[np.newaxis, np.newaxis, :, :]
+        # Fill in the modes block by block as they are exchanged, rather than
+        # filling a frequency distributed container and redistributing it, which
+        # would need another full copy of the modes
+        vis = ma.vis[:].view(np.ndarray)
+        moff = ma.vis[:].local_offset[0]
+        block_size = containers.redistribute_block_size(2 ** 26)
 
-        ma.redistribute("m")
+        for (ms, me), block in blockdist.iter_redistribute(marray, 0, block_size):
+            vis[ms - moff : me - moff] = block
+
+        del marray
+
+        ma.weight[:] = weight_sum[np.newaxis, np.newaxis, :, :]
 
         return ma
 
@@ -35,23 +35,1002 @@ their own custom container types.
 
     empty_like
     empty_timestream
+    set_memory_budget
+    set_redistribute_block_size
+    redistribute_block_size
+    redistributed_nbytes
+    BufferPool
 """
 
+import os
+import sys
 import inspect
+import itertools
+import logging
+import tempfile
+import threading
+import weakref
+from collections.abc import Mapping
+
+import h5py
+import numpy as np
+
+from caput import memh5, mpiarray, mpiutil, tod
+
+logger = logging.getLogger(__name__)
+
+# Try to import bitshuffle to set the default compression options
+try:
+    import bitshuffle.h5
+
+    COMPRESSION = bitshuffle.h5.H5FILTER
+    COMPRESSION_OPTS = (0, bitshuffle.h5.H5_COMPRESS_LZ4)
+except ImportError:
+    COMPRESSION = None
+    COMPRESSION_OPTS = None
+
+
+class MemoryBudget:
+    """Keep the memory used by containers on this rank within a budget.
+
+    All containers created while the budget is active are tracked. If their
+    total local size exceeds the limit when one of them allocates memory (by
+    creating a dataset, or reading one back in), the least recently accessed
+    containers have their datasets spilled to scratch files, from which they are
+    read back the next time the container is accessed. Datasets that are referenced
+    outside of their container (e.g. a task holding a view of the array) are
+    considered in use and are never spilled.
+
+    Spilling and reading back are purely local operations, so different ranks
+    can make different decisions.
+
+    Parameters
+    ----------
+    limit : int
+        Memory budget in bytes.
+    directory : str, optional
+        Directory for the scratch files. This should ideally be on node-local
+        storage. By default use the system temporary directory.
+    """
+
+    def __init__(self, limit, directory=None):
+
+        self.limit = limit
+        self.directory = directory if directory is not None else tempfile.gettempdir()
+
+        self._containers = weakref.WeakSet()
+        self._clock = 0
+        self._lock = threading.RLock()
+
+    def register(self, cont):
+        """Start tracking a container."""
+        with self._lock:
+            self._containers.add(cont)
+            self.touch(cont)
+
+    def touch(self, cont):
+        """Mark a container as having just been accessed."""
+        with self._lock:
+            self._clock += 1
+            cont._last_access = self._clock
+
+    def enforce(self, keep=None):
+        """Spill the least recently used containers until we are within budget.
+
+        Parameters
+        ----------
+        keep : ContainerBase, optional
+            A container that must not be spilled, usually the one currently
+            being accessed.
+        """
+        with self._lock:
+            in_memory = list(self._containers)
+            total = sum(c._local_nbytes() for c in in_memory)
+
+            for cont in sorted(in_memory, key=lambda c: c._last_access):
+                if total <= self.limit:
+                    break
+
+                if cont is not keep:
+                    total -= cont._spill(self.directory)
+
+
+# The active memory budget. Set with `set_memory_budget`.
+_memory_budget = None
+
+# The total size of the data moved from this rank by redistributing containers
+_redistributed_nbytes = 0
+
+# The block size used for redistributions. Set with `set_redistribute_block_size`.
+_redistribute_block_size = None
+
+# Datasets shared between containers by `ContainerBase.copy`, keyed by id. These
+# are never returned to a `BufferPool`.
+_shared_datasets = weakref.WeakValueDictionary()
+
+
+def redistributed_nbytes():
+    """The total size of the data moved by redistributing containers.
+
+    Returns
+    -------
+    nbytes : int
+        The local size (on this rank) of the datasets that have been
+        redistributed since the start of the run.
+    """
+    return _redistributed_nbytes
+
+
+def set_memory_budget(limit, directory=None):
+    """Set the per-rank memory budget for containers.
+
+    Only containers created after this call are tracked.
+
+    Parameters
+    ----------
+    limit : int or None
+        Memory budget in bytes. If `None` turn off the budget.
+    directory : str, optional
+        Directory to spill datasets into.
+    """
+    global _memory_budget
+
+    _memory_budget = MemoryBudget(limit, directory) if limit is not None else None
+
+
+def set_redistribute_block_size(block_size):
+    """Set the default block size for redistributing containers.
+
+    When set, datasets are redistributed in a sequence of blocks of roughly this
+    size, see :mod:`draco.util.blockdist`, which overlaps the communication of
+    each block with unpacking the last. Both the original and the redistributed
+    dataset are held until it's done, so to keep memory to about one copy plus a
+    block, tasks should process the blocks as they arrive with
+    :meth:`ContainerBase.iter_redistribute` instead.
+
+    Parameters
+    ----------
+    block_size : int or None
+        Block size in bytes. If `None`, redistribute whole datasets at once.
+    """
+    global _redistribute_block_size
+
+    _redistribute_block_size = block_size
+
+
+def redistribute_block_size(default=None):
+    """Get the default block size for redistributing containers.
+
+    Parameters
+    ----------
+    default : int, optional
+        Value to return if no block size has been set.
+
+    Returns
+    -------
+    block_size : int or None
+        Block size in bytes set by :func:`set_redistribute_block_size`, or
+        `default` if it has not been set.
+    """
+    return _redistribute_block_size or default
+
+
+class BufferPool:
+    """A pool of arrays to reuse for the datasets of new containers.
+
+    Containers created with a pool take the arrays for their datasets from it
+    when there is a free one of the right shape, type and distribution, and
+    give their arrays back to the pool when they are deleted. This saves
+    allocating and faulting in fresh memory for the output of every iteration
+    of a task.
+
+    Arrays are only returned to the pool if nothing else refers to them (e.g. a
+    view held by a task), their dataset isn't shared with a copy of the
+    container, and they own their memory. The pool is local to each rank.
+
+    Parameters
+    ----------
+    limit : int, optional
+        Maximum size of the free arrays held, in bytes. When it's exceeded the
+        arrays freed longest ago are dropped. By default there is no limit.
+    """
+
+    def __init__(self, limit=None):
+
+        self.limit = limit
+
+        self._free = []
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        """Total size of the free arrays in the pool."""
+        return self._nbytes
+
+    def get_like(self, arr):
+        """Take a free array matching another from the pool.
+
+        Parameters
+        ----------
+        arr : np.ndarray or MPIArray
+            The array to match. A match must have the same type, dtype, local
+            shape, and for MPIArrays global shape, distributed axis, local offset
+            and communicator.
+
+        Returns
+        -------
+        match : np.ndarray or MPIArray or None
+            The matching array, zeroed, or `None` if there isn't one.
+        """
+        key = self._key(arr)
+
+        with self._lock:
+            for ii, (free_key, free) in enumerate(self._free):
+                if free_key == key and (
+                    not isinstance(arr, mpiarray.MPIArray) or free.comm == arr.comm
+                ):
+                    del self._free[ii]
+                    self._nbytes -= free.nbytes
+                    break
+            else:
+                return None
+
+        free.view(np.ndarray)[:] = 0
+
+        return free
+
+    def put(self, arr):
+        """Return an array to the pool.
+
+        Parameters
+        ----------
+        arr : np.ndarray or MPIArray
+            The array. It must not be used after this.
+        """
+        if self.limit is not None and arr.nbytes > self.limit:
+            return
+
+        with self._lock:
+            self._free.append((self._key(arr), arr))
+            self._nbytes += arr.nbytes
+
+            while self.limit is not None and self._nbytes > self.limit:
+                _, dropped = self._free.pop(0)
+                self._nbytes -= dropped.nbytes
+
+    def track(self, cont):
+        """Return the arrays of a container's datasets to the pool when it's deleted.
+
+        Parameters
+        ----------
+        cont : ContainerBase
+            The container.
+        """
+        weakref.finalize(cont, self._reclaim, cont._data._get_storage())
+
+    def _reclaim(self, storage):
+        # Return the arrays in a deleted container's storage to the pool
+
+        for name in list(storage.keys()):
+
+            dset = storage[name]
+            arr = getattr(dset, "_data", None)
+
+            if not isinstance(arr, np.ndarray):
+                continue
+
+            # Skip datasets shared with a copy of the container
+            if _shared_datasets.get(id(dset)) is dset:
+                continue
+
+            # Only reuse arrays that own their memory, and that aren't referenced
+            # elsewhere (the references here are the dataset, `arr`, and the
+            # argument to `getrefcount`)
+            if (
+                arr.base is None
+                and arr.flags.writeable
+                and arr.flags.c_contiguous
+                and sys.getrefcount(arr) <= 3
+            ):
+                dset._data = None
+                self.put(arr)
+
+    @staticmethod
+    def _key(arr):
+        # The properties of an array that must match for it to be reused
+
+        key = (type(arr), arr.dtype.str, arr.shape)
+
+        if isinstance(arr, mpiarray.MPIArray):
+            key += (arr.global_shape, arr.axis, arr.local_offset)
+
+        return key
+
+
+def rebind_comm(cont, comm):
+    """Move a container onto another communicator in place.
+
+    Nothing is copied or communicated, so the new communicator must contain the
+    same processes in the same order as the container's current one (e.g. a
+    duplicate of it). Views of the distributed arrays taken before the call stay
+    on the old communicator.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container. It must be held in memory.
+    comm : MPI.Comm
+        The new communicator.
+
+    Returns
+    -------
+    old_comm : MPI.Comm
+        The container's previous communicator.
+    """
+
+    group = cont._data if isinstance(cont, memh5.MemDiskGroup) else cont
+
+    if not isinstance(group, memh5.MemGroup):
+        raise ValueError("Only containers held in memory can be moved.")
+
+    old_comm = group.comm
+
+    if comm is old_comm:
+        return old_comm
+
+    # caput has no public way of changing the communicator of a group or array
+    # without a collective operation (e.g. `MPIArray.wrap`), which can't be done
+    # here as this is called from the threads of concurrent tasks. So set the
+    # communicator where MemGroup and MPIArray keep it, and check through their
+    # public properties that this worked, so that any change to them in caput is
+    # an error rather than leaving the container on the old communicator.
+    group._storage_root._comm = comm
+
+    arrays = []
+    stack = [group]
+    while stack:
+        item = stack.pop()
+
+        if isinstance(item, memh5.MemGroup):
+            stack.extend(item.values())
+
+        elif isinstance(getattr(item, "_data", None), mpiarray.MPIArray):
+            item._data._comm = comm
+            arrays.append(item)
+
+    if group.comm is not comm or any(
+        dset.comm is not comm or dset[:].comm is not comm for dset in arrays
+    ):
+        raise RuntimeError(
+            "Could not move the container onto the new communicator. This relies "
+            "on the internals of caput.memh5 and caput.mpiarray, which may have "
+            "changed."
+        )
+
+    # Spilled datasets are recreated on the communicator they were spilled with
+    spilled = cont.__dict__.get("_spilled", {})
+    for name, (path, cleanup, dtype, info) in spilled.items():
+        if info is not None:
+            spilled[name] = (path, cleanup, dtype, info[:2] + (comm,))
+
+    return old_comm
+
+
+def _chunk_compressor(dset):
+    """Get a function that applies a dataset's HDF5 compression filter.
+
+    Parameters
+    ----------
+    dset : memh5.MemDataset
+        Dataset to compress.
+
+    Returns
+    -------
+    compress : callable or None
+        Function that compresses a chunk into the bytes HDF5 would store for it.
+        `None` if the filter is not supported.
+    """
+
+    dtype = dset.dtype
+
+    # Strings need converting before writing, so leave them to memh5
+    fields = [dtype[n] for n in dtype.names] if dtype.names else [dtype]
+    if any(dt.kind in "OSU" for dt in fields):
+        return None
+
+    if dset.compression is None:
+        return lambda chunk: chunk.tobytes()
+
+    if dset.compression in ["gzip", 1]:
+        import zlib
+
+        level = dset.compression_opts if dset.compression_opts is not None else 4
+        return lambda chunk: zlib.compress(chunk.tobytes(), level)
+
+    if COMPRESSION is not None and dset.compression == COMPRESSION:
+        import struct
+
+        import bitshuffle
+
+        block_size, method = dset.compression_opts
+        if method != bitshuffle.h5.H5_COMPRESS_LZ4:
+            return None
+
+        # Use the same default block size as the filter
+        if not block_size:
+            block_size = max(8192 // dtype.itemsize // 8 * 8, 128)
+
+        def _compress(chunk):
+            # The filter prefixes the data with the uncompressed size and the
+            # block size in bytes
+            header = struct.pack(">QI", chunk.nbytes, block_size * dtype.itemsize)
+            data = bitshuffle.compress_lz4(chunk.reshape(-1), block_size)
+            return header + data.tobytes()
+
+        return _compress
+
+    return None
+
+
+def _compress_chunks(dset, comm):
+    """Compress the chunks of a distributed dataset in parallel.
+
+    The dataset is redistributed so that each rank holds a whole number of
+    chunks along the distributed axis, and each rank then compresses its own.
+
+    Parameters
+    ----------
+    dset : memh5.MemDatasetDistributed
+        Dataset to compress.
+    comm : MPI.Comm
+        Communicator the dataset is distributed over.
+
+    Returns
+    -------
+    chunks : list of (tuple, bytes)
+        The global offset and compressed data of each chunk on this rank.
+    """
+
+    compress = _chunk_compressor(dset)
+
+    chunks = dset.chunks
+    axis = dset.distributed_axis
+    n = dset.global_shape[axis]
+
+    # Split whole chunks across the ranks
+    nchunk = -(-n // chunks[axis])
+    _, cstart, cend = mpiutil.split_local(nchunk, comm=comm)
+    start, end = cstart * chunks[axis], min(cend * chunks[axis], n)
+
+    local = dset[:].view(np.ndarray)
+    lstart = dset.local_offset[axis]
+    block = _repartition(local, axis, lstart, start, end, comm)
+
+    out = []
+    grid = [range(0, s, c) for s, c in zip(block.shape, chunks)]
+    for pos in itertools.product(*grid):
+
+        sl = tuple(slice(p, p + c) for p, c in zip(pos, chunks))
+        chunk = block[sl]
+
+        # Edge chunks are padded out to the full chunk shape
+        if chunk.shape != tuple(chunks):
+            padded = np.zeros(chunks, dtype=chunk.dtype)
+            padded[tuple(slice(0, s) for s in chunk.shape)] = chunk
+            chunk = padded
+
+        offset = list(pos)
+        offset[axis] += start
+        out.append((tuple(offset), compress(np.ascontiguousarray(chunk))))
+
+    return out
+
+
+def _repartition(local, axis, lstart, start, end, comm):
+    """Move a distributed array into a new partition along its distributed axis.
+
+    Parameters
+    ----------
+    local : np.ndarray
+        Local section of the array.
+    axis : int
+        Distributed axis.
+    lstart : int
+        Global index of the start of the local section.
+    start, end : int
+        Global range this rank should hold afterwards.
+    comm : MPI.Comm
+        Communicator the array is distributed over.
+
+    Returns
+    -------
+    block : np.ndarray
+        The new local section.
+    """
+
+    from mpi4py import MPI
+
+    current = comm.allgather((lstart, lstart + local.shape[axis]))
+    target = comm.allgather((start, end))
+    lend = current[comm.rank][1]
+
+    local = np.moveaxis(local, axis, 0)
+    block = np.empty((end - start,) + local.shape[1:], dtype=local.dtype)
+
+    requests, buffers = [], []
+
+    # Send the parts of our section that other ranks need
+    for rank, (ts, te) in enumerate(target):
+        s, e = max(lstart, ts), min(lend, te)
+        if s >= e:
+            continue
+
+        if rank == comm.rank:
+            block[s - start : e - start] = local[s - lstart : e - lstart]
+        else:
+            buf = np.ascontiguousarray(local[s - lstart : e - lstart])
+            requests.append(comm.Isend([buf, MPI.BYTE], dest=rank))
+            buffers.append(buf)
+
+    # And receive the parts we need from the other ranks
+    for rank, (cs, ce) in enumerate(current):
+        s, e = max(cs, start), min(ce, end)
+        if rank != comm.rank and s < e:
+            requests.append(
+                comm.Irecv([block[s - start : e - start], MPI.BYTE], source=rank)
+            )
+
+    MPI.Request.Waitall(requests)
+
+    return np.moveaxis(block, 0, axis)
+
+
+def _create_chunked_dataset(fh, name, dset):
+    """Create an empty HDF5 dataset matching a chunked memh5 dataset.
+
+    Parameters
+    ----------
+    fh : h5py.File
+        File to create the dataset in.
+    name : str
+        Name of the dataset.
+    dset : memh5.MemDatasetDistributed
+        Dataset to match.
+    """
+
+    h5dset = fh.create_dataset(
+        name,
+        shape=dset.global_shape,
+        dtype=dset.dtype,
+        chunks=dset.chunks,
+        compression=dset.compression,
+        compression_opts=dset.compression_opts,
+    )
+
+    for key, value in dset.attrs.items():
+        # h5py can't write unicode arrays
+        if isinstance(value, np.ndarray) and value.dtype.kind == "U":
+            value = value.astype(np.bytes_)
+        h5dset.attrs[key] = value
+
+
+def _coalesce_index(index):
+    """Group a list of indices into strided runs.
+
+    Parameters
+    ----------
+    index : list of int
+        Indices to read, in the order they should appear in the output.
+
+    Returns
+    -------
+    runs : list of (slice, slice)
+        Pairs of the slice into the selected output and the equivalent slice into
+        the full axis.
+    """
+
+    runs = []
+    start = 0
+    n = len(index)
+
+    while start < n:
+
+        # Extend the run while the stride stays the same and positive
+        end = start + 1
+        step = 1
+        if end < n and index[end] > index[start]:
+            step = index[end] - index[start]
+            while end < n and index[end] - index[end - 1] == step:
+                end += 1
+
+        runs.append((slice(start, end), slice(index[start], index[end - 1] + 1, step)))
+        start = end
+
+    return runs
+
+
+def _can_memmap(item):
+    """Test whether an HDF5 dataset can be memory mapped.
+
+    Parameters
+    ----------
+    item : h5py.Dataset
+
+    Returns
+    -------
+    can_memmap : bool
+        True if the dataset is stored contiguously without any filters, has
+        been allocated in the file, and has a plain numerical type.
+    """
+    return (
+        item.chunks is None
+        and item.compression is None
+        and item.dtype.kind in "biufc"
+        and item.id.get_offset() is not None
+    )
+
+
+def _read_selection(dset, index, out):
+    """Read the given indices along each axis of an HDF5 dataset.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        Dataset to read from.
+    index : list of np.ndarray
+        Indices to read along each axis.
+    out : np.ndarray
+        Array to read into.
+    """
+    runs = [_coalesce_index(list(ix)) for ix in index]
+    for block in itertools.product(*runs):
+        out_sl = tuple(r[0] for r in block)
+        file_sl = tuple(r[1] for r in block)
+        out[out_sl] = dset[file_sl]
+
+
+def _match_dataset(name, datasets=None, exclude=None):
+    """Test whether a dataset is selected by include and exclude lists.
+
+    Entries match the dataset of that name, or any dataset within a group of
+    that name.
+
+    Parameters
+    ----------
+    name : str
+        Name of the dataset.
+    datasets : list of str, optional
+        Datasets to include. By default include everything.
+    exclude : list of str, optional
+        Datasets to exclude. Takes precedence over `datasets`.
+
+    Returns
+    -------
+    match : bool
+    """
+
+    def _in(names):
+        return any(name == n or name.startswith(n + "/") for n in names)
+
+    name = name.strip("/")
+    datasets = [n.strip("/") for n in datasets] if datasets is not None else None
+    exclude = [n.strip("/") for n in exclude] if exclude is not None else None
+
+    if exclude and _in(exclude):
+        return False
+
+    return datasets is None or _in(datasets)
+
+
+def _read_file(
+    cls,
+    filename,
+    sel,
+    distributed,
+    comm,
+    convert_strings,
+    memmap,
+    lazy=False,
+    datasets=None,
+    exclude_datasets=None,
+):
+    """Read a container, applying selections and optionally memory mapping.
+
+    Parameters
+    ----------
+    cls : subclass of `ContainerBase`
+        Type of container to create.
+    filename : str
+        File to read.
+    sel : dict
+        Selections as `<axis>_sel` keys, and slices or index lists as values.
+    distributed : bool
+        Whether to distribute the container.
+    comm : MPI.Comm
+        Communicator to distribute over.
+    convert_strings : bool
+        Convert strings to unicode.
+    memmap : bool
+        Memory map datasets that support it, rather than reading them.
+    lazy : bool, optional
+        Leave the file open and read datasets defined in the container's spec
+        only when they are first accessed.
+    datasets, exclude_datasets : list of str, optional
+        Only read these datasets, and skip these ones. See
+        :func:`_match_dataset`.
+
+    Returns
+    -------
+    cont : subclass of `ContainerBase`
+    """
+
+    from ..util import encoding as enc
+
+    def _convert(x):
+        return memh5.bytes_to_unicode(x) if convert_strings else x
+
+    # Datasets to read on first access, and their indices into the file
+    lazy_index = {}
+
+    fh = h5py.File(filename, "r")
+
+    try:
+
+        # Apply the selections to the axis definitions
+        axes = {}
+        axis_index = {}
+        for axis in fh["index_map"]:
+            axis_map = fh["index_map"][axis][:]
+            axis_index[axis] = np.arange(len(axis_map))[
+                sel.get(f"{axis}_sel", slice(None))
+            ]
+            axes[axis] = _convert(axis_map[axis_index[axis]])
+
+        cont = cls(skip_datasets=True, distributed=distributed, comm=comm, **axes)
+
+        # Add any axes the container class doesn't know about, and the reverse maps
+        for axis, axis_map in axes.items():
+            if axis not in cont.index_map:
+                cont.create_index_map(axis, axis_map)
+
+        for name, rmap in fh.get("reverse_map", {}).items():
+            if name not in cont.reverse_map:
+                cont.create_reverse_map(name, _convert(rmap[:]))
+
+        memh5.copyattrs(fh.attrs, cont.attrs, convert_strings=convert_strings)
+
+        def _visit(name, item):
+
+            if name.split("/")[0] in ["index_map", "reverse_map"]:
+                return
+
+            if isinstance(item, h5py.Group):
+                group = cont.create_group(name) if name not in cont else cont[name]
+                memh5.copyattrs(
+                    item.attrs, group.attrs, convert_strings=convert_strings
+                )
+                return
+
+            if not _match_dataset(name, datasets, exclude_datasets):
+                return
+
+            dset_axes = _convert(item.attrs.get("axis", None))
+            encoding = enc.encoding_of(item)
+
+            if dset_axes is not None:
+                index = [axis_index[axis] for axis in dset_axes]
+                slices = [sel.get(f"{axis}_sel", slice(None)) for axis in dset_axes]
+
+                # The last axis of a packed mask holds the packed bits, so it can't
+                # have a selection applied
+                if encoding == "bitpack":
+                    if slices[-1] != slice(None):
+                        raise ValueError(
+                            f"Can not select along the last axis of packed mask {name}."
+                        )
+                    index[-1] = np.arange(item.shape[-1])
+
+            # Datasets without axes can't have selections applied
+            if dset_axes is None:
+                dset = cont.create_dataset(name, data=_convert(item[()]))
+
+            elif name in cont.dataset_spec:
+                if encoding is None:
+                    dset = cont.add_dataset(name)
+                else:
+                    # Encoded datasets have a different type, and for packed masks
+                    # shape, to the spec, so create them as they are in the file
+                    template = cont._schema.templates[name]
+                    dset = cont.create_dataset(
+                        name,
+                        shape=tuple(len(ix) for ix in index),
+                        dtype=item.dtype,
+                        distributed=cont.distributed and template["distributed"],
+                        distributed_axis=template["distributed_axis"],
+                    )
+
+                # Memory mapping only gives a view for slice selections
+                if (
+                    memmap
+                    and _can_memmap(item)
+                    and all(isinstance(sl, slice) for sl in slices)
+                ):
+                    data = np.memmap(
+                        filename,
+                        mode="r",
+                        dtype=item.dtype,
+                        offset=item.id.get_offset(),
+                        shape=item.shape,
+                    )
+                    data = np.asarray(data)[tuple(slices)]
+                else:
+                    data = None
+
+                if dset.distributed:
+                    # Use only this rank's section of the distributed axis
+                    ax = dset.distributed_axis
+                    _, start, end = mpiutil.split_local(len(index[ax]), comm=comm)
+
+                    index[ax] = index[ax][start:end]
+                    if data is not None:
+                        local = data[(slice(None),) * ax + (slice(start, end),)]
+                        data = mpiarray.MPIArray.wrap(local, axis=ax, comm=comm)
+
+                if data is not None:
+                    dset._data = data
+                elif lazy:
+                    # The empty array won't use any memory until it's read into
+                    lazy_index[name] = index
+                else:
+                    _read_selection(item, index, dset[:].view(np.ndarray))
+
+            elif distributed and item.attrs.get("__memh5_distributed_dset", False):
+                # Datasets saved as distributed that aren't in the spec are split
+                # over their first axis, as memh5 does, and only the local section
+                # is read
+                dset = cont.create_dataset(
+                    name,
+                    shape=tuple(len(ix) for ix in index),
+                    dtype=item.dtype,
+                    distributed=True,
+                    distributed_axis=0,
+                )
+                local = dset[:]
+                start = local.local_offset[0]
+                index[0] = index[0][start : start + local.local_shape[0]]
+                _read_selection(item, index, local.view(np.ndarray))
+
+            else:
+                data = np.empty([len(ix) for ix in index], dtype=item.dtype)
+                _read_selection(item, index, data)
+                dset = cont.create_dataset(name, data=_convert(data))
+
+            memh5.copyattrs(item.attrs, dset.attrs, convert_strings=convert_strings)
+
+        fh.visititems(_visit)
+
+    except Exception:
+        fh.close()
+        raise
+
+    if lazy_index:
+        cont._set_lazy(fh, lazy_index)
+    else:
+        fh.close()
+
+    return cont
+
+
+class _LazyDatasets(Mapping):
+    """A read only view of a container's datasets, read on first access."""
+
+    def __init__(self, datasets, cont):
+        self._datasets = datasets
+        self._cont = cont
+
+    def __getitem__(self, name):
+        self._cont._access(lazy=name)
+        return self._datasets[name]
+
+    def __contains__(self, name):
+        return name in self._datasets
+
+    def __iter__(self):
+        return iter(self._datasets)
+
+    def __len__(self):
+        return len(self._datasets)
+
+
+class _Schema:
+    """The fully resolved dataset specification and axes of a container.
+
+    Resolving these means walking the MRO, so they are computed once per class
+    (and per instance for instances that define their own `_dataset_spec` or
+    `_axes`) and cached.
+
+    Parameters
+    ----------
+    dataset_spec : dict
+        The resolved dataset specification.
+    axes : iterable
+        The axes.
 
-import numpy as np
+    Attributes
+    ----------
+    dataset_spec : dict
+        The dataset specification, sorted by name so it's the same on all ranks.
+    axes : tuple
+        The sorted axes.
+    templates : dict
+        For each dataset, the arguments used to create it: its `axes`, `dtype`,
+        whether it is `distributed`, the index of the `distributed_axis`, and the
+        `chunks`, `compression` and `compression_opts`.
+    """
 
-from caput import memh5, tod
+    def __init__(self, dataset_spec, axes):
+        self.dataset_spec = {k: dataset_spec[k] for k in sorted(dataset_spec)}
 
-# Try to import bitshuffle to set the default compression options
-try:
-    import bitshuffle.h5
+        # This must be the same order on all ranks, so we need to explicitly sort
+        # to get around the hash randomization
+        self.axes = tuple(sorted(set(axes)))
 
-    COMPRESSION = bitshuffle.h5.H5FILTER
-    COMPRESSION_OPTS = (0, bitshuffle.h5.H5_COMPRESS_LZ4)
-except ImportError:
-    COMPRESSION = None
-    COMPRESSION_OPTS = None
+        self.templates = {
+            name: self._template(spec) for name, spec in self.dataset_spec.items()
+        }
+
+    @classmethod
+    def from_class(cls, container_cls, dataset_spec=None, axes=None):
+        """Resolve the schema of a container class.
+
+        Parameters
+        ----------
+        container_cls : type
+            The container class.
+        dataset_spec : dict, optional
+            Extra dataset specifications, e.g. from an instance.
+        axes : iterable, optional
+            Extra axes, e.g. from an instance.
+
+        Returns
+        -------
+        schema : _Schema
+        """
+        ddict = {}
+        axis_set = set()
+
+        # Iterate over the reversed MRO and look for _dataset_spec and _axes
+        # attributes. We go over the reversed MRO so that the `ddict.update`
+        # overrides datasets in base classes.
+        for c in inspect.getmro(container_cls)[::-1]:
+
+            # NOTE: this will drop down to base classes if the attributes aren't
+            # present, and thus try and `update` with the same values again.
+            ddict.update(getattr(c, "_dataset_spec", {}))
+            axis_set |= set(getattr(c, "_axes", ()))
+
+        ddict.update(dataset_spec or {})
+        axis_set |= set(axes or ())
+
+        return cls(ddict, axis_set)
+
+    @staticmethod
+    def _template(spec):
+        # Pre-process the dataset spec into the arguments for `create_dataset`
+
+        axes = tuple(spec.get("axes", ()))
+        dist_axis = spec.get("distributed_axis", axes[0] if axes else None)
+
+        return {
+            "axes": axes,
+            "dtype": spec.get("dtype", None),
+            "distributed": spec.get("distributed", True),
+            "distributed_axis": axes.index(dist_axis) if dist_axis in axes else None,
+            "chunks": spec.get("chunks", None),
+            "compression": spec.get("compression", None),
+            "compression_opts": spec.get("compression_opts", None),
+        }
 
 
 class ContainerBase(memh5.BasicCont):
@@ -72,6 +1051,9 @@ class ContainerBase(memh5.BasicCont):
     skip_datasets : bool, optional
         Skip creating datasets. They must all be added manually with
         `.add_dataset` regardless of the entry in `.dataset_spec`. Default is False.
+    pool : BufferPool, optional
+        Take the arrays for datasets added with `.add_dataset` from this pool
+        where possible, and return them to it once the container is deleted.
     kwargs : dict
         Should contain entries for all other axes.
 
@@ -118,11 +1100,23 @@ class ContainerBase(memh5.BasicCont):
         skip_datasets = kwargs.pop("skip_datasets", False)
         dist = kwargs.pop("distributed", True)
         comm = kwargs.pop("comm", None)
+        pool = kwargs.pop("pool", None)
         self.allow_chunked = kwargs.pop("allow_chunked", False)
 
         # Run base initialiser
         memh5.BasicCont.__init__(self, distributed=dist, comm=comm)
 
+        # Track the memory usage of this container if there is a budget
+        self._spilled = {}
+        self._lazy = {}
+        if _memory_budget is not None:
+            _memory_budget.register(self)
+
+        # Reuse arrays from the pool for the datasets, and give them back after
+        self._pool = pool
+        if pool is not None:
+            pool.track(self)
+
         # Check to see if this call looks like it was called like
         # memh5.MemDiskGroup would have been. If it is, we're probably trying to
         # create a bare container, so don't initialise any datasets. This
@@ -156,7 +1150,7 @@ class ContainerBase(memh5.BasicCont):
 
         # Iterate over datasets and initialise any that specify it
         if not skip_datasets:
-            for name, spec in self.dataset_spec.items():
+            for name, spec in self._schema.dataset_spec.items():
                 if "initialise" in spec and spec["initialise"]:
                     self.add_dataset(name)
 
@@ -167,7 +1161,7 @@ class ContainerBase(memh5.BasicCont):
             memh5.copyattrs(attrs_from.attrs, self.attrs)
 
             # Copy attributes over from any common datasets
-            for name in self.dataset_spec.keys():
+            for name in self._schema.dataset_spec:
                 if name in self.datasets and name in attrs_from.datasets:
                     attrs_no_axis = {
                         k: v
@@ -198,22 +1192,23 @@ class ContainerBase(memh5.BasicCont):
         """
 
         # Dataset must be specified
-        if name not in self.dataset_spec:
+        templates = self._schema.templates
+        if name not in templates:
             raise RuntimeError("Dataset name not known.")
 
-        dspec = self.dataset_spec[name]
+        template = templates[name]
 
         # Fetch dataset properties
-        axes = dspec["axes"]
-        dtype = dspec["dtype"]
+        axes = template["axes"]
+        dtype = template["dtype"]
         chunks, compression, compression_opts = None, None, None
         if self.allow_chunked:
-            chunks = dspec.get("chunks", None)
-            compression = dspec.get("compression", None)
-            compression_opts = dspec.get("compression_opts", None)
+            chunks = template["chunks"]
+            compression = template["compression"]
+            compression_opts = template["compression_opts"]
 
         # Get distribution properties
-        dist = self.distributed and dspec.get("distributed", True)
+        dist = self.distributed and template["distributed"]
         shape = ()
 
         # Check that all the specified axes are defined, and fetch their lengths
@@ -228,11 +1223,9 @@ class ContainerBase(memh5.BasicCont):
 
             shape += (l,)
 
-        # Fetch distributed axis, and turn into axis index
-        dist_axis = (
-            dspec["distributed_axis"] if "distributed_axis" in dspec else axes[0]
-        )
-        dist_axis = list(axes).index(dist_axis)
+        dist_axis = template["distributed_axis"]
+        if dist_axis is None:
+            raise ValueError(f"Distributed axis of {name} is not one of its axes.")
 
         # Check chunk dimensions are consistent with axis
         if chunks is not None:
@@ -253,10 +1246,116 @@ class ContainerBase(memh5.BasicCont):
             compression_opts=compression_opts,
         )
 
+        # Swap in an array from the pool. The one just allocated has not been
+        # written to, so it has cost nothing but the allocation.
+        pool = self.__dict__.get("_pool", None)
+        if pool is not None:
+            arr = pool.get_like(dset._data)
+            if arr is not None:
+                dset._data = arr
+
         dset.attrs["axis"] = np.array(axes)
 
+        self._access()
+
         return dset
 
+    @classmethod
+    def from_file(
+        cls,
+        file_,
+        ondisk=False,
+        distributed=False,
+        comm=None,
+        *,
+        memmap=False,
+        lazy=False,
+        datasets=None,
+        exclude_datasets=None,
+        **kwargs,
+    ):
+        """Load a container from a file.
+
+        This behaves like :meth:`memh5.BasicCont.from_file`, with some additions.
+        Index selections (`<axis>_sel` given as a list) are supported for
+        distributed loads, with each rank reading only the parts of the file it
+        needs. Datasets can be memory mapped, or read only when first used. And,
+        only a subset of the datasets can be loaded.
+
+        Parameters
+        ----------
+        file_ : str or h5py.File
+            HDF5 file to load.
+        ondisk : bool, optional
+            Keep the data on disk rather than loading it into memory, as in
+            :meth:`memh5.BasicCont.from_file`. The options below are ignored if
+            this is set.
+        distributed : bool, optional
+            Distribute the container across ranks.
+        comm : MPI.Comm, optional
+            Communicator to distribute over. Defaults to the world communicator.
+        memmap : bool, optional
+            Back the datasets with read-only memory maps of the file, so their
+            data is only read from disk when it is used. This is only possible for
+            datasets stored contiguously without compression, and with range
+            selections only. Other datasets are read as usual. The container's
+            datasets can't be modified in place or redistributed without copying.
+        lazy : bool, optional
+            Keep the file open and only read each dataset in the container's spec
+            the first time it is accessed, e.g. by `cont.vis`. Each rank reads
+            its own section independently, so the ranks don't need to access the
+            same datasets. Operations on the whole container (saving, copying,
+            redistributing) read any remaining datasets first. The file is closed
+            once all datasets are read, or the container is deleted.
+        datasets : list of str, optional
+            Only load these datasets. Entries can also be groups, in which case
+            all datasets within them are loaded.
+        exclude_datasets : list of str, optional
+            Don't load these datasets or groups. Takes precedence over `datasets`.
+        **kwargs
+            Other arguments, including selections, passed on to
+            :meth:`memh5.BasicCont.from_file`.
+
+        Returns
+        -------
+        cont : subclass of ContainerBase
+        """
+
+        sel = {k: v for k, v in kwargs.items() if k.endswith("_sel")}
+        index_sel = any(not isinstance(v, slice) for v in sel.values())
+
+        if (
+            isinstance(file_, str)
+            and not ondisk
+            and (
+                memmap
+                or lazy
+                or datasets is not None
+                or exclude_datasets is not None
+                or (distributed and index_sel)
+            )
+        ):
+
+            comm = comm if comm is not None else mpiutil.world
+            convert = kwargs.get("convert_dataset_strings", cls.convert_dataset_strings)
+
+            return _read_file(
+                cls,
+                file_,
+                sel,
+                distributed,
+                comm,
+                convert,
+                memmap,
+                lazy=lazy,
+                datasets=datasets,
+                exclude_datasets=exclude_datasets,
+            )
+
+        return super(ContainerBase, cls).from_file(
+            file_, ondisk=ondisk, distributed=distributed, comm=comm, **kwargs
+        )
+
     @property
     def datasets(self):
         """Return the datasets in this container.
@@ -270,70 +1369,658 @@ class ContainerBase(memh5.BasicCont):
             Entries are :mod:`caput.memh5` datasets.
 
         """
-        out = {}
-        for name, value in self._data.items():
-            if not memh5.is_group(value):
-                out[name] = value
+        self._access(lazy=False)
+
+        # The dataset names are cached until one is created, or the number of
+        # items in the root group changes (e.g. one is deleted). Only the names
+        # are cached so that the cache doesn't hold references to the datasets,
+        # which would stop them being spilled or returned to a pool.
+        storage = self._data._get_storage()
+        key = (id(storage), len(storage))
+        cache = self.__dict__.get("_datasets_cache", None)
+
+        if cache is None or cache[0] != key:
+            names = [
+                name for name, value in self._data.items() if not memh5.is_group(value)
+            ]
+            cache = (key, names)
+            self._datasets_cache = cache
+
+        out = {name: storage[name] for name in cache[1]}
+
+        if self.is_lazy:
+            return _LazyDatasets(out, self)
+
         return memh5.ro_dict(out)
 
+    def create_dataset(self, name, *args, **kwargs):
+        """Create a new dataset.
+
+        See :meth:`memh5.BasicCont.create_dataset`.
+        """
+        self._datasets_cache = None
+        dset = super(ContainerBase, self).create_dataset(name, *args, **kwargs)
+
+        self._enforce_budget()
+
+        return dset
+
+    def __getitem__(self, name):
+        self._access(lazy=name)
+        return super(ContainerBase, self).__getitem__(name)
+
+    def redistribute(self, dist_axis, block_size=None):
+        """Redistribute all distributed datasets in the container.
+
+        Nothing is done if all the datasets are already distributed correctly.
+        This supersedes any redistribution deferred with
+        :meth:`defer_redistribute`. The local size of the datasets moved is
+        added to the count returned by :func:`redistributed_nbytes`.
+
+        See :meth:`memh5.BasicCont.redistribute`.
+
+        Parameters
+        ----------
+        dist_axis : str or list of str
+            The axis to redistribute over. If a list, each dataset is
+            redistributed over the first of the axes it has.
+        block_size : int, optional
+            Redistribute each dataset in blocks of about this many bytes. If not
+            set use the default from :func:`set_redistribute_block_size`. This
+            still holds the whole of the original and the redistributed dataset
+            at once, see :meth:`iter_redistribute` to avoid that.
+        """
+        global _redistributed_nbytes
+
+        self._access()
+        self._pending_axis = None
+
+        # The plan only covers datasets at the top level, so leave containers
+        # with groups to memh5, which redistributes the datasets within them too
+        if any(memh5.is_group(item) for item in self._data.values()):
+            super(ContainerBase, self).redistribute(dist_axis)
+            return
+
+        plan = self._redistribute_plan(dist_axis)
+
+        if not plan:
+            return
+
+        nbytes = sum(dset[:].nbytes for dset, _ in plan)
+
+        if block_size is None:
+            block_size = redistribute_block_size()
+
+        if block_size:
+            from ..util import blockdist
+
+            for dset, axis in plan:
+                dset._data = blockdist.redistribute(dset._data, axis, block_size)
+        else:
+            super(ContainerBase, self).redistribute(dist_axis)
+
+        _redistributed_nbytes += nbytes
+
+        logger.debug(
+            "Redistributed %s to %s, moving %.1f MB from this rank",
+            self.__class__.__name__,
+            dist_axis,
+            nbytes / 2 ** 20,
+        )
+
+    def iter_redistribute(self, names, dist_axis, block_size=None):
+        """Iterate over datasets in blocks, as if they were redistributed.
+
+        The datasets are exchanged between ranks one block at a time, each block
+        being part of the local section the dataset would have if it were
+        redistributed over `dist_axis`. The exchange of the next block overlaps
+        with processing the current one. The container itself is left as it is,
+        so only a couple of blocks are held at any time rather than a full
+        redistributed copy.
+
+        This must be called on all ranks, and the iteration run to completion on
+        all ranks.
+
+        Parameters
+        ----------
+        names : list of str
+            The datasets. They must all be distributed and have `dist_axis`, and
+            must not be compactly encoded (see :meth:`encode_dataset`).
+        dist_axis : str
+            The axis to iterate over.
+        block_size : int, optional
+            Size of the blocks of the largest dataset on each rank, in bytes. If
+            not set use the default from :func:`set_redistribute_block_size`, or
+            64 MB if that is not set.
+
+        Yields
+        ------
+        start, end : int
+            The range of the block along `dist_axis`, as global indices.
+        blocks : list of np.ndarray
+            The blocks of each dataset. They have their full length along all
+            other axes.
+        """
+        from ..util import blockdist
+
+        self._access()
+
+        if block_size is None:
+            block_size = redistribute_block_size(2 ** 26)
+
+        arrays = []
+        for name in names:
+            # The blocks are used as they are, so refuse encoded datasets in the
+            # same way as the named accessors
+            dset = self._unencoded(name)
+            arrays.append((dset[:], list(dset.attrs["axis"]).index(dist_axis)))
+
+        # Use the same number of rows for all datasets so the blocks line up
+        rows = min(
+            blockdist.block_rows(arr.global_shape, axis, arr.itemsize, block_size)
+            for arr, axis in arrays
+        )
+
+        iters = [
+            blockdist.iter_redistribute(arr, axis, rows=rows) for arr, axis in arrays
+        ]
+
+        for blocks in zip(*iters):
+            yield blocks[0][0], [block for _, block in blocks]
+
+    def defer_redistribute(self, dist_axis):
+        """Redistribute the container only once it's needed.
+
+        The redistribution is done by the next :class:`task.SingleTask` the
+        container is passed to. If that task declares the axis it needs its input
+        distributed over, it's redistributed straight to that axis, otherwise to
+        `dist_axis`. This lets a task ask for its output to be left in a
+        standard distribution without a transpose being done only to be undone
+        by the next task.
+
+        Parameters
+        ----------
+        dist_axis : str or list of str
+            The axis to redistribute over if no other is needed.
+        """
+        self._pending_axis = dist_axis
+
+    @property
+    def pending_axis(self):
+        """The axis a deferred redistribution is to, or `None` if there is none."""
+        return self.__dict__.get("_pending_axis", None)
+
+    def _redistribute_plan(self, dist_axis):
+        # Work out which datasets redistributing to `dist_axis` would move, and
+        # the index of the axis each would be distributed over. This is the same
+        # on all ranks.
+
+        axes = [dist_axis] if isinstance(dist_axis, str) else list(dist_axis)
+
+        plan = []
+
+        for dset in self.datasets.values():
+
+            if not dset.distributed or "axis" not in dset.attrs:
+                continue
+
+            dset_axes = list(dset.attrs["axis"])
+
+            for ax in axes:
+                if ax in dset_axes:
+                    if dset_axes.index(ax) != dset.distributed_axis:
+                        plan.append((dset, dset_axes.index(ax)))
+                    break
+
+        return plan
+
+    def save(self, filename, *args, **kwargs):
+        """Save the container to disk.
+
+        Distributed datasets with chunking are written chunk by chunk, see
+        :meth:`to_hdf5`. Otherwise see :meth:`memh5.BasicCont.save`.
+
+        Containers that have been split over a process grid (see
+        :mod:`draco.util.decomp`) can't be saved, as each group only holds part of
+        the data. Recombine them first, e.g. with
+        :class:`draco.core.misc.CombineOverGrid`.
+        """
+        self._check_saveable()
+        self._access()
+
+        write = super(ContainerBase, self).save
+        if str(filename).endswith(".zarr"):
+            return write(filename, *args, **kwargs)
+
+        return self._write_chunked(write, filename, *args, **kwargs)
+
+    def to_hdf5(self, filename, *args, **kwargs):
+        """Write the container to an HDF5 file.
+
+        Distributed datasets that have chunks set (see `allow_chunked`) and use
+        a compression filter we can apply ourselves (none, gzip or bitshuffle
+        LZ4) are written with their chunk shapes. Each rank compresses its own
+        chunks after a redistribution that aligns the local sections with the
+        chunk boundaries, and the compressed chunks are then written directly
+        into the file one rank at a time. Only the compression is parallel: the
+        write itself is serial over the ranks, as HDF5 without MPI support allows
+        only one process to write to a file at once. The compression is by far
+        the larger cost, so this is still much faster than writing through the
+        filter. Everything else is written by :meth:`memh5.BasicCont.to_hdf5`.
+        """
+        self._check_saveable()
+        self._access()
+
+        write = super(ContainerBase, self).to_hdf5
+        return self._write_chunked(write, filename, *args, **kwargs)
+
+    def _check_saveable(self):
+        # Sub-containers of a process grid only hold part of the data, and each
+        # group would write its own file over its own communicator
+
+        from ..util import decomp
+
+        if decomp.is_decomposed(self):
+            raise ValueError(
+                "Can't save a container that has been split over a process grid. "
+                "Recombine it first with CombineOverGrid."
+            )
+
+    def _write_chunked(self, write, filename, *args, **kwargs):
+        # Write the container with `write`, but with any distributed and chunked
+        # datasets written separately in parallel compressed chunks
+
+        storage = self._data._get_storage()
+
+        chunked = {}
+        if self.distributed:
+            for name in list(storage.keys()):
+                dset = storage[name]
+                if (
+                    not memh5.is_group(dset)
+                    and dset.distributed
+                    and dset.chunks is not None
+                    and _chunk_compressor(dset) is not None
+                ):
+                    chunked[name] = dset
+
+        if not chunked:
+            return write(filename, *args, **kwargs)
+
+        # Temporarily remove the chunked datasets while writing everything else
+        try:
+            for name in chunked:
+                del storage[name]
+            write(filename, *args, **kwargs)
+        finally:
+            storage.update(chunked)
+
+        # Redistribute and compress the chunks on every rank at once
+        compressed = {
+            name: _compress_chunks(dset, self.comm) for name, dset in chunked.items()
+        }
+
+        # Write the chunks one rank at a time, with the first rank also creating
+        # the datasets. This part is serial, but writing already compressed chunks
+        # is a small fraction of the time spent compressing them. Funnelling the
+        # chunks through a single writing rank instead was slower, from the extra
+        # copies of the data.
+        for rank in range(self.comm.size):
+            if rank == self.comm.rank:
+                with h5py.File(filename, "r+") as fh:
+                    for name, dset in chunked.items():
+                        if rank == 0:
+                            _create_chunked_dataset(fh, name, dset)
+
+                        h5dset = fh[name]
+                        for offset, data in compressed[name]:
+                            h5dset.id.write_direct_chunk(offset, data)
+            self.comm.Barrier()
+
+    def encode_dataset(self, name, encoding):
+        """Replace a dataset with a compact encoding of itself.
+
+        See :mod:`draco.util.encoding` for details. The encoded dataset keeps its
+        name and attributes. Code reading it must decode it, e.g. with
+        :func:`draco.util.encoding.decode`, or the dataset can be converted back
+        with :meth:`decode_dataset`. The named accessors of the container (e.g.
+        `weight`) raise a `ValueError` for encoded datasets, so tasks that don't
+        support them fail rather than using the codes as values. Encoded datasets
+        are still available through :attr:`datasets`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the dataset.
+        encoding : {"log8", "log16", "bitpack"}
+            Log-quantise weights into 8 or 16 bits, or pack a boolean mask into
+            bits along its last axis.
+        """
+        from ..util import encoding as enc
+
+        dset = self.datasets[name]
+
+        if enc.encoding_of(dset) is not None:
+            raise ValueError(f"Dataset {name} is already encoded.")
+
+        local = dset[:].view(np.ndarray)
+        shape = dset.global_shape if dset.distributed else dset.shape
+
+        if encoding in enc.LOG_ENCODINGS:
+            comm = self.comm if dset.distributed else None
+            bits = enc.LOG_ENCODINGS[encoding]
+            data, attrs = enc.encode_log(local, bits, comm=comm)
+
+        elif encoding == "bitpack":
+            if dset.distributed and dset.distributed_axis == len(shape) - 1:
+                raise ValueError("Can not pack a mask along its distributed axis.")
+            data, attrs = enc.pack_mask(local)
+            shape = shape[:-1] + (-(-shape[-1] // 8),)
+
+        else:
+            raise ValueError(f"Unknown encoding {encoding}.")
+
+        self._replace_dataset(name, data, shape, attrs)
+
+    def decode_dataset(self, name):
+        """Replace an encoded dataset with its decoded values.
+
+        Parameters
+        ----------
+        name : str
+            Name of the dataset. If it's not encoded, nothing is done.
+        """
+        from ..util import encoding as enc
+
+        dset = self.datasets[name]
+        encoding = enc.encoding_of(dset)
+
+        if encoding is None:
+            return
+
+        data = enc.decode(dset)
+        shape = dset.global_shape if dset.distributed else dset.shape
+
+        if encoding == "bitpack":
+            shape = shape[:-1] + (data.shape[-1],)
+
+        self._replace_dataset(name, data, shape, {})
+
+    def _replace_dataset(self, name, data, shape, attrs):
+        # Replace a dataset with one containing the local section `data`, keeping
+        # its distribution, chunking and attributes other than any encoding ones
+
+        from ..util import encoding as enc
+
+        dset = self.datasets[name]
+
+        kwargs = {"distributed": dset.distributed}
+        if dset.distributed:
+            kwargs["distributed_axis"] = dset.distributed_axis
+
+        if dset.chunks is not None:
+            kwargs["chunks"] = tuple(min(c, n) for c, n in zip(dset.chunks, shape))
+            kwargs["compression"] = dset.compression
+            kwargs["compression_opts"] = dset.compression_opts
+
+        old_attrs = {k: v for k, v in dset.attrs.items() if k not in enc.ENCODING_ATTRS}
+
+        del self._data._get_storage()[name]
+        del dset
+
+        new_dset = self.create_dataset(name, shape=shape, dtype=data.dtype, **kwargs)
+        new_dset[:].view(np.ndarray)[:] = data
+
+        memh5.copyattrs(old_attrs, new_dset.attrs)
+        memh5.copyattrs(attrs, new_dset.attrs)
+
+    def _unencoded(self, name):
+        # Get a dataset for one of the named accessors (e.g. `weight`). Code using
+        # these treats the values as they are, so refuse to give out compactly
+        # encoded datasets. Code that can decode them gets them from `datasets`.
+
+        from ..util import encoding as enc
+
+        dset = self.datasets[name]
+        encoding = enc.encoding_of(dset)
+
+        if encoding is not None:
+            raise ValueError(
+                f"Dataset {name} is compactly encoded ({encoding}) and can't be "
+                "used directly. Decode it first with `decode_dataset`."
+            )
+
+        return dset
+
+    @property
+    def is_spilled(self):
+        """Whether any datasets are currently spilled to disk."""
+        return bool(self.__dict__.get("_spilled"))
+
+    @property
+    def is_lazy(self):
+        """Whether any datasets are still to be read from the file."""
+        return bool(self.__dict__.get("_lazy"))
+
+    def _access(self, lazy=True):
+        # Read back any spilled datasets and update the memory budget. `lazy`
+        # gives the lazily loaded datasets to read: all of them if True, those
+        # with the given name (or within the given group) if a string, or none if
+        # False
+
+        # Only reading data in can take us over the budget, so only enforce it
+        # then. Checking the budget on every access would be too slow.
+        allocated = False
+
+        if lazy and self.is_lazy:
+            allocated = self._load_lazy(None if lazy is True else lazy)
+
+        if self.is_spilled:
+            self._fault()
+            allocated = True
+
+        if _memory_budget is not None and self in _memory_budget._containers:
+            _memory_budget.touch(self)
+
+            if allocated:
+                _memory_budget.enforce(keep=self)
+
+    def _enforce_budget(self):
+        # Enforce the memory budget after allocating memory for this container
+        if _memory_budget is not None and self in _memory_budget._containers:
+            _memory_budget.touch(self)
+            _memory_budget.enforce(keep=self)
+
+    def _local_nbytes(self):
+        # The memory used by the local sections of the datasets in memory
+        storage = self._data._get_storage()
+        return sum(
+            storage[name]._data.nbytes
+            for name in storage
+            if not memh5.is_group(storage[name])
+            and name not in self._spilled
+            and name not in self._lazy
+        )
+
+    def _spill(self, directory):
+        # Write the local sections of the datasets into scratch files and release
+        # them. Returns the number of bytes freed.
+
+        storage = self._data._get_storage()
+        freed = 0
+
+        for name in list(storage.keys()):
+            dset = storage[name]
+
+            if memh5.is_group(dset) or name in self._spilled or name in self._lazy:
+                continue
+
+            arr = dset._data
+
+            # Skip any dataset or array that is referenced from outside this
+            # container (the references here are `storage`, `dset`/`arr`, and
+            # the argument to `getrefcount`), as they are still in use and
+            # changes to them would be lost
+            if sys.getrefcount(dset) > 3 or sys.getrefcount(arr) > 3:
+                continue
+
+            # Only spill distributed arrays with the standard distribution, as
+            # that's the only one we can recreate without communication
+            if dset.distributed:
+                n, start, _ = mpiutil.split_local(
+                    arr.global_shape[arr.axis], comm=arr.comm
+                )
+                ax = arr.axis
+                if arr.local_shape[ax] != n or arr.local_offset[ax] != start:
+                    continue
+                info = (arr.global_shape, arr.axis, arr.comm)
+            else:
+                info = None
+
+            fd, path = tempfile.mkstemp(
+                prefix="draco_spill_", suffix=".npy", dir=directory
+            )
+            os.close(fd)
+            np.save(path, arr.view(np.ndarray))
+
+            # Ensure the file is cleaned up if the container is deleted while spilled
+            cleanup = weakref.finalize(self, os.remove, path)
+
+            self._spilled[name] = (path, cleanup, arr.dtype, info)
+            dset._data = None
+            freed += arr.nbytes
+
+        if freed:
+            logger.info(
+                "Spilled %.1f MB from %s to %s",
+                freed / 2 ** 20,
+                self.__class__.__name__,
+                directory,
+            )
+
+        return freed
+
+    def _fault(self):
+        # Read any spilled datasets back into memory
+
+        storage = self._data._get_storage()
+        nbytes = 0
+
+        for name, (path, cleanup, dtype, info) in self._spilled.items():
+
+            local = np.load(path, mmap_mode="r")
+
+            if info is not None:
+                global_shape, axis, comm = info
+                arr = mpiarray.MPIArray(global_shape, axis=axis, comm=comm, dtype=dtype)
+                arr.view(np.ndarray)[:] = local
+            else:
+                arr = np.array(local)
+
+            del local
+
+            storage[name]._data = arr
+            nbytes += arr.nbytes
+
+            # Remove the scratch file
+            cleanup()
+
+        self._spilled = {}
+
+        logger.info(
+            "Read back %.1f MB of spilled data into %s",
+            nbytes / 2 ** 20,
+            self.__class__.__name__,
+        )
+
+    def _set_lazy(self, fh, index):
+        # Read the given datasets from the open file `fh` when first accessed.
+        # `index` gives the indices of the local section along each axis.
+        self._lazy = index
+        self._lazy_file = fh
+        self._lazy_close = weakref.finalize(self, fh.close)
+
+    def _load_lazy(self, name=None):
+        # Read lazily loaded datasets, either all of them, or those with the given
+        # name or within the given group. Returns whether any were read.
+
+        if name is not None:
+            name = name.strip("/")
+            names = [n for n in self._lazy if n == name or n.startswith(name + "/")]
+        else:
+            names = list(self._lazy)
+
+        for n in names:
+            index = self._lazy.pop(n)
+            dset = self._data[n]
+            _read_selection(self._lazy_file[n], index, dset[:].view(np.ndarray))
+
+            logger.debug("Read lazily loaded dataset %s", n)
+
+        if not self._lazy:
+            self._lazy_close()
+            self._lazy_file = None
+
+        return bool(names)
+
     @property
     def dataset_spec(self):
         """Return a copy of the fully resolved dataset specifiction as a
         dictionary.
         """
+        return dict(self._schema.dataset_spec)
 
-        ddict = {}
+    @classmethod
+    def _class_schema(cls):
+        """The schema for this class, resolved from it and its base classes.
 
-        # Iterate over the reversed MRO and look for _table_spec attributes
-        # which get added to a temporary dict. We go over the reversed MRO so
-        # that the `tdict.update` overrides tables in base classes.`
-        for cls in inspect.getmro(self.__class__)[::-1]:
+        This is cached on the class, so the class level `_dataset_spec` and
+        `_axes` should not be changed once it is in use.
+        """
+        schema = cls.__dict__.get("_schema_cache", None)
 
-            try:
-                # NOTE: this is a little ugly as the following line will drop
-                # down to base classes if dataset_spec isn't present, and thus
-                # try and `update` with the same values again.
-                ddict.update(cls._dataset_spec)
-            except AttributeError:
-                pass
+        if schema is None:
+            schema = _Schema.from_class(cls)
+            cls._schema_cache = schema
 
-        # Add in any _dataset_spec found on the instance
-        ddict.update(self.__dict__.get("_dataset_spec", {}))
+        return schema
 
-        # Ensure that the dataset_spec is the same order on all ranks
-        return {k: ddict[k] for k in sorted(ddict)}
+    @property
+    def _schema(self):
+        # The schema including any `_dataset_spec` or `_axes` defined on the
+        # instance. Instance schemas are cached until either is set again.
 
-    @classmethod
-    def _class_axes(cls):
-        """Return the set of axes for this container defined by this class and the base classes."""
-        axes = set()
+        instance_dict = self.__dict__
 
-        # Iterate over the reversed MRO and look for _table_spec attributes
-        # which get added to a temporary dict. We go over the reversed MRO so
-        # that the `tdict.update` overrides tables in base classes.
-        for c in inspect.getmro(cls)[::-1]:
+        if "_dataset_spec" not in instance_dict and "_axes" not in instance_dict:
+            return self._class_schema()
 
-            try:
-                axes |= set(c._axes)
-            except AttributeError:
-                pass
+        schema = instance_dict.get("_instance_schema", None)
+
+        if schema is None:
+            schema = _Schema.from_class(
+                self.__class__,
+                instance_dict.get("_dataset_spec", None),
+                instance_dict.get("_axes", None),
+            )
+            instance_dict["_instance_schema"] = schema
+
+        return schema
 
-        # This must be the same order on all ranks, so we need to explicitly sort to get around the
-        # hash randomization
-        return tuple(sorted(axes))
+    def __setattr__(self, name, value):
+        if name in ["_dataset_spec", "_axes"]:
+            self.__dict__.pop("_instance_schema", None)
+        super(ContainerBase, self).__setattr__(name, value)
+
+    @classmethod
+    def _class_axes(cls):
+        """Return the set of axes for this container defined by this class and the base classes."""
+        return cls._class_schema().axes
 
     @property
     def axes(self):
         """The set of axes for this container including any defined on the instance."""
-        axes = set(self._class_axes())
-
-        # Add in any axes found on the instance (this is needed to support the table classes where
-        # the axes get added at run time)
-        axes |= set(self.__dict__.get("_axes", []))
-
-        # This must be the same order on all ranks, so we need to explicitly sort to get around the
-        # hash randomization
-        return tuple(sorted(axes))
+        return self._schema.axes
 
     @classmethod
     def _make_selections(cls, sel_args):
@@ -380,7 +2067,7 @@ class ContainerBase(memh5.BasicCont):
 
         return selections
 
-    def copy(self, shared=None):
+    def copy(self, shared=None, comm=None, copy_on_write=False):
         """Copy this container, optionally sharing the source datasets.
 
         This routine will create a copy of the container. By default this is
@@ -392,23 +2079,42 @@ class ContainerBase(memh5.BasicCont):
         addition and removal of attributes, redistribution etc. This
         functionality should be used with caution and clearly documented.
 
+        Alternatively datasets can be shared copy-on-write, in which case the
+        copy and the original behave as if they were fully independent, but
+        share their memory until either is written to. Only the pages written
+        to are then duplicated. See :mod:`draco.util.cow`.
+
         Parameters
         ----------
         shared : list, optional
             A list of datasets whose content will be shared with the original.
+        copy_on_write : bool or list, optional
+            Datasets to share copy-on-write, or True for all datasets that are not
+            in `shared`. Datasets holding Python objects are always copied.
+            Unless the original's data for a dataset is in use elsewhere (e.g. a
+            view of it is held by a task), it is moved into the shared memory as
+            well, so further copies of an unmodified original are free.
+        comm : MPI.Comm, optional
+            Communicator for the copy. This must contain the same processes in
+            the same order as the original's (e.g. a duplicate of it). Shared
+            datasets remain attached to the original communicator. By default
+            use the communicator of the original.
 
         Returns
         -------
         copy : subclass of ContainerBase
             The copied container.
         """
+        from ..util import encoding as enc
+
         new_cont = self.__class__(
             attrs_from=self,
             axes_from=self,
             skip_datasets=True,
             distributed=self.distributed,
-            comm=self.comm,
+            comm=self.comm if comm is None else comm,
         )
+        new_cont._pending_axis = self.pending_axis
 
         # Loop over datasets that exist in the source and either add a view of
         # the source dataset, or perform a full copy
@@ -419,7 +2125,33 @@ class ContainerBase(memh5.BasicCont):
                 # internal implementation of BasicCont and MemGroup
                 # NOTE: we don't use `.view()` on the RHS here as we want to
                 # preserve the shared data through redistributions
-                new_cont._data._get_storage()[name] = self._data._get_storage()[name]
+                new_cont._data._get_storage()[name] = data
+                new_cont._datasets_cache = None
+
+                # Mark it so neither container gives it to a buffer pool
+                _shared_datasets[id(data)] = data
+
+            elif (
+                copy_on_write is True or (copy_on_write and name in copy_on_write)
+            ) and not data.dtype.hasobject:
+                dset = new_cont.add_dataset(name)
+                dset._data = self._map_copy_on_write(name, new_cont.comm)
+                memh5.copyattrs(data.attrs, dset.attrs)
+
+            elif enc.encoding_of(data) is not None:
+                # Encoded datasets have a different type, and for packed masks
+                # shape, to the spec, so copy them as they are stored
+                kwargs = {"distributed": data.distributed}
+                if data.distributed:
+                    kwargs["distributed_axis"] = data.distributed_axis
+
+                shape = data.global_shape if data.distributed else data.shape
+                dset = new_cont.create_dataset(
+                    name, shape=shape, dtype=data.dtype, **kwargs
+                )
+                dset[:] = data[:]
+                memh5.copyattrs(data.attrs, dset.attrs)
+
             else:
                 dset = new_cont.add_dataset(name)
 
@@ -433,6 +2165,48 @@ class ContainerBase(memh5.BasicCont):
 
         return new_cont
 
+    def _map_copy_on_write(self, name, comm):
+        # Get a copy-on-write mapping of the local section of a dataset, wrapped
+        # with the same distribution onto the communicator `comm`
+
+        from ..util import cow
+
+        dset = self.datasets[name]
+        arr = dset._data
+
+        def _wrap(local, comm):
+            if isinstance(arr, mpiarray.MPIArray):
+                return mpiarray.MPIArray.wrap(local, axis=arr.axis, comm=comm)
+            return local
+
+        # Check whether anything else refers to the array, which would see any
+        # changes made to it before it is moved into shared memory (the
+        # references here are the dataset, `arr` and the argument)
+        in_use = sys.getrefcount(arr) > 3
+
+        local = arr.view(np.ndarray)
+        buffer = cow.buffer_of(local)
+
+        # Reuse the shared memory the dataset is already mapped from if it hasn't
+        # been changed since. Otherwise move the dataset into new shared memory
+        # if we can.
+        replace = False
+        if buffer is None or cow.is_modified(local):
+            buffer = cow.CowBuffer(local)
+            replace = not in_use
+
+        if isinstance(arr, mpiarray.MPIArray):
+            from mpi4py import MPI
+
+            # Wrapping is collective, so if any rank is moving its section all
+            # ranks must rewrap theirs, if only with the same memory
+            if arr.comm.allreduce(replace, op=MPI.LOR):
+                dset._data = _wrap(buffer.map() if replace else local, arr.comm)
+        elif replace:
+            dset._data = buffer.map()
+
+        return _wrap(buffer.map(), comm)
+
 
 class TableBase(ContainerBase):
     """A base class for containers holding tables of data.
@@ -669,7 +2443,7 @@ class VisContainer(ContainerBase):
     @property
     def weight(self):
         """The visibility weights."""
-        return self.datasets["vis_weight"]
+        return self._unencoded("vis_weight")
 
     @property
     def freq(self):
@@ -714,7 +2488,9 @@ class VisContainer(ContainerBase):
     @property
     def is_stacked(self):
         """Test if the data has been stacked or not."""
-        return len(self.stack) != len(self.prod)
+        from ..util import decomp
+
+        return decomp.axis_length(self, "stack") != decomp.axis_length(self, "prod")
 
 
 class Map(ContainerBase):
@@ -884,7 +2660,7 @@ class SystemSensitivity(TODContainer):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def frac_lost(self):
@@ -920,7 +2696,7 @@ class RFIMask(TODContainer):
 
     @property
     def mask(self):
-        return self.datasets["mask"]
+        return self._unencoded("mask")
 
     @property
     def freq(self):
@@ -1026,7 +2802,7 @@ class GridBeam(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def gain(self):
@@ -1095,7 +2871,7 @@ class TrackBeam(ContainerBase):
         coords="celestial",
         track_type="drift",
         *args,
-        **kwargs
+        **kwargs,
     ):
 
         if theta is not None and phi is not None:
@@ -1125,7 +2901,7 @@ class TrackBeam(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def gain(self):
@@ -1255,7 +3031,7 @@ class SVDModes(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["vis_weight"]
+        return self._unencoded("vis_weight")
 
     def __init__(self, mmax=None, *args, **kwargs):
 
@@ -1314,7 +3090,7 @@ class CommonModeGainData(TODContainer):
     @property
     def weight(self):
         try:
-            return self.datasets["weight"]
+            return self._unencoded("weight")
         except KeyError:
             return None
 
@@ -1352,7 +3128,7 @@ class CommonModeSiderealGainData(ContainerBase):
     @property
     def weight(self):
         try:
-            return self.datasets["weight"]
+            return self._unencoded("weight")
         except KeyError:
             return None
 
@@ -1394,7 +3170,7 @@ class GainData(TODContainer):
     @property
     def weight(self):
         try:
-            return self.datasets["weight"]
+            return self._unencoded("weight")
         except KeyError:
             return None
 
@@ -1436,7 +3212,7 @@ class SiderealGainData(ContainerBase):
     @property
     def weight(self):
         try:
-            return self.datasets["weight"]
+            return self._unencoded("weight")
         except KeyError:
             return None
 
@@ -1481,7 +3257,7 @@ class StaticGainData(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def freq(self):
@@ -1635,7 +3411,7 @@ class FrequencyStack(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def freq(self):
@@ -1709,7 +3485,7 @@ class FormedBeam(ContainerBase):
 
     @property
     def weight(self):
-        return self.datasets["weight"]
+        return self._unencoded("weight")
 
     @property
     def freq(self):
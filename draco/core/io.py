@@ -9,6 +9,7 @@ Tasks
     LoadFiles
     LoadMaps
     LoadFilesFromParams
+    SelectFiles
     Save
     Print
     LoadBeamTransfer
@@ -48,8 +49,9 @@ from caput import config
 from cora.util import units
 
 from . import task
-from ..util.truncate import bit_truncate_weights, bit_truncate_fixed
-from .containers import SiderealStream, TimeStream, TrackBeam
+from ..util import encoding
+from ..util.truncate import bit_truncate_array, bit_truncate_array_weights
+from .containers import SiderealStream, TimeStream, TrackBeam, RFIMask
 
 
 TRUNC_SPEC = {
@@ -58,18 +60,28 @@ TRUNC_SPEC = {
         "weight_dataset": ["vis_weight", None],
         "fixed_precision": 1e-4,
         "variance_increase": 1e-3,
+        "encode": {},
     },
     TimeStream: {
         "dataset": ["vis", "vis_weight"],
         "weight_dataset": ["vis_weight", None],
         "fixed_precision": 1e-4,
         "variance_increase": 1e-3,
+        "encode": {},
     },
     TrackBeam: {
         "dataset": ["beam", "weight"],
         "weight_dataset": ["weight", None],
         "fixed_precision": 1e-4,
         "variance_increase": 1e-3,
+        "encode": {},
+    },
+    RFIMask: {
+        "dataset": [],
+        "weight_dataset": [],
+        "fixed_precision": 1e-4,
+        "variance_increase": 1e-3,
+        "encode": {},
     },
 }
 
@@ -148,9 +160,17 @@ class LoadMaps(task.MPILoggedTask):
     ----------
     maps : list or dict
         A dictionary specifying a file group, or a list of them.
+    prefetch : bool, optional
+        Read the maps in a background thread while adding them up. Default is
+        False.
+
+    The first map in each group is loaded in full, and the local frequencies of
+    the others are then read and added to it a block at a time, so only a little
+    more than one map needs to be held in memory.
     """
 
     maps = config.Property(proptype=_list_of_filegroups)
+    prefetch = config.Property(proptype=bool, default=False)
 
     def next(self):
         """Load the groups of maps from disk and pass them on.
@@ -167,43 +187,136 @@ class LoadMaps(task.MPILoggedTask):
             raise pipeline.PipelineStopIteration
 
         group = self.maps.pop(0)
+        files = list(group["files"])
 
-        map_stack = None
+        # Load the first map to start the stack
+        self.log.debug("Loading file %s", files[0])
+        map_stack = containers.Map.from_file(files[0], distributed=True)
+        map_stack.redistribute("freq")
 
-        # Iterate over all the files in the group, load them into a Map
-        # container and add them all together
-        for mfile in group["files"]:
+        # Stream the remaining maps into the stack a block of frequencies at a time
+        blocks = self._read_blocks(files[1:], map_stack)
+        if self.prefetch:
+            blocks = _prefetch(blocks)
 
-            self.log.debug("Loading file %s", mfile)
+        local_map = map_stack.map[:].view(np.ndarray)
+        for sl, block in blocks:
+            local_map[sl] += block
 
-            current_map = containers.Map.from_file(mfile, distributed=True)
-            current_map.redistribute("freq")
+        # Assign a tag to the stack of maps
+        map_stack.attrs["tag"] = group["tag"]
 
-            # Start the stack if needed
-            if map_stack is None:
-                map_stack = current_map
+        return map_stack
 
-            # Otherwise, check that the new map has consistent frequencies,
-            # nside and pol and stack up.
-            else:
+    def _read_blocks(self, files, map_stack):
+        # Iterate over blocks of the local frequencies of each file, after checking
+        # the new map has consistent frequencies, nside and pol
+
+        from caput import memh5
+
+        dset = map_stack.map
+        start = dset.local_offset[0]
+        nfreq = dset.local_shape[0]
+
+        row_bytes = dset.dtype.itemsize * int(np.prod(dset.local_shape[1:]))
+        nblock = max(1, _MAP_BLOCK_SIZE // max(row_bytes, 1))
+
+        for mfile in files:
+
+            self.log.debug("Loading file %s", mfile)
+
+            with h5py.File(mfile, "r") as fh:
 
-                if (current_map.freq != map_stack.freq).all():
+                index_map = fh["index_map"]
+
+                if (index_map["freq"]["centre"] != map_stack.freq).all():
                     raise RuntimeError("Maps do not have consistent frequencies.")
 
-                if (current_map.index_map["pol"] != map_stack.index_map["pol"]).all():
+                pol = memh5.bytes_to_unicode(index_map["pol"][:])
+                if (pol != map_stack.index_map["pol"]).all():
                     raise RuntimeError("Maps do not have the same polarisations.")
 
-                if (
-                    current_map.index_map["pixel"] != map_stack.index_map["pixel"]
-                ).all():
+                if (index_map["pixel"][:] != map_stack.index_map["pixel"]).all():
                     raise RuntimeError("Maps do not have the same pixelisation.")
 
-                map_stack.map[:] += current_map.map[:]
+                for fi in range(0, nfreq, nblock):
+                    sl = slice(fi, min(fi + nblock, nfreq))
+                    yield sl, fh["map"][start + sl.start : start + sl.stop]
 
-        # Assign a tag to the stack of maps
-        map_stack.attrs["tag"] = group["tag"]
 
-        return map_stack
+# Size in bytes of the blocks `LoadMaps` reads at once
+_MAP_BLOCK_SIZE = 2 ** 26
+
+
+def _prefetch(iterable, depth=2):
+    """Iterate in a background thread, running up to `depth` items ahead.
+
+    Parameters
+    ----------
+    iterable : iterable
+        Items to iterate over. Any exception raised while iterating is re-raised
+        in the caller.
+    depth : int, optional
+        Maximum number of items to hold ready.
+
+    Yields
+    ------
+    item
+        The items of `iterable` in order.
+    """
+    import queue
+    import threading
+
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def _put(item):
+        # Wait for space in the queue, giving up if the consumer has stopped
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _worker():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+        except Exception as e:
+            _put((None, e))
+        else:
+            _put((done, None))
+        finally:
+            # Release anything the iterable holds (e.g. open files) from this thread
+            if hasattr(iterable, "close"):
+                iterable.close()
+
+    thread = threading.Thread(target=_worker, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            item, exc = items.get()
+
+            if exc is not None:
+                raise exc
+
+            if item is done:
+                break
+
+            yield item
+
+    finally:
+        # If the consumer stopped early or raised, stop the worker and drop any
+        # items it has already read
+        stop.set()
+        while not items.empty():
+            items.get_nowait()
+        thread.join()
 
 
 class LoadFITSCatalog(task.SingleTask):
@@ -222,11 +335,19 @@ class LoadFITSCatalog(task.SingleTask):
     freq_range : list, optional
         Select only sources with a 21cm line freq within the given range. Overrides
         `z_range`.
+    cache_dir : str, optional
+        If set, cache the positions read from each catalog file as `.npy` files in
+        this directory, and use them in place of the catalog files in later runs
+        while they are newer than the catalog.
+
+    The files in each group are divided between the ranks and read in parallel,
+    then the selected objects are gathered onto every rank.
     """
 
     catalogs = config.Property(proptype=_list_of_filegroups)
     z_range = config.list_type(type_=float, length=2, default=None)
     freq_range = config.list_type(type_=float, length=2, default=None)
+    cache_dir = config.Property(proptype=str, default=None)
 
     def process(self):
         """Load the groups of catalogs from disk, concatenate them and pass them on.
@@ -236,7 +357,9 @@ class LoadFITSCatalog(task.SingleTask):
         catalog : :class:`containers.SpectroscopicCatalog`
         """
 
-        from astropy.io import fits
+        from caput import mpiutil
+        from mpi4py import MPI
+
         from . import containers
 
         # Exit this task if we have eaten all the file groups
@@ -255,44 +378,38 @@ class LoadFITSCatalog(task.SingleTask):
             zl, zh = self.z_range
             self.log.info(f"Applying redshift selection {zl:.2f} <= z <= {zh:.2f}")
 
-        # Load the data only on rank=0 and then broadcast
-        if self.comm.rank == 0:
-            # Iterate over all the files in the group, load them into a Map
-            # container and add them all together
-            catalog_stack = []
-            for cfile in group["files"]:
-
-                self.log.debug("Loading file %s", cfile)
-
-                # TODO: read out the weights from the catalogs
-                with fits.open(cfile, mode="readonly") as cat:
-                    pos = np.array([cat[1].data[col] for col in ["RA", "DEC", "Z"]])
-
-                # Apply any redshift selection to the objects
-                if self.z_range:
-                    zsel = (pos[2] >= self.z_range[0]) & (pos[2] <= self.z_range[1])
-                    pos = pos[:, zsel]
-
-                catalog_stack.append(pos)
-
-            # NOTE: this one is tricky, for some reason the concatenate in here
-            # produces a non C contiguous array, so we need to ensure that otherwise
-            # the broadcasting will get very confused
-            catalog_array = np.concatenate(catalog_stack, axis=-1).astype(np.float64)
-            catalog_array = np.ascontiguousarray(catalog_array)
-            num_objects = catalog_array.shape[-1]
-        else:
-            num_objects = None
-            catalog_array = None
+        # Split the files across the ranks, keeping them in order, and load and
+        # select from them in parallel
+        local_files = mpiutil.partition_list_mpi(
+            list(group["files"]), method="con", comm=self.comm
+        )
+
+        catalog_stack = [np.zeros((3, 0), dtype=np.float64)]
+        for cfile in local_files:
 
-        # Broadcast the size of the catalog to all ranks, create the target array and
-        # broadcast into it
-        num_objects = self.comm.bcast(num_objects, root=0)
+            pos = self._load_positions(cfile)
+
+            # Apply any redshift selection to the objects
+            if self.z_range:
+                zsel = (pos[2] >= self.z_range[0]) & (pos[2] <= self.z_range[1])
+                pos = pos[:, zsel]
+
+            catalog_stack.append(pos)
+
+        local_array = np.concatenate(catalog_stack, axis=-1)
+
+        # Gather the selected objects from all ranks onto every rank
+        counts = self.comm.allgather(local_array.shape[-1])
+        displs = np.cumsum([0] + counts[:-1]).tolist()
+        num_objects = sum(counts)
         self.log.debug(f"Constructing catalog with {num_objects} objects.")
 
-        if self.comm.rank != 0:
-            catalog_array = np.zeros((3, num_objects), dtype=np.float64)
-        self.comm.Bcast(catalog_array, root=0)
+        catalog_array = np.zeros((3, num_objects), dtype=np.float64)
+        for ii in range(3):
+            self.comm.Allgatherv(
+                np.ascontiguousarray(local_array[ii]),
+                [catalog_array[ii], (counts, displs), MPI.DOUBLE],
+            )
 
         catalog = containers.SpectroscopicCatalog(object_id=num_objects)
         catalog["position"]["ra"] = catalog_array[0]
@@ -305,6 +422,65 @@ class LoadFITSCatalog(task.SingleTask):
 
         return catalog
 
+    def _load_positions(self, cfile):
+        # Load the RA, DEC and Z columns of a catalog file as a (3, N) array, using
+        # the cached copy if there is an up to date one
+
+        from astropy.io import fits
+
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = _cache_path(self.cache_dir, cfile, ".radecz.npy")
+
+            fresh = os.path.exists(cache_file) and (
+                os.path.getmtime(cache_file) >= os.path.getmtime(cfile)
+            )
+            if fresh:
+                self.log.debug("Loading cached positions %s", cache_file)
+                return np.load(cache_file, mmap_mode="r")
+
+        self.log.debug("Loading file %s", cfile)
+
+        # TODO: read out the weights from the catalogs
+        # FITS binary tables are stored by row, so the whole table still has to be
+        # read to extract the columns. Memory mapping only avoids holding a copy
+        # of the entire table in memory; the cache is what avoids the reads.
+        with fits.open(cfile, mode="readonly", memmap=True) as cat:
+            data = cat[1].data
+            pos = np.array([data[col] for col in ["RA", "DEC", "Z"]], dtype=np.float64)
+            del data
+
+        if cache_file is not None:
+            _save_atomic(cache_file, pos)
+
+        return pos
+
+
+def _cache_path(cache_dir, filename, suffix):
+    """Get the path of a cached product of a file.
+
+    The name includes a hash of the full path of the file, so that files with
+    the same name in different directories don't collide.
+    """
+    import hashlib
+
+    path = os.path.abspath(filename)
+    key = hashlib.md5(path.encode()).hexdigest()[:8]
+    base = os.path.basename(path)
+
+    return os.path.join(os.path.expanduser(cache_dir), f"{base}.{key}{suffix}")
+
+
+def _save_atomic(filename, arr):
+    """Save an array into a `.npy` file, so that readers never see a partial one."""
+
+    dirname = os.path.dirname(filename)
+    os.makedirs(dirname, exist_ok=True)
+
+    tmpfile = f"{filename}.{os.getpid()}.tmp.npy"
+    np.save(tmpfile, arr)
+    os.replace(tmpfile, filename)
+
 
 class LoadFilesFromParams(task.SingleTask):
     """Load data from files given in the tasks parameters.
@@ -317,8 +493,29 @@ class LoadFilesFromParams(task.SingleTask):
         Whether the file should be loaded distributed across ranks.
     convert_strings : bool, optional
         Convert strings to unicode when loading.
+    memmap : bool, optional
+        Memory map uncompressed and unchunked datasets rather than reading them.
+        See :meth:`containers.ContainerBase.from_file`. Default is False.
+    index : str, optional
+        A file index (see :class:`SelectFiles`) to look up the container type in,
+        rather than opening the file to find it.
+    lazy : bool, optional
+        Keep each file open and only read datasets when they are first accessed.
+        See :meth:`containers.ContainerBase.from_file`. This can't be combined
+        with `prefetch`. Default is False.
+    datasets : list, optional
+        Only load these datasets (or groups of datasets), e.g. `[vis, vis_weight]`.
+    exclude_datasets : list, optional
+        Don't load these datasets (or groups of datasets), e.g. `[gain, flags]`.
+        Takes precedence over `datasets`.
     selections : dict, optional
         A dictionary of axis selections. See the section below for details.
+    prefetch : int, optional
+        Number of files to read ahead in a background thread while the current
+        one is being processed downstream. If running on multiple ranks this needs
+        MPI to have been initialised with `MPI_THREAD_MULTIPLE`, otherwise the
+        files are read on demand. This needs memory for `prefetch + 1`
+        containers. Default is 0, i.e. no prefetching.
 
     Selections
     ----------
@@ -332,7 +529,10 @@ class LoadFilesFromParams(task.SingleTask):
     name>_index` keys are given the former will take precedence, but you should
     clearly avoid doing this.
 
-    Additionally index based selections currently don't work for distributed reads.
+    For distributed reads with index based selections each rank reads only the
+    parts of the file it needs for its own section of each dataset, with the
+    indices coalesced into as few strided slices as possible. This is only
+    supported for subclasses of :class:`containers.ContainerBase`.
 
     Here's an example in the YAML format that the pipeline uses:
 
@@ -348,10 +548,24 @@ class LoadFilesFromParams(task.SingleTask):
     distributed = config.Property(proptype=bool, default=True)
     convert_strings = config.Property(proptype=bool, default=True)
     selections = config.Property(proptype=dict, default=None)
+    prefetch = config.Property(proptype=int, default=0)
+    memmap = config.Property(proptype=bool, default=False)
+    index = config.Property(proptype=str, default=None)
+    lazy = config.Property(proptype=bool, default=False)
+    datasets = config.Property(proptype=list, default=None)
+    exclude_datasets = config.Property(proptype=list, default=None)
+
+    _executor = None
 
     def setup(self):
         """Resolve the selections."""
         self._sel = self._resolve_sel()
+        self._prefetched = []
+
+        if self.prefetch > 0 and self.lazy:
+            self.log.warning("Lazily loaded files can't be prefetched.")
+        elif self.prefetch > 0:
+            self._start_prefetch()
 
     def process(self):
         """Load the given files in turn and pass on.
@@ -361,45 +575,71 @@ class LoadFilesFromParams(task.SingleTask):
         cont : subclass of `memh5.BasicCont`
         """
 
-        from caput import memh5
-
         # Garbage collect to workaround leaking memory from containers.
         # TODO: find actual source of leak
         import gc
 
         gc.collect()
 
+        if self._executor is not None:
+            return self._next_prefetched()
+
         if len(self.files) == 0:
             raise pipeline.PipelineStopIteration
 
         # Fetch and remove the first item in the list
         file_ = self.files.pop(0)
 
+        return self._load_file(file_, self.comm)
+
+    def _load_file(self, file_, comm):
+        # Read a single file using the given communicator
+
+        from caput import memh5
+
+        from .containers import ContainerBase
+
         self.log.info(f"Loading file {file_}")
         self.log.debug(f"Reading with selections: {self._sel}")
 
-        # If we are applying selections we need to dispatch the `from_file` via the
-        # correct subclass, rather than relying on the internal detection of the
-        # subclass. To minimise the number of files being opened this is only done on
-        # rank=0 and is then broadcast
-        if self._sel:
-            if self.comm.rank == 0:
-                with h5py.File(file_, "r") as fh:
-                    clspath = memh5.MemDiskGroup._detect_subclass_path(fh)
+        # Options that are only supported by `ContainerBase.from_file`
+        options = {
+            "memmap": self.memmap,
+            "lazy": self.lazy,
+            "datasets": self.datasets,
+            "exclude_datasets": self.exclude_datasets,
+        }
+
+        # If we are applying selections or any of the options above we need to
+        # dispatch the `from_file` via the correct subclass, rather than relying on
+        # the internal detection of the subclass. To minimise the number of files
+        # being opened this is only done on rank=0 and is then broadcast
+        if self._sel or any(options.values()):
+            if comm.rank == 0:
+                clspath = self._lookup_clspath(file_)
             else:
                 clspath = None
-            clspath = self.comm.bcast(clspath, root=0)
+            clspath = comm.bcast(clspath, root=0)
             new_cls = memh5.MemDiskGroup._resolve_subclass(clspath)
         else:
             new_cls = memh5.BasicCont
 
+        kwargs = {}
+        if issubclass(new_cls, ContainerBase):
+            kwargs = options
+        elif any(options.values()):
+            self.log.warning(
+                f"File {file_} is not a ContainerBase subclass. Loading it in full."
+            )
+
         cont = new_cls.from_file(
             file_,
             distributed=self.distributed,
-            comm=self.comm,
+            comm=comm,
             convert_attribute_strings=self.convert_strings,
             convert_dataset_strings=self.convert_strings,
             **self._sel,
+            **kwargs,
         )
 
         if "tag" not in cont.attrs:
@@ -410,6 +650,77 @@ class LoadFilesFromParams(task.SingleTask):
 
         return cont
 
+    def _lookup_clspath(self, file_):
+        # Get the container type of a file, from the index if possible
+
+        from caput import memh5
+
+        from ..util.fileindex import FileIndex
+
+        if self.index is not None:
+            with FileIndex(self.index) as index:
+                record = index.get(file_)
+            if record is not None:
+                return record["clspath"]
+
+        with h5py.File(file_, "r") as fh:
+            return memh5.MemDiskGroup._detect_subclass_path(fh)
+
+    def _start_prefetch(self):
+        # Set up the thread for reading ahead
+        from mpi4py import MPI
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self.comm.size > 1 and MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+            self.log.warning(
+                "MPI does not support multiple threads. Files will not be prefetched."
+            )
+            return
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _submit_reads(self, n):
+        # Queue up reads until there are `n` files in flight. Each read gets its
+        # own duplicate of the communicator so its collective operations can't
+        # interleave with those of the downstream tasks
+
+        while len(self._prefetched) < n and len(self.files) > 0:
+            file_ = self.files.pop(0)
+            comm = self.comm.Dup() if self.comm.size > 1 else self.comm
+            future = self._executor.submit(self._load_file, file_, comm)
+            self._prefetched.append((future, comm))
+
+    def _next_prefetched(self):
+        # Return the next file from the read ahead queue, and start reading the
+        # following ones while it is processed
+
+        from .containers import rebind_comm
+
+        self._submit_reads(1)
+
+        if len(self._prefetched) == 0:
+            self._executor.shutdown()
+            self._executor = None
+            raise pipeline.PipelineStopIteration
+
+        future, comm = self._prefetched.pop(0)
+        try:
+            cont = future.result()
+        except Exception:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+            raise
+
+        self._submit_reads(self.prefetch)
+
+        # Move the container back onto our communicator in place, so the read's
+        # duplicate can be freed
+        if comm is not self.comm:
+            rebind_comm(cont, self.comm)
+            comm.Free()
+
+        return cont
+
     def _resolve_sel(self):
         # Turn the selection parameters into actual selectable types
 
@@ -485,6 +796,74 @@ class FindFiles(pipeline.TaskBase):
         return self.files
 
 
+class SelectFiles(task.MPILoggedTask):
+    """Select files using an index of their metadata, and pass the list on.
+
+    Any of the candidate files that are new or have changed since they were last
+    indexed are added to the index first, so only those files are opened. The
+    output can be given to tasks like :class:`LoadFiles`.
+
+    Attributes
+    ----------
+    files : list or glob
+        The candidate files.
+    index : str
+        Path to the index database. Created if it doesn't exist.
+    container : str, optional
+        Only select files of this container type, given as the full class path,
+        e.g. `draco.core.containers.SiderealStream`.
+    lsd_range : list, optional
+        Select files with an `lsd` attribute within this range.
+    time_range : list, optional
+        Select files with times (UNIX) overlapping this range.
+    ra_range : list, optional
+        Select files with RAs overlapping this range.
+    freq_range : list, optional
+        Select files with any frequencies within this range.
+    """
+
+    files = config.Property(proptype=_list_or_glob)
+    index = config.Property(proptype=str)
+    container = config.Property(proptype=str, default=None)
+    lsd_range = config.list_type(type_=float, length=2, default=None)
+    time_range = config.list_type(type_=float, length=2, default=None)
+    ra_range = config.list_type(type_=float, length=2, default=None)
+    freq_range = config.list_type(type_=float, length=2, default=None)
+
+    def setup(self):
+        """Update the index and select the files.
+
+        Returns
+        -------
+        files : list
+            The selected files.
+        """
+
+        from ..util.fileindex import FileIndex
+
+        # Only access the index on one rank
+        if self.comm.rank == 0:
+            with FileIndex(self.index) as index:
+                nindexed = index.update(self.files)
+                self.log.debug(f"Indexed {nindexed} new or modified files.")
+
+                selected = index.select(
+                    self.files,
+                    clspath=self.container,
+                    lsd_range=self.lsd_range,
+                    time_range=self.time_range,
+                    ra_range=self.ra_range,
+                    freq_range=self.freq_range,
+                )
+        else:
+            selected = None
+
+        selected = self.comm.bcast(selected, root=0)
+        self.log.info(f"Selected {len(selected)} of {len(self.files)} files.")
+
+        return selected
+
+
 class LoadFiles(LoadFilesFromParams):
     """Load data from files passed into the setup routine.
 
@@ -653,17 +1032,26 @@ class Truncate(task.SingleTask):
     dataset : list of str
         Datasets to truncate.
     weight_dataset : list of str
-        Datasets to use as inverse variance for truncation precision.
+        Datasets to use as inverse variance for truncation precision. These must
+        broadcast against the dataset they are used for.
     fixed_precision : float
         Relative precision to truncate to (default 1e-4).
     variance_increase : float
         Maximum fractional increase in variance from numerical truncation.
+    encode : dict
+        Datasets to store in a compact encoding after truncation, as a mapping
+        from the dataset name to the encoding (see
+        :meth:`containers.ContainerBase.encode_dataset`), e.g. `{vis_weight: log16}`
+        or `{mask: bitpack}` for an `RFIMask`. No datasets are encoded by default.
+        Datasets that are already encoded are not truncated, and encoded weight
+        datasets are decoded to set the truncation precision.
     """
 
     dataset = config.Property(proptype=list, default=None)
     weight_dataset = config.Property(proptype=list, default=None)
     fixed_precision = config.Property(proptype=float, default=None)
     variance_increase = config.Property(proptype=float, default=None)
+    encode = config.Property(proptype=dict, default=None)
 
     def _get_params(self, container):
         """Load truncation parameters from config or container defaults."""
@@ -674,6 +1062,7 @@ class Truncate(task.SingleTask):
                 "weight_dataset",
                 "fixed_precision",
                 "variance_increase",
+                "encode",
             ]:
                 attr = getattr(self, key)
                 if attr is None:
@@ -717,43 +1106,39 @@ class Truncate(task.SingleTask):
             self.weight_dataset = [None] * len(self.dataset)
 
         for dset, wgt in zip(self.dataset, self.weight_dataset):
-            old_shape = data[dset].local_shape
-            val = np.ndarray.reshape(data[dset][:], data[dset][:].size)
+
+            # The encodings are already lossy, so don't truncate on top of them
+            if encoding.encoding_of(data[dset]) is not None:
+                self.log.debug(f"Dataset {dset} is encoded. Skipping truncation.")
+                continue
+
+            # Truncate the local sections in place
+            val = data[dset][:].view(np.ndarray)
+
             if wgt is None:
-                if np.iscomplexobj(data[dset]):
-                    data[dset][:].real = bit_truncate_fixed(
-                        val.real, self.fixed_precision
-                    ).reshape(old_shape)
-                    data[dset][:].imag = bit_truncate_fixed(
-                        val.imag, self.fixed_precision
-                    ).reshape(old_shape)
-                else:
-                    data[dset][:] = bit_truncate_fixed(
-                        val, self.fixed_precision
-                    ).reshape(old_shape)
-            else:
-                if data[dset][:].shape != data[wgt][:].shape:
-                    raise pipeline.PipelineRuntimeError(
-                        "Dataset and weight arrays must have same shape ({} != {})".format(
-                            data[dset].shape, data[wgt].shape
-                        )
-                    )
-                invvar = np.ndarray.reshape(data[wgt][:], data[dset][:].size)
-                if np.iscomplexobj(data[dset]):
-                    data[dset][:].real = bit_truncate_weights(
-                        val.real,
-                        invvar * 2.0 / self.variance_increase,
-                        self.fixed_precision,
-                    ).reshape(old_shape)
-                    data[dset][:].imag = bit_truncate_weights(
-                        val.imag,
-                        invvar * 2.0 / self.variance_increase,
-                        self.fixed_precision,
-                    ).reshape(old_shape)
-                else:
-                    data[dset][:] = bit_truncate_weights(
-                        val, invvar / self.variance_increase, self.fixed_precision
-                    ).reshape(old_shape)
+                bit_truncate_array(val, self.fixed_precision)
+                continue
+
+            invvar = encoding.decode(data[wgt])
+
+            # The weights only need to broadcast against the data
+            try:
+                np.broadcast_to(invvar, val.shape)
+            except ValueError as e:
+                raise pipeline.PipelineRuntimeError(
+                    "Weight array shape can not be broadcast to the dataset shape "
+                    "({} vs {})".format(data[wgt].shape, data[dset].shape)
+                ) from e
+
+            # The variance is split between the real and imaginary parts
+            scale = (2.0 if np.iscomplexobj(val) else 1.0) / self.variance_increase
+            bit_truncate_array_weights(val, invvar, scale, self.fixed_precision)
+
+        # Store any requested datasets compactly
+        for dset, enc in (self.encode or {}).items():
+            if encoding.encoding_of(data[dset]) is None:
+                self.log.debug(f"Encoding dataset {dset} as {enc}.")
+                data.encode_dataset(dset, enc)
 
         return data
 
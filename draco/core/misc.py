@@ -11,7 +11,7 @@ import numpy as np
 from caput import config, mpiutil
 
 from ..core import task, containers
-from ..util import tools
+from ..util import decomp, tools
 
 
 class ApplyGain(task.SingleTask):
@@ -49,6 +49,10 @@ class ApplyGain(task.SingleTask):
         tstream : TimeStream or SiderealStream
             The timestream with the gains applied.
         """
+        # If the data has been split over a process grid, split the gains the same
+        # way so the local sections line up
+        gain = decomp.like(gain, tstream)
+
         tstream.redistribute("freq")
         gain.redistribute("freq")
 
@@ -147,10 +151,21 @@ class ApplyGain(task.SingleTask):
         # Apply gains to visibility matrix
         self.log.info("Applying inverse gain." if self.inverse else "Applying gain.")
         gvis = inverse_gain_arr if self.inverse else gain_arr
+
+        # The products held, which are only a subset if the data has been split
+        # over the stacks or products
+        prod_map = tstream.prod
+        if decomp.axis_of(tstream) == "stack":
+            start = decomp.offset(tstream, "stack")
+            prod_map = prod_map[start : start + len(tstream.stack)]
+
+        # Otherwise the products are assumed to be all pairs of inputs
+        input_prod_map = prod_map if decomp.is_decomposed(tstream) else None
+
         if isinstance(gain, containers.SiderealGainData):
             # Need a prod_map for sidereal streams
             tools.apply_gain(
-                tstream.vis[:], gvis, out=tstream.vis[:], prod_map=tstream.prod
+                tstream.vis[:], gvis, out=tstream.vis[:], prod_map=prod_map
             )
         elif isinstance(
             gain, (containers.CommonModeGainData, containers.CommonModeSiderealGainData)
@@ -158,7 +173,9 @@ class ApplyGain(task.SingleTask):
             # Apply the gains to all 'prods/stacks' directly:
             tstream.vis[:] *= np.abs(gvis[:, np.newaxis, :]) ** 2
         else:
-            tools.apply_gain(tstream.vis[:], gvis, out=tstream.vis[:])
+            tools.apply_gain(
+                tstream.vis[:], gvis, out=tstream.vis[:], prod_map=input_prod_map
+            )
 
         # Apply gains to the weights
         if self.update_weight:
@@ -173,7 +190,7 @@ class ApplyGain(task.SingleTask):
         if isinstance(gain, containers.SiderealGainData):
             # Need a prod_map for sidereal streams
             tools.apply_gain(
-                tstream.weight[:], gweight, out=tstream.weight[:], prod_map=tstream.prod
+                tstream.weight[:], gweight, out=tstream.weight[:], prod_map=prod_map
             )
         elif isinstance(
             gain, (containers.CommonModeGainData, containers.CommonModeSiderealGainData)
@@ -181,7 +198,12 @@ class ApplyGain(task.SingleTask):
             # Apply the gains to all 'prods/stacks' directly:
             tstream.weight[:] *= gweight[:, np.newaxis, :] ** 2
         else:
-            tools.apply_gain(tstream.weight[:], gweight, out=tstream.weight[:])
+            tools.apply_gain(
+                tstream.weight[:],
+                gweight,
+                out=tstream.weight[:],
+                prod_map=input_prod_map,
+            )
 
         # Update units if they were specified
         convert_units_to = gain.gain.attrs.get("convert_units_to")
@@ -227,3 +249,63 @@ class WaitUntil(task.MPILoggedTask):
     def next(self, input_):
         """Immediately forward any input."""
         return input_
+
+
+class SplitOverGrid(task.SingleTask):
+    """Split a container over a two dimensional grid of processes.
+
+    The ranks are split into `ngroup` groups, and each takes a range of `axis`
+    and distributes its part of the container over `freq` amongst its own ranks.
+    This allows more ranks to work on the data than there are frequencies. See
+    :mod:`draco.util.decomp`.
+
+    Tasks receiving the split containers must support them, and the container
+    must be recombined with :class:`CombineOverGrid` before saving it.
+
+    Attributes
+    ----------
+    axis : str
+        The axis to split over the groups, e.g. `stack` or `ra`. Default is
+        `stack`.
+    ngroup : int
+        The number of groups. This must divide the number of ranks.
+    """
+
+    axis = config.Property(proptype=str, default="stack")
+    ngroup = config.Property(proptype=int, default=1)
+
+    def process(self, cont):
+        """Split up the container.
+
+        Parameters
+        ----------
+        cont : containers.ContainerBase
+            The container to split.
+
+        Returns
+        -------
+        sub : containers.ContainerBase
+            The part of the container held by this rank's group.
+        """
+        grid = decomp.process_grid(self.ngroup, self.comm)
+
+        return grid.scatter(cont, self.axis)
+
+
+class CombineOverGrid(task.SingleTask):
+    """Recombine a container that was split with :class:`SplitOverGrid`."""
+
+    def process(self, sub):
+        """Combine the parts of the container.
+
+        Parameters
+        ----------
+        sub : containers.ContainerBase
+            The part of the container held by this rank's group.
+
+        Returns
+        -------
+        cont : containers.ContainerBase
+            The full container.
+        """
+        return decomp.grid_of(sub, self.comm).gather(sub)
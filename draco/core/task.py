@@ -13,7 +13,12 @@ Tasks
 """
 
 import os
+import json
+import time
 import logging
+import itertools
+import contextlib
+import collections
 
 import numpy as np
 
@@ -138,6 +143,175 @@ class SetMPILogging(pipeline.TaskBase):
         ch.setFormatter(formatter)
 
 
+# The barrier policy used by tasks that don't set their own. Changed with the
+# `SetBarrierPolicy` task.
+_default_barrier_policy = "always"
+
+
+def _barrier_policy(x):
+    """Interpret the input as a barrier policy.
+
+    Parameters
+    ----------
+    x : str
+        One of 'always', 'never' or 'redistribute'.
+
+    Returns
+    -------
+    policy : str
+    """
+
+    if x is None or x in ("always", "never", "redistribute"):
+        return x
+    else:
+        raise ValueError("Barrier policy %s not understood" % repr(x))
+
+
+class SetBarrierPolicy(pipeline.TaskBase):
+    """A task used to set the default barrier policy for the pipeline.
+
+    This changes the policy for all :class:`SingleTask` instances that don't set
+    their own `barrier` property. It must come before the tasks it should apply
+    to.
+
+    Attributes
+    ----------
+    policy : str
+        One of 'always', 'never' or 'redistribute'. See
+        :attr:`SingleTask.barrier` for details.
+    """
+
+    policy = config.Property(proptype=_barrier_policy, default="always")
+
+    def __init__(self):
+
+        global _default_barrier_policy
+        _default_barrier_policy = self.policy
+
+
+class SetMemoryBudget(pipeline.TaskBase):
+    """A task used to limit the memory used by containers on each rank.
+
+    Containers created after this task is set up are tracked, and if the total
+    size of their local data exceeds the budget the least recently used ones are
+    spilled into scratch files and transparently read back when next accessed.
+    It must come before the tasks it should apply to.
+
+    Attributes
+    ----------
+    budget : float
+        Memory budget per rank in GB.
+    scratch_dir : str, optional
+        Directory to spill data into. This should ideally be on fast node-local
+        storage. If not set use the system temporary directory.
+    """
+
+    budget = config.Property(proptype=float)
+    scratch_dir = config.Property(proptype=str, default=None)
+
+    def __init__(self):
+
+        from . import containers
+
+        containers.set_memory_budget(int(self.budget * 2 ** 30), self.scratch_dir)
+
+
+class SetRedistributeBlockSize(pipeline.TaskBase):
+    """A task used to make containers redistribute in blocks.
+
+    Each redistribution of a dataset is done as a sequence of exchanges of
+    blocks of roughly this size, which lowers the temporary memory needed on
+    each rank. It must come before the tasks it should apply to.
+
+    Attributes
+    ----------
+    block_size : float
+        Block size per rank in MB. If zero, redistribute whole datasets at once.
+    """
+
+    block_size = config.Property(proptype=float, default=64.0)
+
+    def __init__(self):
+
+        from . import containers
+
+        block_size = int(self.block_size * 2 ** 20)
+        containers.set_redistribute_block_size(block_size if block_size else None)
+
+
+def _redistributed_nbytes():
+    # The data moved by redistributions on this rank so far
+    from . import containers
+
+    return containers.redistributed_nbytes()
+
+
+def _on_comm(cont, comm):
+    """Test whether a container is held in memory on a given communicator.
+
+    Parameters
+    ----------
+    cont : object
+        The container. Anything that isn't a `memh5.BasicCont` held in memory is
+        never on the communicator.
+    comm : MPI.Comm or None
+        The communicator.
+
+    Returns
+    -------
+    on_comm : bool
+    """
+    from mpi4py import MPI
+
+    if (
+        comm is None
+        or not isinstance(cont, memh5.BasicCont)
+        or not isinstance(cont._data, memh5.MemGroup)
+        or cont.comm is None
+    ):
+        return False
+
+    return MPI.Comm.Compare(cont.comm, comm) == MPI.IDENT
+
+
+def _needs_redistribute(cont, axis):
+    """Test whether redistributing a container would move any data.
+
+    Parameters
+    ----------
+    cont : object
+        The container. Anything that isn't a distributed `memh5.BasicCont` is
+        never redistributed.
+    axis : str or list of str
+        Axis to redistribute to. If a list, the first axis in each dataset
+        that's present is used, in the same way as `BasicCont.redistribute`.
+
+    Returns
+    -------
+    redistribute : bool
+    """
+
+    if not isinstance(cont, memh5.BasicCont) or not cont.distributed:
+        return False
+
+    axis = [axis] if isinstance(axis, str) else axis
+
+    for dset in cont.datasets.values():
+
+        if not dset.distributed or "axis" not in dset.attrs:
+            continue
+
+        dset_axes = list(dset.attrs["axis"])
+
+        for ax in axis:
+            if ax in dset_axes:
+                if dset_axes.index(ax) != dset.distributed_axis:
+                    return True
+                break
+
+    return False
+
+
 class LoggedTask(pipeline.TaskBase):
     """A task with logger support."""
 
@@ -213,6 +387,278 @@ class MPILoggedTask(MPITask, LoggedTask):
         self._log = logadapter
 
 
+def _peak_rss():
+    # Return the peak resident set size of this process in bytes
+    import sys
+    import resource
+
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports in kilobytes, macOS in bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class _CallTrace:
+    """Timing and memory statistics for a single `process` type call of a task.
+
+    Parameters
+    ----------
+    name : str
+        The name of the call being traced, e.g. `process` or `process_finish`.
+    count : int
+        The iteration count of the task at the time of the call.
+    """
+
+    def __init__(self, name, count):
+
+        self.name = name
+        self.count = count
+        self.phases = {}
+
+        self._start = time.time()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._rss = _peak_rss()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time a named phase within the call."""
+        start = time.time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (start, time.perf_counter() - t0)
+
+    def stop(self):
+        """Finish the trace and return the statistics as a dictionary."""
+        return {
+            "name": self.name,
+            "count": self.count,
+            "start": self._start,
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "rss_delta": _peak_rss() - self._rss,
+            "phases": self.phases,
+        }
+
+
+# Traces gathered in this process keyed by output file. This allows all tasks in a
+# pipeline run to write into a single timeline file.
+_trace_events = {}
+_trace_summaries = {}
+
+# The number of tasks of each type tracing into each output file
+_trace_counts = {}
+
+
+def _trace_path(trace_file):
+    # The path a trace is written to
+    return os.path.expandvars(os.path.expanduser(trace_file))
+
+
+def _trace_task_name(path, cls_name):
+    """Get a unique name for a task in a trace file.
+
+    The first task of each type is named after its class. Any later ones, in the
+    order the pipeline creates them, get their position among them appended, e.g.
+    `Foo[1]`, so that their traces don't overwrite each other.
+
+    Parameters
+    ----------
+    path : str
+        The trace file.
+    cls_name : str
+        Name of the task's class.
+
+    Returns
+    -------
+    name : str
+    """
+    counts = _trace_counts.setdefault(path, collections.Counter())
+    n = counts[cls_name]
+    counts[cls_name] += 1
+
+    return cls_name if n == 0 else "%s[%i]" % (cls_name, n)
+
+
+def _write_trace(path, task_name, rank_traces):
+    """Write out the traces of a task into a Chrome trace format file.
+
+    Parameters
+    ----------
+    path : str
+        File to write into. Events from earlier tasks written to the same file in
+        this process are retained.
+    task_name : str
+        Name of the task the traces belong to. This must be unique within the file
+        (see `_trace_task_name`).
+    rank_traces : list of lists
+        The call statistics (as returned by `_CallTrace.stop`) for each rank.
+    """
+
+    def _us(t):
+        # Timestamps are absolute in microseconds, viewers display them relative to
+        # the earliest event
+        return int(t * 1e6)
+
+    events = _trace_events.setdefault(path, [])
+
+    for rank, traces in enumerate(rank_traces):
+        for tr in traces:
+            args = {
+                "count": tr["count"],
+                "cpu": tr["cpu"],
+                "rss_delta": tr["rss_delta"],
+            }
+            args.update({k + "_time": v[1] for k, v in tr["phases"].items()})
+
+            events.append(
+                {
+                    "name": "%s.%s" % (task_name, tr["name"]),
+                    "cat": "task",
+                    "ph": "X",
+                    "ts": _us(tr["start"]),
+                    "dur": int(tr["wall"] * 1e6),
+                    "pid": rank,
+                    "tid": task_name,
+                    "args": args,
+                }
+            )
+
+            for phase, (start, dur) in tr["phases"].items():
+                events.append(
+                    {
+                        "name": phase,
+                        "cat": "phase",
+                        "ph": "X",
+                        "ts": _us(start),
+                        "dur": int(dur * 1e6),
+                        "pid": rank,
+                        "tid": task_name,
+                    }
+                )
+
+    # Aggregate each call across ranks. All ranks should have made the same
+    # sequence of calls, but don't assume it. Calls that only some ranks made
+    # are aggregated over those ranks, and `nranks` says how many there were.
+    summary = []
+    for calls in itertools.zip_longest(*rank_traces):
+        calls = [tr for tr in calls if tr is not None]
+
+        def _stats(values):
+            return {
+                "min": min(values),
+                "mean": sum(values) / len(values),
+                "max": max(values),
+            }
+
+        stats = {
+            "name": calls[0]["name"],
+            "count": calls[0]["count"],
+            "nranks": len(calls),
+            "wall": _stats([tr["wall"] for tr in calls]),
+            "cpu": _stats([tr["cpu"] for tr in calls]),
+            "rss_delta": _stats([tr["rss_delta"] for tr in calls]),
+        }
+        for phase in calls[0]["phases"]:
+            times = [tr["phases"].get(phase, (0, 0.0))[1] for tr in calls]
+            stats[phase] = _stats(times)
+
+        summary.append(stats)
+
+    _trace_summaries.setdefault(path, {})[task_name] = summary
+
+    with open(path, "w") as fh:
+        json.dump(
+            {
+                "traceEvents": events,
+                "displayTimeUnit": "ms",
+                "otherData": {"summary": _trace_summaries[path]},
+            },
+            fh,
+        )
+
+
+class _AsyncWriter:
+    """Write outputs in a background thread.
+
+    Parameters
+    ----------
+    write : callable
+        Called with the arguments given to `submit` in the background thread to
+        actually write the output.
+    queue_size : int
+        Maximum number of outputs waiting to be written. Submitting an output
+        when the queue is full blocks until one has been written.
+    """
+
+    def __init__(self, write, queue_size):
+
+        import queue
+        import threading
+
+        self._write = write
+        self._error = None
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+
+        # Use a daemon thread so that a crashing pipeline doesn't hang on exit
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        # Write outputs until we receive the `None` sentinel
+
+        while True:
+            item = self._queue.get()
+
+            if item is None:
+                return
+
+            # Once a write has failed, skip the rest so the error is not buried
+            if self._error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self._error = e
+
+    def _check_error(self):
+        # Re-raise any error from the writer thread in the calling thread
+        if self._error is not None:
+            raise RuntimeError("Background write failed.") from self._error
+
+    def submit(self, *args):
+        """Queue an output to be written, blocking if the queue is full."""
+        self._check_error()
+        self._queue.put(args)
+
+    def close(self):
+        """Wait for all queued outputs to be written and stop the thread."""
+        self._queue.put(None)
+        self._thread.join()
+        self._check_error()
+
+
+class _PendingOutput:
+    """The output of a task running concurrently in its own thread.
+
+    This is passed on in place of the real output. :class:`SingleTask` resolves
+    these in its inputs before calling `process`.
+
+    Parameters
+    ----------
+    future : concurrent.futures.Future
+        The future for the call to `next`.
+    """
+
+    def __init__(self, future):
+        self._future = future
+
+    def result(self):
+        """Wait for the task to finish and return its output."""
+        return self._future.result()
+
+
 class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
     """Process a task with at most one input and output.
 
@@ -253,6 +699,9 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
         Deprecated in favour of `output_name`.
     nan_check : bool
         Check the output for NaNs (and infs) logging if they are present.
+    nan_check_sample : int
+        Only check every Nth block of each dataset for NaNs. The blocks checked
+        are rotated on each iteration. Default is 1, i.e. check everything.
     nan_dump : bool
         If NaN's are found, dump the container to disk.
     nan_skip : bool
@@ -262,6 +711,70 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
         attached to output metadata.
     pipeline_config : dict
         Global pipeline configuration. This is attached to output metadata.
+    async_save : bool
+        Write the output in a background thread, so the pipeline can continue
+        while the output is written. Outputs are flushed when the task finishes.
+        This needs MPI to have been initialised with `MPI_THREAD_MULTIPLE`,
+        otherwise the output is written synchronously.
+    async_copy : bool
+        Snapshot the output before handing it to the background writer. Only
+        turn this off if the output will not be modified after this task
+        returns it. A snapshot is always taken when running on more than one
+        rank, as the writer needs its own communicator. Default is True.
+    async_queue_size : int
+        Maximum number of outputs waiting to be written. When the queue is full
+        the task blocks until an output has been written. This limits the memory
+        used by snapshots. Default is 1.
+    cache : bool
+        Reuse outputs saved by a previous run. Before calling `process` a key is
+        computed from the task class, its config properties, and the tags and
+        contents of the inputs. If the file the output would be saved to already
+        exists and was saved with the same key, it is loaded and passed on
+        instead of calling `process`. Requires `save`. This should only be used
+        for tasks without internal state carried between iterations, and with
+        the output tag derived from the input (the default).
+    barrier : str
+        When to synchronise all ranks with a barrier before calling `process`.
+        One of 'always', 'never' or 'redistribute'. The last only uses a barrier
+        if an input will need to be redistributed to the axis the task works on
+        (see `_input_distributed_axis`), or if the task doesn't declare one. By
+        default use the pipeline-wide policy set by :class:`SetBarrierPolicy`,
+        which is 'always' unless changed. The total time spent waiting is
+        logged at the end of the task.
+    concurrent : bool
+        Run `process` in a separate thread so that tasks on independent branches
+        of the pipeline run at the same time. A placeholder is passed on
+        immediately, and is resolved by the :class:`SingleTask` instances that
+        consume it, so all consumers of a concurrent task must be
+        :class:`SingleTask` subclasses. The task uses a duplicated communicator
+        for its collective operations, and its container inputs are moved onto it
+        for the duration of each iteration. Its outputs are moved back onto the
+        original communicator once ready. The next iteration waits for the
+        previous one to finish. Only tasks with inputs can run concurrently.
+        Needs MPI to have been initialised with `MPI_THREAD_MULTIPLE` if run on
+        multiple ranks, otherwise the task runs normally.
+    concurrent_copy : bool
+        Give a concurrent task private copies of its container inputs, rather
+        than using them in place. This is needed if the inputs are used by any
+        other task while this one runs (e.g. the output of a task consumed by
+        several tasks), but doubles the memory used by the inputs. Default is
+        False.
+    trace : bool
+        Record the wall time, CPU time, peak RSS increase, and the time spent in
+        the initial barrier, NaN checking and saving for every call to `process`
+        and `process_finish`. The statistics are gathered across ranks and
+        written into a Chrome trace format (JSON) file when the task finishes.
+    trace_file : string
+        File to write the trace into. Tasks sharing the same file within a run are
+        written into a single timeline. Default is `draco_trace.json`.
+    reuse_buffers : bool
+        Reuse the memory of outputs that have been deleted downstream for new
+        outputs, rather than allocating fresh memory each iteration. This only
+        applies to tasks that create their outputs with :attr:`buffer_pool`.
+        Default is False.
+    buffer_pool_size : float
+        Maximum size in GB (per rank) of the unused memory held for reuse.
+        Default is 4 GB.
 
     Methods
     -------
@@ -281,6 +794,7 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
     output_name = config.Property(default="{output_root}{tag}.h5", proptype=str)
 
     nan_check = config.Property(default=True, proptype=bool)
+    nan_check_sample = config.Property(default=1, proptype=int)
     nan_skip = config.Property(default=True, proptype=bool)
     nan_dump = config.Property(default=True, proptype=bool)
 
@@ -288,7 +802,66 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
     versions = config.Property(default={}, proptype=dict)
     pipeline_config = config.Property(default={}, proptype=dict)
 
+    async_save = config.Property(default=False, proptype=bool)
+    async_copy = config.Property(default=True, proptype=bool)
+    async_queue_size = config.Property(default=1, proptype=int)
+
+    cache = config.Property(default=False, proptype=bool)
+
+    barrier = config.Property(default=None, proptype=_barrier_policy)
+
+    concurrent = config.Property(default=False, proptype=bool)
+    concurrent_copy = config.Property(default=False, proptype=bool)
+
+    trace = config.Property(default=False, proptype=bool)
+    trace_file = config.Property(default="draco_trace.json", proptype=str)
+
+    reuse_buffers = config.Property(default=False, proptype=bool)
+    buffer_pool_size = config.Property(default=4.0, proptype=float)
+
     _count = 0
+    _traces = None
+    _current_trace = None
+    _trace_name = None
+    _writer = None
+    _barrier_time = 0.0
+    _executor = None
+    _pending = None
+    _stopped = False
+    _base_comm = None
+    _buffer_pool = None
+    _redistributed_nbytes = 0
+
+    # The axis (or list of candidate axes) that `process` redistributes its inputs
+    # to. Subclasses should set this to allow the barrier to be skipped when the
+    # input is already distributed correctly, and so that inputs with a deferred
+    # redistribution are sent straight to it.
+    _input_distributed_axis = None
+
+    # Properties that do not change the output and so aren't part of the cache key
+    _cache_ignore = {
+        "save",
+        "output_root",
+        "output_name",
+        "nan_check",
+        "nan_check_sample",
+        "nan_skip",
+        "nan_dump",
+        "versions",
+        "pipeline_config",
+        "async_save",
+        "async_copy",
+        "async_queue_size",
+        "cache",
+        "barrier",
+        "concurrent",
+        "concurrent_copy",
+        "trace",
+        "trace_file",
+        "reuse_buffers",
+        "buffer_pool_size",
+        "log_level",
+    }
 
     done = False
     _no_input = False
@@ -314,45 +887,122 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
         else:
             self._no_input = False
 
+        if self.cache and not self.save:
+            raise pipeline.PipelineConfigError(
+                "Caching outputs requires them to be saved (`save: true`)."
+            )
+
+        if self.concurrent:
+            self._start_concurrent()
+
+        # Name the task in the trace by the order the pipeline creates the tasks in,
+        # so that several of the same type can be told apart
+        if self.trace:
+            self._trace_name = _trace_task_name(
+                _trace_path(self.trace_file), self.__class__.__name__
+            )
+
+    @property
+    def buffer_pool(self):
+        """A pool of memory to create output containers with.
+
+        Pass this as the `pool` argument when creating an output container, so
+        that its memory is reused once downstream tasks have deleted it (see
+        :class:`containers.BufferPool`). This is `None` unless `reuse_buffers`
+        is set.
+        """
+        if not self.reuse_buffers:
+            return None
+
+        if self._buffer_pool is None:
+            from . import containers
+
+            self._buffer_pool = containers.BufferPool(
+                limit=int(self.buffer_pool_size * 2 ** 30)
+            )
+
+        return self._buffer_pool
+
     def next(self, *input):
         """Should not need to override. Implement `process` instead."""
 
+        if self.concurrent:
+            return self._submit_next(input)
+
+        # Wait for the outputs of any concurrent tasks
+        input = [x.result() if isinstance(x, _PendingOutput) else x for x in input]
+
+        # A concurrent task upstream produced no output, so there is nothing to do
+        if any(x is None for x in input):
+            return None
+
+        return self._next(*input)
+
+    def _next(self, *input):
+        # The actual implementation of `next`
+
         self.log.info("Starting next for task %s" % self.__class__.__name__)
 
-        self.comm.Barrier()
+        with self._trace_call("process"):
 
-        # This should only be called once.
-        try:
-            if self.done:
-                raise pipeline.PipelineStopIteration()
-        except AttributeError:
-            self.done = True
+            with self._trace_phase("barrier"):
+                self._barrier(input)
 
-        # Process input and fetch ouput
-        if self._no_input:
-            if len(input) > 0:
-                # This should never happen.  Just here to catch bugs.
-                raise RuntimeError("Somehow `input` was set.")
-            output = self.process()
-        else:
-            output = self.process(*input)
+            nbytes_start = _redistributed_nbytes()
 
-        # Return immediately if output is None to skip writing phase.
-        if output is None:
-            return
+            with self._trace_phase("redistribute"):
+                self._resolve_distribution(input)
 
-        # Set a tag in output if needed
-        if "tag" not in output.attrs and len(input) > 0 and "tag" in input[0].attrs:
-            output.attrs["tag"] = input[0].attrs["tag"]
+            # This should only be called once.
+            try:
+                if self.done:
+                    raise pipeline.PipelineStopIteration()
+            except AttributeError:
+                self.done = True
 
-        # Check for NaN's etc
-        output = self._nan_process_output(output)
+            # Pass on a previously saved output if we have one
+            cache_key = None
+            if self.cache and not self._no_input:
+                cache_key = self._cache_key(input)
+                output = self._load_cached_output(cache_key, input)
 
-        # Write the output if needed
-        self._save_output(output)
+                if output is not None:
+                    self._count = self._count + 1
+                    return output
 
-        # Increment internal counter
-        self._count = self._count + 1
+            # Process input and fetch ouput
+            if self._no_input:
+                if len(input) > 0:
+                    # This should never happen.  Just here to catch bugs.
+                    raise RuntimeError("Somehow `input` was set.")
+                output = self.process()
+            else:
+                output = self.process(*input)
+
+            self._redistributed_nbytes += _redistributed_nbytes() - nbytes_start
+
+            # Return immediately if output is None to skip writing phase.
+            if output is None:
+                return
+
+            # Set a tag in output if needed
+            if "tag" not in output.attrs and len(input) > 0 and "tag" in input[0].attrs:
+                output.attrs["tag"] = input[0].attrs["tag"]
+
+            # Record the key so a later run can reuse this output
+            if cache_key is not None:
+                output.attrs["cache_key"] = cache_key
+
+            # Check for NaN's etc
+            with self._trace_phase("nan_check"):
+                output = self._nan_process_output(output)
+
+            # Write the output if needed
+            with self._trace_phase("save"):
+                self._save_output(output)
+
+            # Increment internal counter
+            self._count = self._count + 1
 
         self.log.info("Leaving next for task %s" % self.__class__.__name__)
 
@@ -364,22 +1014,280 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
 
         self.log.info("Starting finish for task %s" % self.__class__.__name__)
 
+        # Wait for any iteration still running in the task's thread
+        self._wait_concurrent()
+
         try:
-            output = self.process_finish()
+            with self._trace_call("process_finish"):
+                try:
+                    output = self.process_finish()
+                except AttributeError:
+                    self.log.info("No finish for task %s" % self.__class__.__name__)
+                    output = None
+                else:
+                    # Errors from here on are not a missing finish, so they must
+                    # not be caught above and the output silently dropped
 
-            # Check for NaN's etc
-            output = self._nan_process_output(output)
+                    # Check for NaN's etc
+                    with self._trace_phase("nan_check"):
+                        output = self._nan_process_output(output)
 
-            # Write the output if needed
-            self._save_output(output)
+                    # Write the output if needed
+                    with self._trace_phase("save"):
+                        self._save_output(output)
+
+                        # Wait for any outputs still being written in the background
+                        self._close_writer()
 
-            self.log.info("Leaving finish for task %s" % self.__class__.__name__)
+                    self.log.info(
+                        "Leaving finish for task %s" % self.__class__.__name__
+                    )
 
-            return output
+        finally:
+            # Always flush the writer, even if finishing failed, so queued outputs
+            # aren't lost and its collective operations don't hang the other ranks
+            self._close_writer()
 
-        except AttributeError:
-            self.log.info("No finish for task %s" % self.__class__.__name__)
-            pass
+        # Shut down the task's thread and release its communicator
+        self._stop_concurrent(output)
+
+        if self._barrier_time > 0:
+            self.log.debug(
+                "Task %s waited %.3f s in barriers.",
+                self.__class__.__name__,
+                self._barrier_time,
+            )
+
+        # Report the data moved by redistributions over all ranks. This needs a
+        # collective operation, so only do it if the report will be seen
+        if self.log.isEnabledFor(logging.INFO):
+            nbytes = self.comm.allreduce(self._redistributed_nbytes)
+        else:
+            nbytes = 0
+
+        if nbytes > 0:
+            self.log.info(
+                "Task %s moved %.3f GB in redistributions.",
+                self.__class__.__name__,
+                nbytes / 2 ** 30,
+            )
+
+        self._write_trace()
+
+        return output
+
+    def _start_concurrent(self):
+        # Set up the thread and communicator for running concurrently
+        from mpi4py import MPI
+        from concurrent.futures import ThreadPoolExecutor
+
+        if self._no_input:
+            raise pipeline.PipelineConfigError(
+                "Only tasks with inputs can run concurrently."
+            )
+
+        if self.comm.size > 1:
+            if MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+                self.log.warning(
+                    "MPI does not support multiple threads. Running sequentially."
+                )
+                self.concurrent = False
+                return
+
+            # Collective operations from this task's thread must not interleave
+            # with those of other tasks
+            self._base_comm = self.comm
+            self.comm = self.comm.Dup()
+
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _submit_next(self, input):
+        # Start an iteration in the task's thread and return a placeholder output
+
+        if self._stopped:
+            raise pipeline.PipelineStopIteration()
+
+        # Wait for the previous iteration. This re-raises any error from it, and
+        # ensures the task's thread isn't using the communicator while we copy
+        # the inputs onto it
+        self._wait_concurrent()
+
+        input = [
+            x if isinstance(x, _PendingOutput) else self._copy_input(x) for x in input
+        ]
+
+        self._pending = _PendingOutput(self._executor.submit(self._run_next, input))
+
+        return self._pending
+
+    def _run_next(self, input):
+        # Run an iteration in the task's thread
+
+        from . import containers
+
+        # Outputs of concurrent tasks upstream can only be copied once ready
+        input = [
+            self._copy_input(x.result()) if isinstance(x, _PendingOutput) else x
+            for x in input
+        ]
+
+        if any(x is None for x in input):
+            return None
+
+        # Move the inputs on the original communicator onto ours while we use them
+        moved = [x for x in input if _on_comm(x, self._base_comm)]
+        for x in moved:
+            containers.rebind_comm(x, self.comm)
+
+        # The iteration can't be stopped from this thread, so stop on the next call
+        try:
+            output = self._next(*input)
+        except pipeline.PipelineStopIteration:
+            self._stopped = True
+            return None
+        finally:
+            for x in moved:
+                containers.rebind_comm(x, self._base_comm)
+
+        # Collective operations on the output happen outside of this thread, so
+        # move it onto the original communicator
+        if _on_comm(output, self.comm):
+            containers.rebind_comm(output, self._base_comm)
+
+        return output
+
+    def _copy_input(self, x):
+        # Take a private copy of an input container attached to our communicator,
+        # if requested
+        from .containers import ContainerBase
+
+        if self.concurrent_copy and isinstance(x, ContainerBase):
+            return x.copy(comm=self.comm)
+
+        return x
+
+    def _wait_concurrent(self):
+        # Wait for the current iteration in the task's thread, if there is one
+
+        pending, self._pending = self._pending, None
+
+        if pending is not None:
+            pending.result()
+
+    def _stop_concurrent(self, output=None):
+        # Shut down the task's thread, and move the final output onto the original
+        # communicator so its duplicate can be freed
+
+        from . import containers
+
+        if self._executor is None:
+            return
+
+        self._executor.shutdown()
+        self._executor = None
+        self.concurrent = False
+
+        if self._base_comm is not None:
+            if _on_comm(output, self.comm):
+                containers.rebind_comm(output, self._base_comm)
+            self.comm.Free()
+            self.comm = self._base_comm
+            self._base_comm = None
+
+    def _resolve_distribution(self, input):
+        # Do any redistributions of the inputs that were deferred, straight to the
+        # axis this task needs if it declares one. This depends only on the
+        # distribution of the inputs, so is the same on all ranks.
+
+        for x in input:
+
+            pending = getattr(x, "pending_axis", None)
+
+            if pending is None:
+                continue
+
+            if self._input_distributed_axis is not None:
+                x.redistribute(self._input_distributed_axis)
+            else:
+                x.redistribute(pending)
+
+    def _barrier(self, input):
+        # Synchronise the ranks according to the barrier policy, accumulating the
+        # time spent waiting. The decision only depends on the distribution of the
+        # inputs, so is the same on all ranks.
+
+        policy = self.barrier if self.barrier is not None else _default_barrier_policy
+
+        if policy == "never":
+            return
+
+        if policy == "redistribute" and self._input_distributed_axis is not None:
+            if not any(
+                _needs_redistribute(x, self._input_distributed_axis) for x in input
+            ):
+                return
+
+        t0 = time.perf_counter()
+        self.comm.Barrier()
+        self._barrier_time += time.perf_counter() - t0
+
+    @contextlib.contextmanager
+    def _trace_call(self, name):
+        # Trace a call to `process` or `process_finish` if tracing is enabled. Calls
+        # that exit with an exception (e.g. stopping the iteration) are not recorded.
+
+        if not self.trace:
+            yield
+            return
+
+        if self._traces is None:
+            self._traces = []
+
+        self._current_trace = _CallTrace(name, self._count)
+        try:
+            yield
+        except BaseException:
+            self._current_trace = None
+            raise
+
+        self._traces.append(self._current_trace.stop())
+        self._current_trace = None
+
+    def _trace_phase(self, name):
+        # Time a phase of the current call if we are tracing. Otherwise return a
+        # no-op context manager (`suppress` with no exception types)
+        if self._current_trace is None:
+            return contextlib.suppress()
+        return self._current_trace.phase(name)
+
+    def _write_trace(self):
+        # Gather the traces from all ranks and write them out on rank=0
+
+        if not self.trace:
+            return
+
+        rank_traces = self.comm.gather(self._traces or [], root=0)
+
+        if self.comm.rank == 0:
+            ncalls = [len(traces) for traces in rank_traces]
+            if min(ncalls) != max(ncalls):
+                self.log.warning(
+                    "Ranks made different numbers of calls (%i to %i). Calls made "
+                    "by only some ranks are summarised over those ranks.",
+                    min(ncalls),
+                    max(ncalls),
+                )
+
+            outfile = _trace_path(self.trace_file)
+
+            # Tracing may have been turned on after the task was created
+            if self._trace_name is None:
+                self._trace_name = _trace_task_name(outfile, self.__class__.__name__)
+
+            self.log.debug("Writing trace to %s.", outfile)
+            _write_trace(outfile, self._trace_name, rank_traces)
+
+        self._traces = []
 
     def _save_output(self, output):
         # Routine to write output if needed.
@@ -392,23 +1300,149 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
 
             # Create a tag for the output file name
             tag = output.attrs["tag"] if "tag" in output.attrs else self._count
+            outfile = self._output_filename(tag)
 
-            # Construct the filename
-            name_parts = {
-                "tag": tag,
-                "count": self._count,
-                "task": self.__class__.__name__,
-                "key": self._out_keys[0] if self._out_keys else "",
-                "output_root": self.output_root,
-            }
-            outfile = self.output_name.format(**name_parts)
+            if self.async_save:
+                self._write_async(outfile, output)
+            else:
+                self.log.debug("Writing output %s to disk.", outfile)
+                self.write_output(outfile, output)
+
+    def _output_filename(self, tag):
+        # Construct the filename for an output with the given tag
+
+        name_parts = {
+            "tag": tag,
+            "count": self._count,
+            "task": self.__class__.__name__,
+            "key": self._out_keys[0] if self._out_keys else "",
+            "output_root": self.output_root,
+        }
+        outfile = self.output_name.format(**name_parts)
+
+        # Expand any variables in the path
+        outfile = os.path.expanduser(outfile)
+        outfile = os.path.expandvars(outfile)
+
+        return outfile
+
+    def _write_async(self, outfile, output):
+        # Hand the output to the background writer, taking a snapshot if needed
 
-            # Expand any variables in the path
-            outfile = os.path.expanduser(outfile)
-            outfile = os.path.expandvars(outfile)
+        from mpi4py import MPI
+        from .containers import ContainerBase
+
+        if self._writer is None:
+
+            if self.comm.size > 1 and MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+                self.log.warning(
+                    "MPI does not support multiple threads. Writing synchronously."
+                )
+                self.async_save = False
+                self.write_output(outfile, output)
+                return
+
+            self._writer = _AsyncWriter(self._write_snapshot, self.async_queue_size)
+
+        comm = self.comm
+
+        if self.async_copy or self.comm.size > 1:
+            if not isinstance(output, ContainerBase):
+                self.log.debug(
+                    "Cannot snapshot %s. Writing %s synchronously.",
+                    output.__class__.__name__,
+                    outfile,
+                )
+                self.write_output(outfile, output)
+                return
+
+            # Collective operations in the writer thread must not interleave with
+            # those in the pipeline, so each snapshot gets its own communicator
+            if self.comm.size > 1:
+                comm = self.comm.Dup()
+
+            output = output.copy(comm=comm)
+
+        self.log.debug("Queueing output %s to be written to disk.", outfile)
+        self._writer.submit(outfile, output, comm)
 
-            self.log.debug("Writing output %s to disk.", outfile)
-            self.write_output(outfile, output)
+    def _write_snapshot(self, outfile, output, comm):
+        # Write out an output in the background thread and release its communicator
+        self.log.debug("Writing output %s to disk.", outfile)
+        self.write_output(outfile, output)
+
+        if comm is not self.comm:
+            comm.Free()
+
+    def _close_writer(self):
+        # Flush and stop the background writer if there is one
+
+        if self._writer is None:
+            return
+
+        self.log.debug("Waiting for outputs to be written.")
+        self._writer.close()
+        self._writer = None
+
+    def _cache_key(self, input):
+        # Compute a key identifying the output of `process` for the given inputs
+        import hashlib
+
+        props = {}
+        for cls in type(self).__mro__:
+            for name, prop in cls.__dict__.items():
+                if (
+                    isinstance(prop, config.Property)
+                    and name not in self._cache_ignore
+                    and name not in props
+                ):
+                    props[name] = getattr(self, name)
+
+        h = hashlib.sha256()
+        h.update(("%s.%s" % (self.__module__, self.__class__.__name__)).encode())
+        h.update(json.dumps(props, sort_keys=True, default=repr).encode())
+
+        # The content hash is made of the hashes of the local sections of the data
+        # on every rank
+        local_hashes = [_content_hash(x) for x in input]
+        for rank_hashes in self.comm.allgather(local_hashes):
+            for x, xhash in zip(input, rank_hashes):
+                tag = x.attrs.get("tag", "") if hasattr(x, "attrs") else ""
+                h.update(str(tag).encode())
+                h.update(xhash.encode())
+
+        return h.hexdigest()
+
+    def _load_cached_output(self, key, input):
+        # Load the output saved by a previous run if it was saved with the same
+        # cache key. Returns None if it doesn't exist.
+        import h5py
+
+        tag = input[0].attrs["tag"] if "tag" in input[0].attrs else self._count
+        outfile = self._output_filename(tag)
+
+        # Check the key of any existing file on rank=0 only
+        cached = False
+        if self.comm.rank == 0 and os.path.exists(outfile):
+            with h5py.File(outfile, "r") as fh:
+                file_key = fh.attrs.get("cache_key", None)
+            if isinstance(file_key, bytes):
+                file_key = file_key.decode()
+            cached = file_key == key
+        cached = self.comm.bcast(cached, root=0)
+
+        if not cached:
+            return None
+
+        self.log.info("Using cached output %s.", outfile)
+
+        return memh5.BasicCont.from_file(
+            outfile,
+            distributed=True,
+            comm=self.comm,
+            convert_attribute_strings=True,
+            convert_dataset_strings=True,
+        )
 
     def _nan_process_output(self, output):
         # Process the output to check for NaN's
@@ -436,45 +1470,66 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
         # Logs any issues found and returns True if there were any found.
         from mpi4py import MPI
 
+        # Read in any lazily loaded or spilled data, so the values are checked
+        # rather than the placeholders
+        _access(cont)
+
         if isinstance(cont, memh5.MemDiskGroup):
             cont = cont._data
 
         stack = [cont]
         found = False
 
+        # Count and report the bad values in every dataset if anyone will see it.
+        # Otherwise only whether there are any matters (for `nan_skip` and
+        # `nan_dump`), so we can stop at the first one
+        report = self.log.isEnabledFor(logging.INFO)
+
         # Walk over the container tree...
-        while stack:
+        while stack and (report or not found):
             n = stack.pop()
 
             # Check the dataset for non-finite numbers
             if isinstance(n, memh5.MemDataset):
 
-                # Try to test for NaN's and infs. This will fail for compound datatypes...
-                arr = n[:]
-                try:
-                    is_nan = np.isnan(arr)
-                    is_inf = np.isinf(arr)
-                    arr = n[:]
-                except TypeError:
+                # Only floating point types can hold NaN's and infs
+                if not np.issubdtype(n.dtype, np.inexact):
                     continue
 
-                if is_nan.any():
+                num_nan, num_inf = 0, 0
+
+                for block in _iter_blocks(
+                    n[:], _BLOCK_SIZE, self.nan_check_sample, self._count
+                ):
+
+                    # A single reduction over the block is sufficient for the
+                    # common case of finding nothing
+                    if np.isfinite(block).all():
+                        continue
+
+                    found = True
+
+                    if not report:
+                        break
+
+                    num_nan += np.isnan(block).sum()
+                    num_inf += np.isinf(block).sum()
+
+                if num_nan:
                     self.log.info(
                         "NaN's found in dataset %s [%i of %i elements]",
                         n.name,
-                        is_nan.sum(),
-                        arr.size,
+                        num_nan,
+                        n[:].size,
                     )
-                    found = True
 
-                if is_inf.any():
+                if num_inf:
                     self.log.info(
                         "Inf's found in dataset %s [%i of %i elements]",
                         n.name,
-                        is_inf.sum(),
-                        arr.size,
+                        num_inf,
+                        n[:].size,
                     )
-                    found = True
 
             elif isinstance(n, (memh5.MemGroup, memh5.MemDiskGroup)):
                 for item in n.values():
@@ -486,6 +1541,110 @@ class SingleTask(MPILoggedTask, pipeline.BasicContMixin):
         return found
 
 
+def _content_hash(obj):
+    """Hash the local contents of a memh5 container.
+
+    Only the datasets (including the index maps) are hashed, not the attributes.
+    Other objects are identified only by their type.
+
+    Parameters
+    ----------
+    obj : memh5.MemDiskGroup or object
+        Object to hash.
+
+    Returns
+    -------
+    hash : str
+        Hex digest of the content.
+    """
+    import hashlib
+
+    h = hashlib.sha256()
+    h.update(type(obj).__name__.encode())
+
+    _access(obj)
+
+    if isinstance(obj, memh5.MemDiskGroup):
+        obj = obj._data
+
+    # Walk the tree in a fixed order
+    stack = [obj] if isinstance(obj, memh5.MemGroup) else []
+    while stack:
+        n = stack.pop()
+
+        if isinstance(n, memh5.MemDataset):
+            arr = n[:]
+            h.update(("%s %s %s" % (n.name, n.dtype, arr.shape)).encode())
+
+            if arr.dtype.hasobject:
+                h.update(repr(arr.tolist()).encode())
+                continue
+
+            for block in _iter_blocks(arr, _BLOCK_SIZE):
+                h.update(np.ascontiguousarray(block).view(np.uint8).reshape(-1))
+
+        elif isinstance(n, memh5.MemGroup):
+            stack += [n[k] for k in sorted(n.keys(), reverse=True)]
+
+    return h.hexdigest()
+
+
+def _access(obj):
+    # Read in any lazily loaded or spilled datasets of a container, as walks
+    # over its tree that bypass `datasets` would find only placeholders
+
+    from . import containers
+
+    if isinstance(obj, containers.ContainerBase):
+        obj._access()
+
+
+# Number of elements to process at a time when scanning through datasets
+_BLOCK_SIZE = 2 ** 20
+
+
+def _iter_blocks(arr, block_size, sample=1, offset=0):
+    """Iterate over views of an array in blocks without copying.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        Array to iterate over.
+    block_size : int
+        Approximate number of elements in each block.
+    sample : int, optional
+        Only yield every `sample`-th block.
+    offset : int, optional
+        Offset the sampled blocks by this amount. Changing this between calls
+        rotates through the whole array.
+
+    Yields
+    ------
+    block : np.ndarray
+        A view of the next block of the array.
+    """
+    if sample < 1:
+        raise ValueError("Sampling interval must be positive. Got %i." % sample)
+
+    arr = np.asarray(arr)
+
+    if arr.ndim == 0:
+        yield arr
+        return
+
+    # If the array is contiguous we can take a flat view and yield exactly sized
+    # blocks, otherwise we need to split along the first axis
+    if arr.flags.c_contiguous:
+        arr = arr.reshape(-1)
+        step = block_size
+    else:
+        step = max(block_size * arr.shape[0] // max(arr.size, 1), 1)
+
+    for bi, start in enumerate(range(0, arr.shape[0], step)):
+        if (bi + offset) % sample == 0:
+            yield arr[start : start + step]
+
+
 class ReturnLastInputOnFinish(SingleTask):
     """Workaround for `caput.pipeline` issues.
 
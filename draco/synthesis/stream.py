@@ -358,7 +358,8 @@ class MakeSiderealDayStream(task.SingleTask):
     """Task for simulating a set of sidereal days from a given stream.
 
     This creates a copy of the base stream for every LSD within the provided time
-    range.
+    range. The copies are copy-on-write, so only use extra memory for the parts
+    that are modified downstream.
 
     Attributes
     ----------
@@ -415,7 +416,8 @@ class MakeSiderealDayStream(task.SingleTask):
         if self._current_lsd >= self.lsd_end:
             raise pipeline.PipelineStopIteration
 
-        ss = self.sstream.copy()
+        # Share the base stream's memory until the copy is modified
+        ss = self.sstream.copy(copy_on_write=True)
         ss.attrs["tag"] = f"lsd_{self._current_lsd}"
         ss.attrs["lsd"] = self._current_lsd
 
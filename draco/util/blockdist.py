@@ -0,0 +1,227 @@
+"""Redistribute MPIArrays in blocks.
+
+A redistribution between two axes is split into a sequence of smaller
+all-to-all exchanges, each of which delivers a block of the new local section
+along the new distributed axis. The exchange of the next block is started
+before the current one is handed over, so communication overlaps with packing
+the data and with any processing done on the blocks as they arrive.
+
+Functions
+=========
+
+.. autosummary::
+    :toctree:
+
+    iter_redistribute
+    redistribute
+    block_rows
+"""
+import numpy as np
+
+from caput import mpiarray, mpiutil
+
+
+def block_rows(global_shape, axis, itemsize, block_size):
+    """Number of rows along the new distributed axis that fit in a block.
+
+    Parameters
+    ----------
+    global_shape : tuple
+        Global shape of the array.
+    axis : int
+        The axis being redistributed over.
+    itemsize : int
+        Size of the array elements in bytes.
+    block_size : int
+        Target size of a block on each rank in bytes.
+
+    Returns
+    -------
+    rows : int
+        At least 1.
+    """
+    row_bytes = itemsize * int(np.prod(global_shape)) // max(global_shape[axis], 1)
+    return max(1, block_size // max(row_bytes, 1))
+
+
+def iter_redistribute(arr, axis, block_size=2 ** 26, rows=None):
+    """Redistribute an array block by block, yielding each block as it arrives.
+
+    The original array is left unchanged. This must be called on all ranks, and
+    the iteration must be run to completion on all ranks.
+
+    Parameters
+    ----------
+    arr : mpiarray.MPIArray
+        The array.
+    axis : int
+        The axis to redistribute over.
+    block_size : int, optional
+        Target size of each block on each rank in bytes. Default is 64 MB.
+    rows : int, optional
+        Number of rows along `axis` in each block. Overrides `block_size`.
+
+    Yields
+    ------
+    start, end : int
+        The range of the block along `axis`, as global indices.
+    block : np.ndarray
+        The block. It has the full global length along all other axes. If the
+        array is already distributed over `axis` this is a view of it.
+    """
+
+    comm = arr.comm
+    src_axis = arr.axis
+    gshape = arr.global_shape
+
+    if rows is None:
+        rows = block_rows(gshape, axis, arr.itemsize, block_size)
+
+    local = arr.view(np.ndarray)
+
+    _, sa, ea = mpiutil.split_all(gshape[src_axis], comm=comm)
+    nb, sb, eb = mpiutil.split_all(gshape[axis], comm=comm)
+
+    # The number of exchanges is set by the rank with the most rows
+    nsteps = int(max(-(-n // rows) for n in nb)) if len(nb) else 0
+
+    def _range(rank, step):
+        # The range along the new axis delivered to `rank` in `step`
+        start = min(sb[rank] + step * rows, eb[rank])
+        return start, min(start + rows, eb[rank])
+
+    def _start(step):
+        # Pack the data for a step and start exchanging it
+
+        sendbufs = []
+        for rank in range(comm.size):
+            start, end = _range(rank, step)
+            sl = [slice(None)] * local.ndim
+            sl[axis] = slice(start, end)
+            sendbufs.append(np.ascontiguousarray(local[tuple(sl)]).reshape(-1))
+
+        sendcounts = [b.nbytes for b in sendbufs]
+        send = np.concatenate(sendbufs).view(np.uint8)
+        del sendbufs
+
+        start, end = _range(comm.rank, step)
+
+        shapes = []
+        for rank in range(comm.size):
+            shape = list(gshape)
+            shape[src_axis] = ea[rank] - sa[rank]
+            shape[axis] = end - start
+            shapes.append(shape)
+
+        recvcounts = [int(np.prod(s)) * arr.itemsize for s in shapes]
+        recv = np.empty(sum(recvcounts), dtype=np.uint8)
+
+        request = _alltoallv(comm, send, sendcounts, recv, recvcounts)
+
+        # The send buffer is returned to keep it alive until the exchange is done
+        return request, send, recv, recvcounts, shapes, (start, end)
+
+    def _finish(exchange):
+        # Wait for a step's exchange and unpack the block
+
+        request, _, recv, recvcounts, shapes, (start, end) = exchange
+
+        if request is not None:
+            request.Wait()
+
+        block_shape = list(gshape)
+        block_shape[axis] = end - start
+        block = np.empty(block_shape, dtype=arr.dtype)
+
+        offset = 0
+        for rank, (count, shape) in enumerate(zip(recvcounts, shapes)):
+            sl = [slice(None)] * block.ndim
+            sl[src_axis] = slice(sa[rank], ea[rank])
+            chunk = recv[offset : offset + count].view(arr.dtype)
+            block[tuple(sl)] = chunk.reshape(shape)
+            offset += count
+
+        return (start, end), block
+
+    if axis == src_axis:
+        # Nothing needs exchanging, just yield the local section in the same blocks
+        offset = arr.local_offset[axis]
+
+        for step in range(nsteps):
+            start, end = _range(comm.rank, step)
+            sl = [slice(None)] * local.ndim
+            sl[axis] = slice(start - offset, end - offset)
+            yield (start, end), local[tuple(sl)]
+
+        return
+
+    pending = _start(0) if nsteps > 0 else None
+
+    try:
+        for step in range(nsteps):
+
+            # Start the next exchange before waiting for this one
+            current = pending
+            pending = _start(step + 1) if step + 1 < nsteps else None
+
+            yield _finish(current)
+
+    finally:
+        # Complete any outstanding exchange if the iteration was abandoned
+        if pending is not None and pending[0] is not None:
+            pending[0].Wait()
+
+
+def redistribute(arr, axis, block_size=2 ** 26):
+    """Redistribute an array over a new axis, in blocks.
+
+    This only needs a couple of blocks of temporary memory beyond the new array.
+
+    Parameters
+    ----------
+    arr : mpiarray.MPIArray
+        The array.
+    axis : int
+        The axis to redistribute over.
+    block_size : int, optional
+        Target size of each block on each rank in bytes. Default is 64 MB.
+
+    Returns
+    -------
+    new_arr : mpiarray.MPIArray
+        The redistributed array.
+    """
+    if axis == arr.axis:
+        return arr
+
+    new_arr = mpiarray.MPIArray(
+        arr.global_shape, axis=axis, comm=arr.comm, dtype=arr.dtype
+    )
+    local = new_arr.view(np.ndarray)
+    offset = new_arr.local_offset[axis]
+
+    for (start, end), block in iter_redistribute(arr, axis, block_size):
+        sl = [slice(None)] * local.ndim
+        sl[axis] = slice(start - offset, end - offset)
+        local[tuple(sl)] = block
+
+    return new_arr
+
+
+def _alltoallv(comm, send, sendcounts, recv, recvcounts):
+    # Start a non-blocking all-to-all of bytes, or do a blocking one if the MPI
+    # library doesn't support it. Returns the request, or None if it is complete.
+
+    from mpi4py import MPI
+
+    senddispls = np.concatenate([[0], np.cumsum(sendcounts)[:-1]]).astype(int)
+    recvdispls = np.concatenate([[0], np.cumsum(recvcounts)[:-1]]).astype(int)
+
+    sendspec = [send, (sendcounts, senddispls.tolist()), MPI.BYTE]
+    recvspec = [recv, (recvcounts, recvdispls.tolist()), MPI.BYTE]
+
+    try:
+        return comm.Ialltoallv(sendspec, recvspec)
+    except NotImplementedError:
+        comm.Alltoallv(sendspec, recvspec)
+        return None
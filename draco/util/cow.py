@@ -0,0 +1,219 @@
+"""Copy-on-write sharing of arrays.
+
+An array is copied once into an anonymous in-memory file, which can then be
+mapped privately any number of times. All the mappings share the memory of the
+file until they are written to, at which point the operating system duplicates
+only the pages touched, and only for the mapping that wrote to them.
+
+Classes
+=======
+
+.. autosummary::
+    :toctree:
+
+    CowBuffer
+
+Functions
+=========
+
+.. autosummary::
+    :toctree:
+
+    buffer_of
+    is_modified
+    private_nbytes
+"""
+import mmap
+import os
+import tempfile
+import weakref
+
+import numpy as np
+
+
+class _CowMap(mmap.mmap):
+    # A private mapping of a CowBuffer, which keeps the buffer alive
+    buffer = None
+
+
+class CowBuffer:
+    """An immutable in-memory copy of an array that can be mapped copy-on-write.
+
+    The memory is released once the buffer and all its mappings are deleted.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        The array to copy. Must not contain Python objects.
+    """
+
+    def __init__(self, arr):
+
+        arr = np.asarray(arr)
+
+        if arr.dtype.hasobject:
+            raise ValueError("Arrays of Python objects can't be shared.")
+
+        self.shape = arr.shape
+        self.dtype = arr.dtype
+        self.nbytes = arr.nbytes
+
+        self._fd = _anonymous_file()
+        self._finalizer = weakref.finalize(self, os.close, self._fd)
+
+        if self.nbytes == 0:
+            return
+
+        os.ftruncate(self._fd, self.nbytes)
+
+        m = mmap.mmap(self._fd, self.nbytes, flags=mmap.MAP_SHARED)
+        dest = np.frombuffer(m, dtype=self.dtype).reshape(self.shape)
+        dest[...] = arr
+        del dest
+        m.close()
+
+    def map(self):
+        """Create a private copy-on-write mapping of the buffer.
+
+        Returns
+        -------
+        arr : np.ndarray
+            A writeable C-ordered array with the contents of the buffer.
+        """
+        if self.nbytes == 0:
+            return np.empty(self.shape, dtype=self.dtype)
+
+        m = _CowMap(
+            self._fd,
+            self.nbytes,
+            flags=mmap.MAP_PRIVATE,
+            prot=mmap.PROT_READ | mmap.PROT_WRITE,
+        )
+        m.buffer = self
+
+        return np.frombuffer(m, dtype=self.dtype).reshape(self.shape)
+
+
+def buffer_of(arr):
+    """Get the buffer that an array maps in full.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        The array.
+
+    Returns
+    -------
+    buffer : CowBuffer or None
+        The buffer, or `None` if the array is not a full mapping of one (e.g. it's
+        a sub-array of a mapping, or an ordinary array).
+    """
+    m = _mapping_of(arr)
+
+    if m is None or arr.shape != m.buffer.shape or arr.dtype != m.buffer.dtype:
+        return None
+
+    # Check it starts at the start of the mapping and is C-ordered
+    start = np.frombuffer(m, dtype=np.uint8, count=1).ctypes.data
+    if arr.ctypes.data != start or not arr.flags.c_contiguous:
+        return None
+
+    return m.buffer
+
+
+def is_modified(arr):
+    """Whether any of the mapping an array is part of has been written to.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        A copy-on-write mapping, or a view of one.
+
+    Returns
+    -------
+    modified : bool
+        True if any pages have been written to, or if this can't be determined.
+    """
+    m = _mapping_of(arr)
+
+    if m is None:
+        return True
+
+    npages = _private_pages(m)
+
+    return npages is None or npages > 0
+
+
+def private_nbytes(arr):
+    """The memory used by an array that is not shared with any other array.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        The array.
+
+    Returns
+    -------
+    nbytes : int
+        For copy-on-write mappings, the size of the pages that have been written
+        to. For other arrays (or if this can't be determined) `arr.nbytes`.
+    """
+    m = _mapping_of(arr)
+
+    if m is None:
+        return arr.nbytes
+
+    npages = _private_pages(m)
+
+    if npages is None:
+        return arr.nbytes
+
+    return min(npages * mmap.PAGESIZE, arr.nbytes)
+
+
+def _anonymous_file():
+    # Get a file descriptor for an anonymous file, in memory if possible
+
+    if hasattr(os, "memfd_create"):
+        return os.memfd_create("draco_cow")
+
+    with tempfile.TemporaryFile() as fh:
+        return os.dup(fh.fileno())
+
+
+def _mapping_of(arr):
+    # Find the copy-on-write mapping an array is a view of, if any
+
+    base = arr
+    while base is not None and not isinstance(base, _CowMap):
+        if isinstance(base, memoryview):
+            base = base.obj
+        else:
+            base = getattr(base, "base", None)
+
+    return base
+
+
+def _private_pages(m):
+    # Count the pages of a mapping that have been written to, and so are no longer
+    # shared with the file. This uses the Linux pagemap interface, where written
+    # pages are present (bit 63) or swapped (bit 62), but are not file pages (bit
+    # 61). Returns None if the pagemap can't be read.
+
+    start = np.frombuffer(m, dtype=np.uint8, count=1).ctypes.data
+    npages = -(-len(m) // mmap.PAGESIZE)
+
+    try:
+        with open("/proc/self/pagemap", "rb") as fh:
+            fh.seek(start // mmap.PAGESIZE * 8)
+            entries = np.frombuffer(fh.read(npages * 8), dtype=np.uint64)
+    except OSError:
+        return None
+
+    if len(entries) != npages:
+        return None
+
+    in_memory = (entries >> np.uint64(62)) != 0
+    file_page = ((entries >> np.uint64(61)) & np.uint64(1)) != 0
+
+    return int(np.count_nonzero(in_memory & ~file_page))
@@ -0,0 +1,645 @@
+"""Two dimensional decomposition of containers over a grid of processes.
+
+`caput` containers can only be distributed over one axis, usually `freq`, which
+limits the number of ranks that can usefully work on them. Here the ranks are
+split into groups, each group takes a contiguous range of a second axis (e.g.
+`stack` or `ra`) and holds a sub-container with that part of the data
+distributed over its own communicator. Together the groups cover a
+`freq` x `axis` grid of tiles.
+
+Tasks can work on a sub-container as on any other container, so elementwise and
+per-baseline tasks generally need no changes, though anything indexing global
+arrays along the split axis needs :func:`offset`, and any reductions over the
+split axis must be done across the groups with :attr:`ProcessGrid.cross_comm`.
+Other containers can be split up the same way as a decomposed one with
+:func:`like`.
+
+The sub-containers record the decomposition in their `decomp_*` attributes.
+The reverse maps are not sliced, and so still refer to the full axes.
+
+Classes
+=======
+
+.. autosummary::
+    :toctree:
+
+    ProcessGrid
+
+Functions
+=========
+
+.. autosummary::
+    :toctree:
+
+    process_grid
+    grid_of
+    is_decomposed
+    axis_of
+    offset
+    axis_length
+    global_shape
+    tile
+    enumerate_axis
+    like
+    exchange
+"""
+import numpy as np
+
+from caput import mpiutil
+
+
+# Process grids that have been created, so their communicators are reused
+_grids = {}
+
+# Maximum number of bytes moved to or from a rank in each all-to-all. MPI counts
+# and displacements are C ints, so this must be below 2 GB.
+_MAX_EXCHANGE_BYTES = 2 ** 30
+
+
+class ProcessGrid:
+    """A grid of processes for splitting containers over a second axis.
+
+    Use :func:`process_grid` to get one rather than creating it directly.
+
+    Parameters
+    ----------
+    ngroup : int
+        Number of groups to split the ranks into. This must divide the number of
+        ranks.
+    comm : MPI.Comm, optional
+        The communicator of the whole grid. Default is `MPI.COMM_WORLD`.
+
+    Attributes
+    ----------
+    comm : MPI.Comm
+        The communicator of the whole grid.
+    group : int
+        The group this rank is in.
+    group_comm : MPI.Comm
+        The communicator of the ranks within this group. Sub-containers are
+        distributed over this.
+    cross_comm : MPI.Comm
+        The communicator of the ranks with the same rank in each of the groups.
+        As all groups are the same size, these hold the same part of the
+        sub-containers of each group if they are distributed in the same way.
+    """
+
+    def __init__(self, ngroup, comm=None):
+
+        if comm is None:
+            from mpi4py import MPI
+
+            comm = MPI.COMM_WORLD
+
+        if ngroup < 1 or comm.size % ngroup:
+            raise ValueError(
+                f"Number of groups ({ngroup}) must divide the number of ranks "
+                f"({comm.size})."
+            )
+
+        self.ngroup = ngroup
+        self.comm = comm
+
+        group_size = comm.size // ngroup
+        self.group = comm.rank // group_size
+
+        self.group_comm = comm.Split(self.group, comm.rank)
+        self.cross_comm = comm.Split(self.group_comm.rank, comm.rank)
+
+    def axis_range(self, n, group=None):
+        """The range of an axis of length `n` held by a group.
+
+        Parameters
+        ----------
+        n : int
+            Length of the axis.
+        group : int, optional
+            The group. Default is this rank's group.
+
+        Returns
+        -------
+        start, end : int
+        """
+        group = self.group if group is None else group
+        _, start, end = mpiutil.split_m(n, self.ngroup)
+
+        return int(start[group]), int(end[group])
+
+    def scatter(self, cont, axis):
+        """Split a container up over the groups.
+
+        This must be called on all ranks of the grid.
+
+        Parameters
+        ----------
+        cont : containers.ContainerBase
+            The container, distributed over the grid's communicator.
+        axis : str
+            The axis to split over the groups. If the container doesn't have it,
+            each group gets all of the data.
+
+        Returns
+        -------
+        sub : containers.ContainerBase
+            This group's part of the container, distributed over `group_comm`.
+            Distributed datasets are distributed over `freq` if they have it.
+        """
+        from caput import memh5
+
+        if is_decomposed(cont):
+            raise ValueError("Container has already been decomposed.")
+
+        kwargs = {}
+        if axis in cont.index_map:
+            start, end = self.axis_range(len(cont.index_map[axis]))
+            kwargs[axis] = cont.index_map[axis][start:end]
+        else:
+            start, end = 0, None
+
+        sub = cont.__class__(
+            axes_from=cont,
+            attrs_from=cont,
+            skip_datasets=True,
+            comm=self.group_comm,
+            distributed=True,
+            **kwargs,
+        )
+
+        sub.attrs["decomp_axis"] = axis
+        sub.attrs["decomp_ngroup"] = self.ngroup
+        sub.attrs["decomp_start"] = start
+        sub.attrs["decomp_length"] = (
+            len(cont.index_map[axis]) if axis in cont.index_map else 0
+        )
+
+        for name, dset in cont.datasets.items():
+
+            dset_axes = list(dset.attrs.get("axis", ()))
+            shape = list(dset.global_shape if dset.distributed else dset.shape)
+
+            sl = [slice(None)] * len(shape)
+            if axis in dset_axes:
+                sl[dset_axes.index(axis)] = slice(start, end)
+                shape[dset_axes.index(axis)] = end - start
+
+            if dset.distributed:
+                dist_axis = (
+                    dset_axes.index("freq")
+                    if "freq" in dset_axes
+                    else dset.distributed_axis
+                )
+                sub.create_dataset(
+                    name,
+                    shape=shape,
+                    dtype=dset.dtype,
+                    distributed=True,
+                    distributed_axis=dist_axis,
+                )
+                memh5.copyattrs(dset.attrs, sub.datasets[name].attrs)
+
+                sub.datasets[name][:].view(np.ndarray)[:] = exchange(
+                    dset[:].view(np.ndarray),
+                    tile(cont, name),
+                    tile(sub, name),
+                    self.comm,
+                )
+            else:
+                sub.create_dataset(name, data=dset[:][tuple(sl)].copy())
+                memh5.copyattrs(dset.attrs, sub.datasets[name].attrs)
+
+        return sub
+
+    def gather(self, sub):
+        """Recombine the sub-containers of the groups into a single container.
+
+        This must be called on all ranks of the grid.
+
+        Parameters
+        ----------
+        sub : containers.ContainerBase
+            This group's sub-container.
+
+        Returns
+        -------
+        cont : containers.ContainerBase
+            The full container, distributed over the grid's communicator.
+            Distributed datasets are distributed over the same axis as in the
+            sub-container.
+        """
+        from caput import memh5
+
+        axis = axis_of(sub)
+
+        if axis is None:
+            raise ValueError("Container has not been decomposed.")
+
+        kwargs = {}
+        if axis in sub.index_map:
+            parts = self.cross_comm.allgather(sub.index_map[axis])
+            kwargs[axis] = np.concatenate(parts)
+
+        cont = sub.__class__(
+            axes_from=sub,
+            attrs_from=sub,
+            skip_datasets=True,
+            comm=self.comm,
+            distributed=True,
+            **kwargs,
+        )
+
+        for key in ["decomp_axis", "decomp_ngroup", "decomp_start", "decomp_length"]:
+            cont.attrs.pop(key, None)
+
+        for name, dset in sub.datasets.items():
+
+            dset_axes = list(dset.attrs.get("axis", ()))
+
+            if dset.distributed:
+                cont.create_dataset(
+                    name,
+                    shape=global_shape(sub, name),
+                    dtype=dset.dtype,
+                    distributed=True,
+                    distributed_axis=dset.distributed_axis,
+                )
+                memh5.copyattrs(dset.attrs, cont.datasets[name].attrs)
+
+                # Every group has all of the datasets not split over the groups,
+                # so only take them from the first group
+                if axis in dset_axes or self.group == 0:
+                    src_box = tile(sub, name)
+                else:
+                    src_box = [(0, 0)] * len(dset_axes)
+
+                cont.datasets[name][:].view(np.ndarray)[:] = exchange(
+                    dset[:].view(np.ndarray), src_box, tile(cont, name), self.comm
+                )
+            elif axis in dset_axes:
+                parts = self.cross_comm.allgather(dset[:])
+                cont.create_dataset(
+                    name, data=np.concatenate(parts, axis=dset_axes.index(axis))
+                )
+                memh5.copyattrs(dset.attrs, cont.datasets[name].attrs)
+            else:
+                cont.create_dataset(name, data=dset[:].copy())
+                memh5.copyattrs(dset.attrs, cont.datasets[name].attrs)
+
+        return cont
+
+
+def process_grid(ngroup, comm=None):
+    """Get the process grid with the given number of groups.
+
+    Grids are cached, so calling this repeatedly doesn't create new communicators.
+    This must be called on all ranks of `comm` the first time.
+
+    Parameters
+    ----------
+    ngroup : int
+        Number of groups.
+    comm : MPI.Comm, optional
+        The communicator of the whole grid. Default is `MPI.COMM_WORLD`.
+
+    Returns
+    -------
+    grid : ProcessGrid
+    """
+    if comm is None:
+        from mpi4py import MPI
+
+        comm = MPI.COMM_WORLD
+
+    key = (comm.py2f(), ngroup)
+
+    if key not in _grids:
+        _grids[key] = ProcessGrid(ngroup, comm)
+
+    return _grids[key]
+
+
+def grid_of(cont, comm=None):
+    """Get the process grid a container has been split over.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    comm : MPI.Comm, optional
+        The communicator of the whole grid. Default is `MPI.COMM_WORLD`.
+
+    Returns
+    -------
+    grid : ProcessGrid or None
+        The grid, or `None` if the container is not decomposed.
+    """
+    if not is_decomposed(cont):
+        return None
+
+    return process_grid(int(cont.attrs["decomp_ngroup"]), comm)
+
+
+def is_decomposed(cont):
+    """Whether a container is a sub-container of a decomposition.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+
+    Returns
+    -------
+    decomposed : bool
+    """
+    return axis_of(cont) is not None
+
+
+def axis_of(cont):
+    """The axis a container has been split over the groups along.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+
+    Returns
+    -------
+    axis : str or None
+        The axis, or `None` if the container is not decomposed.
+    """
+    axis = cont.attrs.get("decomp_axis", None)
+
+    if isinstance(axis, bytes):
+        axis = axis.decode()
+
+    return axis
+
+
+def offset(cont, axis):
+    """The offset of a container's axis within the full axis.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    axis : str
+        The axis.
+
+    Returns
+    -------
+    offset : int
+        The global index of the first element of the container's axis. This is
+        zero unless the container has been decomposed over `axis`.
+    """
+    if axis_of(cont) != axis:
+        return 0
+
+    return int(cont.attrs["decomp_start"])
+
+
+def axis_length(cont, axis):
+    """The length of an axis in the full container.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    axis : str
+        The axis.
+
+    Returns
+    -------
+    length : int
+    """
+    if axis_of(cont) == axis:
+        return int(cont.attrs["decomp_length"])
+
+    return len(cont.index_map[axis])
+
+
+def global_shape(cont, dset):
+    """The shape a dataset has in the full container.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    dset : str or memh5.MemDataset
+        The dataset, or its name.
+
+    Returns
+    -------
+    shape : tuple
+    """
+    dset = _dataset(cont, dset)
+    shape = list(dset.global_shape if dset.distributed else dset.shape)
+
+    axis = axis_of(cont)
+    dset_axes = list(dset.attrs.get("axis", ()))
+
+    if axis is not None and axis in dset_axes:
+        shape[dset_axes.index(axis)] = int(cont.attrs["decomp_length"])
+
+    return tuple(shape)
+
+
+def tile(cont, dset):
+    """The part of the full dataset held locally.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    dset : str or memh5.MemDataset
+        The dataset, or its name.
+
+    Returns
+    -------
+    box : list of (start, end)
+        The range of each axis of the full dataset held by this rank.
+    """
+    dset = _dataset(cont, dset)
+    dset_axes = list(dset.attrs.get("axis", ()))
+    axis = axis_of(cont)
+
+    if dset.distributed:
+        data = dset[:]
+        starts = list(data.local_offset)
+        shape = data.local_shape
+    else:
+        starts = [0] * len(dset.shape)
+        shape = dset.shape
+
+    if axis is not None and axis in dset_axes:
+        starts[dset_axes.index(axis)] += offset(cont, axis)
+
+    return [(int(s), int(s + n)) for s, n in zip(starts, shape)]
+
+
+def enumerate_axis(cont, dset, axis):
+    """Iterate over the local indices of an axis and their full indices.
+
+    This works like `MPIArray.enumerate`, but gives the indices within the full
+    container if it has been split over the axis.
+
+    Parameters
+    ----------
+    cont : memh5.BasicCont
+        The container.
+    dset : str or memh5.MemDataset
+        The dataset, or its name.
+    axis : int
+        The axis of the dataset.
+
+    Yields
+    ------
+    local_index, global_index : int
+    """
+    start, end = tile(cont, dset)[axis]
+
+    for gi in range(start, end):
+        yield gi - start, gi
+
+
+def like(cont, other):
+    """Split a container up in the same way as another.
+
+    This must be called on all ranks.
+
+    Parameters
+    ----------
+    cont : containers.ContainerBase
+        The container to split up.
+    other : containers.ContainerBase
+        A container which may have been decomposed.
+
+    Returns
+    -------
+    sub : containers.ContainerBase
+        The part of `cont` that goes with `other`, or `cont` itself if `other`
+        isn't decomposed.
+    """
+    axis = axis_of(other)
+
+    if axis is None or is_decomposed(cont):
+        return cont
+
+    return grid_of(other, cont.comm).scatter(cont, axis)
+
+
+def exchange(local, src_box, dst_box, comm):
+    """Exchange the parts of an array between ranks.
+
+    Each rank holds a box of the full array and wants another box of it. The
+    boxes held must not overlap, and must together cover the boxes wanted.
+
+    Parameters
+    ----------
+    local : np.ndarray
+        The box of the array held by this rank.
+    src_box : list of (start, end)
+        The range of each axis of the full array held by this rank.
+    dst_box : list of (start, end)
+        The range of each axis wanted by this rank.
+    comm : MPI.Comm
+        Communicator over all ranks holding parts of the array.
+
+    Returns
+    -------
+    out : np.ndarray
+        The box wanted.
+    """
+    from mpi4py import MPI
+
+    boxes = comm.allgather((src_box, dst_box))
+
+    def _intersect(a, b):
+        box = [(max(a0, b0), min(a1, b1)) for (a0, a1), (b0, b1) in zip(a, b)]
+        return box if all(e > s for s, e in box) else None
+
+    def _slice(box, origin):
+        return tuple(slice(s - o, e - o) for (s, e), (o, _) in zip(box, origin))
+
+    # Pack the parts wanted by each rank
+    sendbufs = []
+    for _, want in boxes:
+        box = _intersect(src_box, want)
+        if box is None:
+            sendbufs.append(np.empty(0, dtype=local.dtype))
+        else:
+            sendbufs.append(np.ascontiguousarray(local[_slice(box, src_box)]).ravel())
+
+    sendcounts = [b.nbytes for b in sendbufs]
+    send = np.concatenate(sendbufs).view(np.uint8)
+    del sendbufs
+
+    recvboxes = [_intersect(have, dst_box) for have, _ in boxes]
+    recvcounts = [
+        0 if box is None else int(np.prod([e - s for s, e in box])) * local.itemsize
+        for box in recvboxes
+    ]
+    recv = np.empty(sum(recvcounts), dtype=np.uint8)
+
+    def _displs(counts):
+        return np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int).tolist()
+
+    # The counts and displacements of a single all-to-all overflow once a rank
+    # moves more than 2 GB, so split the exchange into rounds. Each round moves
+    # an equal share of the bytes between each pair of ranks.
+    nbytes = max(send.nbytes, recv.nbytes)
+    nrounds = comm.allreduce(max(1, -(-nbytes // _MAX_EXCHANGE_BYTES)), op=MPI.MAX)
+
+    if nrounds == 1:
+        comm.Alltoallv(
+            [send, (sendcounts, _displs(sendcounts)), MPI.BYTE],
+            [recv, (recvcounts, _displs(recvcounts)), MPI.BYTE],
+        )
+    else:
+        senddispls = _displs(sendcounts)
+        recvdispls = _displs(recvcounts)
+
+        def _share(displs, counts, rnd):
+            # The range of bytes of each rank's part moved in a round
+            return [
+                (d + c * rnd // nrounds, d + c * (rnd + 1) // nrounds)
+                for d, c in zip(displs, counts)
+            ]
+
+        for rnd in range(nrounds):
+            sparts = _share(senddispls, sendcounts, rnd)
+            rparts = _share(recvdispls, recvcounts, rnd)
+
+            sbuf = np.concatenate([send[s:e] for s, e in sparts])
+            scounts = [e - s for s, e in sparts]
+            rcounts = [e - s for s, e in rparts]
+            rbuf = np.empty(sum(rcounts), dtype=np.uint8)
+
+            comm.Alltoallv(
+                [sbuf, (scounts, _displs(scounts)), MPI.BYTE],
+                [rbuf, (rcounts, _displs(rcounts)), MPI.BYTE],
+            )
+
+            offset_ = 0
+            for s, e in rparts:
+                recv[s:e] = rbuf[offset_ : offset_ + e - s]
+                offset_ += e - s
+
+            del sbuf, rbuf
+
+    out = np.empty([e - s for s, e in dst_box], dtype=local.dtype)
+
+    offset_ = 0
+    for box, count in zip(recvboxes, recvcounts):
+        if box is None:
+            continue
+        shape = [e - s for s, e in box]
+        out[_slice(box, dst_box)] = (
+            recv[offset_ : offset_ + count].view(local.dtype).reshape(shape)
+        )
+        offset_ += count
+
+    return out
+
+
+def _dataset(cont, dset):
+    # Get a dataset of a container given it or its name
+    return cont.datasets[dset] if isinstance(dset, str) else dset
@@ -0,0 +1,243 @@
+"""Compact encodings for weight and mask datasets.
+
+Weights can be log-quantised into 8 or 16 bit integers, and boolean masks can be
+packed into bits. Encoded datasets keep their name and `axis` attribute, and
+record how they were encoded in their attributes, so they can be stored in
+memory and on disk in the compact form and decoded when needed.
+
+Functions
+=========
+
+.. autosummary::
+    :toctree:
+
+    encode_log
+    decode_log
+    pack_mask
+    unpack_mask
+    encoding_of
+    decode_array
+    decode
+"""
+import numpy as np
+
+
+# Bits used by each of the log encodings
+LOG_ENCODINGS = {"log8": 8, "log16": 16}
+
+# Attributes used to describe the encodings
+ENCODING_ATTRS = [
+    "encoding",
+    "log_min",
+    "log_step",
+    "max_rel_error",
+    "decoded_dtype",
+    "length",
+]
+
+
+def encode_log(weight, bits=8, comm=None):
+    """Log-quantise a non-negative array (e.g. inverse variance weights).
+
+    The logarithm of the positive values is quantised uniformly between the
+    smallest and largest positive values. Zero (and any negative or NaN values) is
+    stored exactly as code zero.
+
+    Parameters
+    ----------
+    weight : np.ndarray
+        Values to encode.
+    bits : {8, 16}
+        Size of the codes.
+    comm : MPI.Comm, optional
+        If given, the range is determined across all ranks so that the sections
+        of a distributed array share the same encoding.
+
+    Returns
+    -------
+    codes : np.ndarray[uint8 or uint16]
+        The encoded values.
+    attrs : dict
+        Attributes needed to decode, and `max_rel_error`, the bound on the
+        relative error of each decoded positive value.
+    """
+
+    if bits not in LOG_ENCODINGS.values():
+        raise ValueError(f"Can only encode into 8 or 16 bits. Got {bits}.")
+
+    dtype = np.uint8 if bits == 8 else np.uint16
+    nlevels = 2 ** bits - 1
+
+    positive = weight > 0
+
+    # Find the range of the positive values
+    if positive.any():
+        lmin = float(np.log(weight[positive].min()))
+        lmax = float(np.log(weight[positive].max()))
+    else:
+        lmin, lmax = np.inf, -np.inf
+
+    if comm is not None:
+        from mpi4py import MPI
+
+        lmin = comm.allreduce(lmin, op=MPI.MIN)
+        lmax = comm.allreduce(lmax, op=MPI.MAX)
+
+    if lmin > lmax:
+        lmin, lmax = 0.0, 0.0
+
+    step = (lmax - lmin) / (nlevels - 1)
+
+    codes = np.zeros(weight.shape, dtype=dtype)
+    if step > 0:
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lw = np.log(weight, where=positive, out=np.zeros(weight.shape)) - lmin
+        codes[positive] = np.rint(lw[positive] / step) + 1
+    else:
+        codes[positive] = 1
+
+    attrs = {
+        "encoding": f"log{bits}",
+        "log_min": lmin,
+        "log_step": step,
+        "max_rel_error": float(np.expm1(step / 2)),
+        "decoded_dtype": np.dtype(weight.dtype).str,
+    }
+
+    return codes, attrs
+
+
+def decode_log(codes, attrs):
+    """Decode log-quantised values.
+
+    Parameters
+    ----------
+    codes : np.ndarray[uint8 or uint16]
+        The encoded values.
+    attrs : dict
+        The attributes returned by :func:`encode_log`.
+
+    Returns
+    -------
+    weight : np.ndarray
+        The decoded values.
+    """
+    bits = LOG_ENCODINGS[_encoding(attrs)]
+    dtype = np.dtype(attrs.get("decoded_dtype", np.float32))
+
+    # Decode with a lookup table of all possible values
+    levels = np.arange(2 ** bits - 1)
+    table = np.zeros(2 ** bits, dtype=dtype)
+    table[1:] = np.exp(attrs["log_min"] + levels * attrs["log_step"])
+
+    return table[codes]
+
+
+def pack_mask(mask):
+    """Pack a boolean mask into bits along its last axis.
+
+    Parameters
+    ----------
+    mask : np.ndarray[bool]
+        The mask.
+
+    Returns
+    -------
+    packed : np.ndarray[uint8]
+        The packed mask.
+    attrs : dict
+        Attributes needed to unpack.
+    """
+    packed = np.packbits(mask, axis=-1, bitorder="little")
+
+    return packed, {"encoding": "bitpack", "length": mask.shape[-1]}
+
+
+def unpack_mask(packed, attrs):
+    """Unpack a mask packed with :func:`pack_mask`.
+
+    Parameters
+    ----------
+    packed : np.ndarray[uint8]
+        The packed mask.
+    attrs : dict
+        The attributes returned by :func:`pack_mask`.
+
+    Returns
+    -------
+    mask : np.ndarray[bool]
+        The mask.
+    """
+    return np.unpackbits(
+        packed, axis=-1, count=int(attrs["length"]), bitorder="little"
+    ).astype(bool)
+
+
+def encoding_of(dset):
+    """Get the encoding of a dataset.
+
+    Parameters
+    ----------
+    dset : memh5.MemDataset
+        The dataset.
+
+    Returns
+    -------
+    encoding : str or None
+        The name of the encoding, or `None` if the dataset is not encoded.
+    """
+    return _encoding(dset.attrs)
+
+
+def decode_array(arr, attrs):
+    """Decode an array given the attributes of the dataset it came from.
+
+    Parameters
+    ----------
+    arr : np.ndarray
+        The array, or a section of it along any axis except the last for masks.
+    attrs : dict
+        The attributes of the dataset.
+
+    Returns
+    -------
+    decoded : np.ndarray
+        The decoded values. If the dataset is not encoded `arr` is returned.
+    """
+    encoding = _encoding(attrs)
+
+    if encoding is None:
+        return arr
+    if encoding in LOG_ENCODINGS:
+        return decode_log(arr, attrs)
+    if encoding == "bitpack":
+        return unpack_mask(arr, attrs)
+
+    raise ValueError(f"Unknown encoding {encoding}.")
+
+
+def decode(dset):
+    """Decode the local section of a dataset.
+
+    Parameters
+    ----------
+    dset : memh5.MemDataset
+        The dataset.
+
+    Returns
+    -------
+    decoded : np.ndarray
+        The decoded local values. If the dataset is not encoded this is a view of
+        the dataset.
+    """
+    return decode_array(dset[:].view(np.ndarray), dset.attrs)
+
+
+def _encoding(attrs):
+    # Get the encoding from a set of attributes, which may have been read as bytes
+    encoding = attrs.get("encoding", None)
+
+    if isinstance(encoding, bytes):
+        encoding = encoding.decode()
+
+    return encoding
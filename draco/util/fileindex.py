@@ -0,0 +1,312 @@
+"""An on-disk index of the metadata of container files.
+
+The index records the container type, tag, LSD, time, RA and frequency coverage
+and the input and stack sizes of each file, so that files can be selected
+without opening them. It's stored in an SQLite database and is updated
+incrementally, re-reading only files that are new or have changed since they
+were last indexed.
+
+Classes
+=======
+
+.. autosummary::
+    :toctree:
+
+    FileIndex
+"""
+import json
+import os
+import sqlite3
+
+import h5py
+import numpy as np
+
+
+class FileIndex:
+    """An index of container file metadata.
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite database. Created if it doesn't exist.
+
+    Notes
+    -----
+    Each file has a record with the fields:
+
+    - `path`, `mtime`, `size`: the absolute path and the state of the file when
+      it was indexed.
+    - `clspath`: the full path of the container class.
+    - `tag`: the `tag` attribute.
+    - `lsd`: the `lsd` attribute as a list of days.
+    - `time_start`, `time_end`: the range of the time axis (as a UNIX time).
+    - `ra_start`, `ra_end`: the range of the RA axis.
+    - `freq`: the frequency centres.
+    - `ninput`, `nstack`, `nprod`: the lengths of those axes.
+
+    Any that are not present in a file are `None`.
+    """
+
+    _fields = [
+        ("path", "TEXT PRIMARY KEY"),
+        ("mtime", "REAL"),
+        ("size", "INTEGER"),
+        ("clspath", "TEXT"),
+        ("tag", "TEXT"),
+        ("lsd", "TEXT"),
+        ("time_start", "REAL"),
+        ("time_end", "REAL"),
+        ("ra_start", "REAL"),
+        ("ra_end", "REAL"),
+        ("freq", "TEXT"),
+        ("ninput", "INTEGER"),
+        ("nstack", "INTEGER"),
+        ("nprod", "INTEGER"),
+    ]
+
+    # Fields stored as JSON
+    _json_fields = ["lsd", "freq"]
+
+    def __init__(self, path):
+
+        self.path = os.path.expandvars(os.path.expanduser(path))
+
+        self._conn = sqlite3.connect(self.path, timeout=60)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS files ({})".format(
+                ", ".join(f"{name} {type_}" for name, type_ in self._fields)
+            )
+        )
+        self._conn.commit()
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, files):
+        """Add any new or modified files to the index.
+
+        Parameters
+        ----------
+        files : list of str
+            Files to index.
+
+        Returns
+        -------
+        nindexed : int
+            Number of files that needed (re)indexing.
+        """
+
+        nindexed = 0
+
+        for fname in files:
+            path = os.path.abspath(fname)
+            stat = os.stat(path)
+
+            row = self._conn.execute(
+                "SELECT mtime, size FROM files WHERE path = ?", (path,)
+            ).fetchone()
+
+            if row is not None and row[0] == stat.st_mtime and row[1] == stat.st_size:
+                continue
+
+            record = _read_metadata(path)
+            record.update(path=path, mtime=stat.st_mtime, size=stat.st_size)
+            self._insert(record)
+            nindexed += 1
+
+        self._conn.commit()
+
+        return nindexed
+
+    def get(self, fname):
+        """Get the record for a file.
+
+        Parameters
+        ----------
+        fname : str
+            The file.
+
+        Returns
+        -------
+        record : dict or None
+            The record, or `None` if the file has not been indexed or has changed
+            since it was.
+        """
+
+        path = os.path.abspath(fname)
+        cursor = self._conn.execute("SELECT * FROM files WHERE path = ?", (path,))
+        row = cursor.fetchone()
+
+        if row is None:
+            return None
+
+        record = self._to_record(cursor, row)
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+
+        if record["mtime"] != stat.st_mtime or record["size"] != stat.st_size:
+            return None
+
+        return record
+
+    def select(
+        self,
+        files=None,
+        clspath=None,
+        lsd_range=None,
+        time_range=None,
+        ra_range=None,
+        freq_range=None,
+    ):
+        """Select indexed files matching the criteria.
+
+        Files that don't have the information needed for a criterion (e.g. no
+        time axis when selecting on time) don't match it.
+
+        Parameters
+        ----------
+        files : list of str, optional
+            Only consider these files, and return them in this order. By default
+            consider all indexed files, in path order.
+        clspath : str, optional
+            Only select files of this container type.
+        lsd_range : [start, end], optional
+            Select files with an LSD within the range.
+        time_range : [start, end], optional
+            Select files whose time axis overlaps the range.
+        ra_range : [start, end], optional
+            Select files whose RA axis overlaps the range.
+        freq_range : [low, high], optional
+            Select files with any frequencies within the range.
+
+        Returns
+        -------
+        files : list of str
+            The selected files.
+        """
+
+        cursor = self._conn.execute("SELECT * FROM files ORDER BY path")
+        records = {row[0]: self._to_record(cursor, row) for row in cursor.fetchall()}
+
+        if files is not None:
+            paths = [os.path.abspath(fname) for fname in files]
+        else:
+            paths = list(records.keys())
+
+        def _within(values, range_):
+            return values is not None and any(
+                range_[0] <= v <= range_[1] for v in values
+            )
+
+        def _overlaps(start, end, range_):
+            return start is not None and start <= range_[1] and end >= range_[0]
+
+        selected = []
+        for path in paths:
+            rec = records.get(path, None)
+
+            if rec is None:
+                continue
+            if clspath is not None and rec["clspath"] != clspath:
+                continue
+            if lsd_range is not None and not _within(rec["lsd"], lsd_range):
+                continue
+            if time_range is not None and not _overlaps(
+                rec["time_start"], rec["time_end"], time_range
+            ):
+                continue
+            if ra_range is not None and not _overlaps(
+                rec["ra_start"], rec["ra_end"], ra_range
+            ):
+                continue
+            if freq_range is not None and not _within(rec["freq"], freq_range):
+                continue
+
+            selected.append(path)
+
+        return selected
+
+    def _insert(self, record):
+        # Insert or replace a record
+
+        names = [name for name, _ in self._fields]
+        values = [record.get(name) for name in names]
+        values = [
+            json.dumps(v) if name in self._json_fields else v
+            for name, v in zip(names, values)
+        ]
+
+        self._conn.execute(
+            "INSERT OR REPLACE INTO files ({}) VALUES ({})".format(
+                ", ".join(names), ", ".join("?" * len(names))
+            ),
+            values,
+        )
+
+    def _to_record(self, cursor, row):
+        # Turn a database row into a record
+
+        record = {desc[0]: value for desc, value in zip(cursor.description, row)}
+
+        for name in self._json_fields:
+            record[name] = json.loads(record[name]) if record[name] else None
+
+        return record
+
+
+def _read_metadata(path):
+    # Read the metadata of a container file
+
+    from caput import memh5
+
+    def _str(x):
+        return x.decode() if isinstance(x, bytes) else x
+
+    def _len(index_map, axis):
+        return len(index_map[axis]) if axis in index_map else None
+
+    def _range(x):
+        return (float(np.min(x)), float(np.max(x))) if len(x) else (None, None)
+
+    record = {}
+
+    with h5py.File(path, "r") as fh:
+
+        record["clspath"] = _str(memh5.MemDiskGroup._detect_subclass_path(fh))
+        record["tag"] = _str(fh.attrs.get("tag", None))
+
+        lsd = fh.attrs.get("lsd", None)
+        record["lsd"] = None if lsd is None else np.atleast_1d(lsd).tolist()
+
+        index_map = fh["index_map"] if "index_map" in fh else {}
+
+        if "time" in index_map:
+            time = index_map["time"][:]
+            if time.dtype.names and "ctime" in time.dtype.names:
+                time = time["ctime"]
+            record["time_start"], record["time_end"] = _range(time)
+
+        if "ra" in index_map:
+            record["ra_start"], record["ra_end"] = _range(index_map["ra"][:])
+
+        if "freq" in index_map:
+            freq = index_map["freq"][:]
+            if freq.dtype.names and "centre" in freq.dtype.names:
+                freq = freq["centre"]
+            record["freq"] = freq.astype(np.float64).tolist()
+
+        record["ninput"] = _len(index_map, "input")
+        record["nstack"] = _len(index_map, "stack")
+        record["nprod"] = _len(index_map, "prod")
+
+    return record
@@ -0,0 +1,203 @@
+"""Combine masks and apply them in a single pass.
+
+A :class:`MaskProduct` collects the factors of a multiplicative mask, each of
+which only spans some of the axes of the data (e.g. a per baseline flag, or a
+per frequency and time RFI mask), along with thresholds on the weights. The
+combined mask is then evaluated and applied in blocks along the first axis, so
+it never exists at the full size of the data and each block of the data is
+read and written once while it is in cache.
+
+Classes
+=======
+
+.. autosummary::
+    :toctree:
+
+    MaskProduct
+"""
+import numpy as np
+
+from . import encoding
+
+
+class MaskProduct:
+    """A multiplicative mask built from factors that broadcast against the data.
+
+    The mask `m` is applied by multiplying the weights by `m**2` and the
+    visibilities (optionally) by `m`. For boolean factors this is just zeroing
+    the masked samples.
+
+    Parameters
+    ----------
+    axes : list of str
+        The names of the axes of the data.
+    shape : tuple
+        The shape of the local section of the data.
+    """
+
+    def __init__(self, axes, shape):
+
+        self.axes = list(axes)
+        self.shape = tuple(shape)
+
+        self._factors = []
+        self._thresholds = []
+
+    def __len__(self):
+        return len(self._factors) + len(self._thresholds)
+
+    @property
+    def is_boolean(self):
+        """Whether all the factors are boolean, and so the mask only flags data."""
+        return all(f.dtype == bool for f in self._factors)
+
+    def multiply(self, axes, values):
+        """Add a factor to the mask.
+
+        Parameters
+        ----------
+        axes : list of str
+            The axes the factor spans. All must be axes of the data.
+        values : np.ndarray
+            The factor, with one dimension for each of `axes` in that order, each
+            the length of the local section of the data or 1. Boolean factors
+            are `True` for samples to keep.
+        """
+        self._factors.append(self._broadcast(axes, values))
+
+    def threshold(self, axes, values):
+        """Mask the samples with weights not above a threshold.
+
+        The thresholds are compared to the weights as they were before any of
+        the mask was applied.
+
+        Parameters
+        ----------
+        axes : list of str
+            The axes the threshold varies along.
+        values : np.ndarray
+            The threshold, with one dimension for each of `axes`.
+        """
+        self._thresholds.append(self._broadcast(axes, values))
+
+    def apply(self, weight, vis=None, attrs=None, block_size=2 ** 20):
+        """Apply the mask in place.
+
+        Parameters
+        ----------
+        weight : np.ndarray
+            The local section of the weights.
+        vis : np.ndarray, optional
+            The local section of the visibilities. If given, they are also
+            masked.
+        attrs : dict, optional
+            Attributes of the weight dataset, if the weights are compactly
+            encoded. The thresholds then use the decoded values, and only
+            boolean masks can be applied.
+        block_size : int, optional
+            Approximate size of each block of the weights in bytes. The default
+            of 1 MB is aimed at keeping a block in cache.
+
+        Returns
+        -------
+        nmasked : int
+            The number of samples masked out by the thresholds.
+        """
+        weight = np.asarray(weight)
+
+        if weight.shape != self.shape:
+            raise ValueError(
+                f"Weight shape {weight.shape} doesn't match the mask {self.shape}."
+            )
+
+        encoded = attrs is not None and attrs.get("encoding", None) is not None
+
+        if encoded and not self.is_boolean:
+            raise ValueError("Only boolean masks can be applied to encoded weights.")
+
+        row_bytes = weight.itemsize * int(np.prod(self.shape[1:]))
+        rows = max(1, block_size // max(row_bytes, 1))
+
+        nmasked = 0
+
+        for start in range(0, self.shape[0], rows):
+            sl = slice(start, min(start + rows, self.shape[0]))
+
+            wblock = weight[sl]
+            m = self._block(sl)
+
+            if self._thresholds:
+                wvalues = encoding.decode_array(wblock, attrs) if encoded else wblock
+                keep = np.ones(wblock.shape, dtype=bool)
+                for t in self._thresholds:
+                    keep &= wvalues > _rows(t, sl)
+                nmasked += int(keep.size - np.count_nonzero(keep))
+                m = keep if m is None else m * keep
+
+            if m is None:
+                continue
+
+            if m.dtype == bool:
+                wblock *= m
+                if vis is not None:
+                    vis[sl] *= m
+            else:
+                wblock *= m ** 2
+                if vis is not None:
+                    vis[sl] *= m
+
+        return nmasked
+
+    def _block(self, sl):
+        # The product of the factors for a block of rows. This only broadcasts up
+        # to the axes spanned by the factors, so is usually much smaller than the
+        # block of data.
+
+        m = None
+
+        for f in self._factors:
+            f = _rows(f, sl)
+
+            if m is None:
+                m = f
+            elif m.dtype == bool and f.dtype == bool:
+                m = m & f
+            else:
+                m = m * f
+
+        return m
+
+    def _broadcast(self, axes, values):
+        # Reshape a factor so it broadcasts against the data
+
+        axes = list(axes)
+        values = np.asarray(values)
+
+        if values.ndim != len(axes):
+            raise ValueError("Factor must have one dimension per axis.")
+
+        missing = [ax for ax in axes if ax not in self.axes]
+        if missing:
+            raise ValueError(f"Data doesn't have axes {missing}.")
+
+        # Put the axes in the order of the data, then insert the missing ones
+        order = sorted(range(len(axes)), key=lambda i: self.axes.index(axes[i]))
+        values = values.transpose(order)
+
+        shape = [1] * len(self.axes)
+        for i in order:
+            ax = self.axes.index(axes[i])
+            shape[ax] = values.shape[order.index(i)]
+
+            if shape[ax] not in (1, self.shape[ax]):
+                raise ValueError(
+                    f"Factor length {shape[ax]} along {axes[i]} doesn't match the "
+                    f"data ({self.shape[ax]})."
+                )
+
+        return values.reshape(shape)
+
+
+def _rows(arr, sl):
+    # Take a block of rows of a broadcastable array
+    return arr if arr.shape[0] == 1 else arr[sl]
@@ -4,6 +4,8 @@ from cython.parallel import prange
 import numpy as np
 cimport numpy as cnp
 
+from libc.math cimport sqrt
+
 cdef extern from "truncate.hpp":
     inline float bit_truncate_float(float val, float err) nogil
 
@@ -38,7 +40,155 @@ def bit_truncate_fixed(float[:] val, float prec):
     cdef int n = val.shape[0]
     cdef int i = 0
 
-    for i in range(n):
+    for i in prange(n, nogil=True):
         val[i] = bit_truncate_float(val[i], prec * val[i])
 
-    return np.asarray(val)
\ No newline at end of file
+    return np.asarray(val)
+
+
+cdef inline Py_ssize_t _row_offset(
+    Py_ssize_t row, Py_ssize_t[::1] shape, Py_ssize_t[::1] strides
+) nogil:
+    # Offset of the start of a row (all but the last axis) of an array with the
+    # given shape and strides
+    cdef Py_ssize_t d, offset = 0
+
+    for d in range(shape.shape[0] - 2, -1, -1):
+        offset += (row % shape[d]) * strides[d]
+        row = row // shape[d]
+
+    return offset
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _bit_truncate_weights_strided(
+    float[::1] val,
+    float[::1] wgt,
+    Py_ssize_t[::1] shape,
+    Py_ssize_t[::1] wstrides,
+    int ncomp,
+    float scale,
+    float fallback,
+):
+    # Truncate a flattened array with `ncomp` interleaved components per element,
+    # against weights addressed with element strides `wstrides`
+    cdef Py_ssize_t ndim = shape.shape[0]
+    cdef Py_ssize_t ninner = shape[ndim - 1]
+    cdef Py_ssize_t nrow = 1
+    cdef Py_ssize_t r, j, c, k, woff
+    cdef float w
+
+    for j in range(ndim - 1):
+        nrow *= shape[j]
+
+    for r in prange(nrow, nogil=True):
+        woff = _row_offset(r, shape, wstrides)
+
+        for j in range(ninner):
+            w = wgt[woff + j * wstrides[ndim - 1]] * scale
+
+            for c in range(ncomp):
+                k = (r * ninner + j) * ncomp + c
+
+                if w != 0:
+                    val[k] = bit_truncate_float(val[k], 1.0 / sqrt(w))
+                else:
+                    val[k] = bit_truncate_float(val[k], fallback * val[k])
+
+
+def _as_float_buffer(arr):
+    # Get a flat float32 view of a contiguous float32 or complex64 array, and the
+    # number of floats per element
+    if arr.dtype == np.float32:
+        ncomp = 1
+    elif arr.dtype == np.complex64:
+        ncomp = 2
+    else:
+        raise ValueError(
+            "Only float32 and complex64 arrays can be truncated. Got {}.".format(
+                arr.dtype
+            )
+        )
+
+    return arr.reshape(-1).view(np.float32), ncomp
+
+
+def bit_truncate_array(arr, float prec):
+    """Truncate a float or complex array in place to a fixed relative precision.
+
+    Complex arrays are truncated in a single pass over the interleaved real and
+    imaginary parts.
+
+    Parameters
+    ----------
+    arr : np.ndarray[float32 or complex64]
+        Array to truncate. Any shape.
+    prec : float
+        Relative precision.
+
+    Returns
+    -------
+    arr : np.ndarray
+        The truncated array.
+    """
+    if not arr.flags.c_contiguous:
+        tmp = np.ascontiguousarray(arr)
+        arr[...] = bit_truncate_array(tmp, prec)
+        return arr
+
+    buf, _ = _as_float_buffer(arr)
+    bit_truncate_fixed(buf, prec)
+
+    return arr
+
+
+def bit_truncate_array_weights(arr, wgt, float scale, float fallback):
+    """Truncate a float or complex array in place relative to weights.
+
+    Each element is truncated with a maximum error of `1 / sqrt(scale * w)` where
+    `w` is its inverse variance weight. Both parts of complex elements use the
+    same weight. Elements with zero weight are truncated to the relative
+    precision `fallback`.
+
+    Parameters
+    ----------
+    arr : np.ndarray[float32 or complex64]
+        Array to truncate. Any shape.
+    wgt : np.ndarray
+        Inverse variance weights. Must be broadcastable to the shape of `arr`.
+    scale : float
+        Scaling to apply to the weights.
+    fallback : float
+        Relative precision for elements with zero weight.
+
+    Returns
+    -------
+    arr : np.ndarray
+        The truncated array.
+    """
+    if not arr.flags.c_contiguous:
+        tmp = np.ascontiguousarray(arr)
+        arr[...] = bit_truncate_array_weights(tmp, wgt, scale, fallback)
+        return arr
+
+    # Broadcasting only creates a strided view of the weights, so the weights are
+    # never expanded in memory
+    wgt = np.ascontiguousarray(wgt, dtype=np.float32)
+    shape = (1,) if arr.ndim == 0 else arr.shape
+    wview = np.broadcast_to(wgt.reshape(wgt.shape or (1,)), shape)
+    wstrides = np.array(wview.strides, dtype=np.intp) // wgt.itemsize
+
+    buf, ncomp = _as_float_buffer(arr)
+    _bit_truncate_weights_strided(
+        buf,
+        wgt.reshape(-1),
+        np.array(shape, dtype=np.intp),
+        wstrides,
+        ncomp,
+        scale,
+        fallback,
+    )
+
+    return arr
\ No newline at end of file
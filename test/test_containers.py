@@ -76,3 +76,485 @@ def test_copy(ss_container):
 
     assert ss_copy.vis.local_shape == ss_container.vis.local_shape
     assert ss_copy.weight.local_shape == current_shape
+
+
+def test_spill(tmp_path):
+
+    containers.set_memory_budget(0, str(tmp_path))
+
+    try:
+        ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+        ss.vis[:] = np.arange(16)
+
+        # Creating another container should push the first one out to disk
+        containers.SiderealStream(axes_from=ss)
+        assert ss.is_spilled
+
+        # Accessing the data should transparently read it back
+        assert (ss.vis[:] == np.arange(16)).all()
+        assert not ss.is_spilled
+
+        # The budget should only be checked when memory is allocated, not on
+        # every access
+        budget = containers._memory_budget
+        clock = budget._clock
+        enforce = budget.enforce
+        budget.enforce = None
+        try:
+            for _ in range(3):
+                ss.vis[:]
+        finally:
+            budget.enforce = enforce
+        assert budget._clock > clock
+    finally:
+        containers.set_memory_budget(None)
+
+
+def test_chunked_write(tmp_path_factory):
+
+    from caput import mpiutil
+
+    dirname = None
+    if mpiutil.rank0:
+        dirname = str(tmp_path_factory.mktemp("chunked"))
+    fname = mpiutil.bcast(dirname, root=0) + "/ss.h5"
+
+    ss = containers.SiderealStream(
+        stack=5, input=3, ra=16, freq=np.linspace(800.0, 750.0, 5), allow_chunked=True
+    )
+    ss.vis[:] = np.arange(16) + 1.0j * ss.vis.local_offset[0]
+    ss.weight[:] = 2.0
+    ss.save(fname)
+
+    ss_load = containers.SiderealStream.from_file(fname, distributed=True)
+
+    assert (ss_load.vis[:] == ss.vis[:]).all()
+    assert (ss_load.weight[:] == 2.0).all()
+    assert tuple(ss_load.vis.attrs["axis"]) == ("freq", "stack", "ra")
+
+
+def test_coalesce_index():
+
+    runs = containers._coalesce_index([1, 2, 3, 7, 9, 11, 4])
+    assert [r[1] for r in runs] == [slice(1, 4, 1), slice(7, 12, 2), slice(4, 5, 1)]
+    assert [r[0] for r in runs] == [slice(0, 3), slice(3, 6), slice(6, 7)]
+
+
+def test_memmap(tmp_path_factory):
+
+    from caput import mpiutil
+
+    dirname = None
+    if mpiutil.rank0:
+        dirname = str(tmp_path_factory.mktemp("memmap"))
+    fname = mpiutil.bcast(dirname, root=0) + "/ss.h5"
+
+    ss = containers.SiderealStream(
+        stack=5, input=3, ra=16, freq=np.linspace(800.0, 750.0, 5)
+    )
+    ss.vis[:] = np.arange(16) + 1.0j * ss.vis.local_offset[0]
+    ss.save(fname)
+
+    ss_load = containers.SiderealStream.from_file(
+        fname, distributed=True, memmap=True, ra_sel=slice(2, 10)
+    )
+
+    # The data should be read-only views of the file
+    assert not ss_load.vis[:].flags.writeable
+    assert (ss_load.vis[:] == ss.vis[:][..., 2:10]).all()
+    assert (ss_load.index_map["ra"] == ss.index_map["ra"][2:10]).all()
+
+    # The extra options are keyword only, so positional arguments still follow
+    # memh5.BasicCont.from_file
+    with pytest.raises(TypeError):
+        containers.SiderealStream.from_file(fname, False, True, None, True)
+
+
+def test_lazy(tmp_path_factory):
+
+    from caput import mpiutil
+
+    dirname = None
+    if mpiutil.rank0:
+        dirname = str(tmp_path_factory.mktemp("lazy"))
+    fname = mpiutil.bcast(dirname, root=0) + "/ss.h5"
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5)
+    ss.add_dataset("gain")
+    ss.vis[:] = np.arange(16) + 1.0j * ss.vis.local_offset[0]
+    ss.weight[:] = 2.0
+    ss.save(fname)
+
+    ss_load = containers.SiderealStream.from_file(
+        fname, distributed=True, lazy=True, exclude_datasets=["gain"]
+    )
+
+    # Excluded datasets shouldn't be there at all, and the others should only be
+    # read when accessed
+    assert "gain" not in ss_load.datasets
+    assert set(ss_load._lazy) == {"vis", "vis_weight"}
+
+    assert (ss_load.vis[:] == ss.vis[:]).all()
+    assert set(ss_load._lazy) == {"vis_weight"}
+
+    # Copying the container should read everything
+    ss_copy = ss_load.copy()
+    assert not ss_load.is_lazy
+    assert (ss_copy.weight[:] == 2.0).all()
+
+
+def test_schema_cache():
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5)
+
+    # The class schema should be resolved once and shared
+    assert ss._schema is containers.SiderealStream._class_schema()
+    assert ss.axes == ("freq", "input", "prod", "ra", "stack")
+    assert list(ss.dataset_spec) == sorted(ss.dataset_spec)
+
+    # Setting an instance level spec should invalidate the instance schema
+    spec = {"extra": {"axes": ["ra"], "dtype": np.float64, "distributed": False}}
+    ss._dataset_spec = spec
+    assert "extra" in ss.dataset_spec
+    assert "extra" not in containers.SiderealStream._class_schema().dataset_spec
+
+    # The cached datasets should track creations and deletions
+    assert "extra" not in ss.datasets
+    ss.add_dataset("extra")
+    assert "extra" in ss.datasets
+    del ss["extra"]
+    assert "extra" not in ss.datasets
+
+
+def test_copy_on_write():
+
+    from draco.util import cow
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5)
+    ss.vis[:] = np.arange(16) + 1.0j * ss.vis.local_offset[0]
+    ss.weight[:] = 1.0
+
+    copies = [ss.copy(copy_on_write=True) for _ in range(3)]
+
+    # Everything should now map the same memory
+    buffer = cow.buffer_of(ss.vis[:].view(np.ndarray))
+    assert buffer is not None
+    for c in copies:
+        assert cow.buffer_of(c.vis[:].view(np.ndarray)) is buffer
+
+    # Writes shouldn't leak between the copies and the original
+    copies[0].vis[:] = 0.0
+    copies[1].weight[:] *= 2.0
+    assert (ss.vis[:] == copies[2].vis[:]).all()
+    assert (copies[0].vis[:] == 0.0).all()
+    assert (ss.weight[:] == 1.0).all()
+    assert (copies[1].weight[:] == 2.0).all()
+
+
+def test_buffer_pool():
+
+    import gc
+
+    pool = containers.BufferPool()
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5, pool=pool)
+    ss.vis[:] = 1.0
+    vis_id = id(ss.vis[:].base)
+
+    # Deleting the container should return its arrays to the pool
+    del ss
+    gc.collect()
+    assert pool.nbytes > 0
+
+    # A new container of the same shape should reuse them, zeroed
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5, pool=pool)
+    assert id(ss.vis[:].base) == vis_id
+    assert (ss.vis[:] == 0.0).all()
+
+    # Arrays that are still referenced elsewhere must not be reused
+    vis = ss.vis[:]
+    del ss
+    gc.collect()
+    assert pool.nbytes > 0
+    assert all(free is not vis.base for _, free in pool._free)
+
+    # Nor should datasets shared with a copy of the container
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5, pool=pool)
+    ss.vis[:] = 2.0
+    ss_copy = ss.copy(shared=("vis",))
+    shared_id = id(ss_copy.vis[:].base)
+    del ss
+    gc.collect()
+    assert all(id(free) != shared_id for _, free in pool._free)
+    assert (ss_copy.vis[:] == 2.0).all()
+
+    # A new container from the pool must not be given the shared array
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5, pool=pool)
+    ss.vis[:] = 3.0
+    assert (ss_copy.vis[:] == 2.0).all()
+
+
+def test_blocked_redistribute():
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=6)
+    ss.redistribute("freq")
+
+    vis = ss.vis[:]
+    vis[:] = (
+        np.arange(vis.local_offset[0], vis.local_offset[0] + vis.shape[0])[
+            :, np.newaxis, np.newaxis
+        ]
+        + 1j * np.arange(16)[np.newaxis, np.newaxis, :]
+    )
+    ss.weight[:] = 1.0
+
+    ref = ss.copy()
+    ref.redistribute("ra")
+
+    ref_vis = ref.vis[:]
+    offset = ref_vis.local_offset[2]
+
+    # Iterating in blocks should give the same data as a full redistribution
+    ra = []
+    for (start, end), (vis_block, weight_block) in ss.iter_redistribute(
+        ["vis", "vis_weight"], "ra", block_size=100
+    ):
+        ra += range(start, end)
+        assert (vis_block == ref_vis[..., start - offset : end - offset]).all()
+        assert (weight_block == 1.0).all()
+
+    assert ra == list(range(offset, offset + ref_vis.shape[2]))
+    assert ss.vis.distributed_axis == 0
+
+    # Encoded datasets can't be used in blocks
+    encoded = ss.copy()
+    encoded.encode_dataset("vis_weight", "log8")
+    with pytest.raises(ValueError):
+        next(encoded.iter_redistribute(["vis", "vis_weight"], "ra"))
+
+    # As should redistributing in blocks
+    ss.redistribute("ra", block_size=100)
+    assert ss.vis.distributed_axis == 2
+    assert (ss.vis[:] == ref.vis[:]).all()
+
+
+def test_redistribute_groups():
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+    ss.create_group("extra")
+    dset = ss.create_dataset(
+        "extra/vis", shape=(4, 16), dtype=np.float64, distributed=True
+    )
+    dset.attrs["axis"] = np.array(["freq", "ra"])
+
+    # Datasets within groups should be redistributed too
+    ss.redistribute("ra")
+    assert ss.vis.distributed_axis == 2
+    assert ss["extra/vis"].distributed_axis == 1
+
+
+def test_rebind_comm():
+
+    from mpi4py import MPI
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+    ss.vis[:] = np.arange(16)
+    vis = ss.vis[:]
+    comm = ss.comm
+
+    # Everything, including datasets within groups, should be moved without
+    # copying the data
+    dup = comm.Dup()
+    try:
+        assert containers.rebind_comm(ss, dup) is comm
+        assert ss.comm is dup
+        assert all(d.comm is dup for d in ss.datasets.values() if d.distributed)
+        assert np.shares_memory(ss.vis[:], vis)
+
+        # Collective operations should then use the new communicator
+        ss.redistribute("ra")
+        assert ss.vis.comm is dup
+        local = ss.vis[:]
+        start, n = local.local_offset[2], local.local_shape[2]
+        assert (local == np.arange(start, start + n)).all()
+        ss.redistribute("freq")
+
+        containers.rebind_comm(ss, comm)
+        assert ss.comm is comm
+        assert MPI.Comm.Compare(ss.vis.comm, comm) == MPI.IDENT
+    finally:
+        dup.Free()
+
+
+def test_encode_dataset(ss_container):
+
+    rng = np.random.default_rng(0)
+    weight = rng.uniform(1.0, 100.0, ss_container.weight.local_shape)
+    weight[0] = 0.0
+    ss_container.weight[:] = weight
+
+    ss_container.encode_dataset("vis_weight", "log16")
+
+    # The codes shouldn't be given out as weights
+    with pytest.raises(ValueError):
+        ss_container.weight
+
+    weight_dset = ss_container.datasets["vis_weight"]
+    assert weight_dset.dtype == np.uint16
+    assert weight_dset.attrs["test_attr3"] == "hello3"
+
+    # Check the error is within the advertised bound, and zeros are exact
+    bound = weight_dset.attrs["max_rel_error"]
+    ss_container.decode_dataset("vis_weight")
+    decoded = ss_container.weight[:].view(np.ndarray)
+    assert (decoded[0] == 0.0).all()
+    assert (np.abs(decoded[1:] / weight[1:] - 1) <= bound * (1 + 1e-6)).all()
+    assert "encoding" not in ss_container.weight.attrs
+
+
+def test_pack_mask():
+
+    mask = containers.RFIMask(freq=4, time=21, distributed=False)
+    mask.mask[:] = np.random.default_rng(0).random((4, 21)) > 0.5
+    orig = mask.mask[:].copy()
+
+    mask.encode_dataset("mask", "bitpack")
+    assert mask.datasets["mask"].shape == (4, 3)
+
+    mask.decode_dataset("mask")
+    assert (mask.mask[:] == orig).all()
+
+
+def test_copy_encoded(ss_container):
+
+    ss_container.weight[:] = np.arange(1.0, 17.0)
+    ss_container.encode_dataset("vis_weight", "log8")
+    codes = ss_container.datasets["vis_weight"][:].view(np.ndarray).copy()
+
+    mask = containers.RFIMask(freq=4, time=21, distributed=False)
+    mask.mask[:] = np.random.default_rng(0).random((4, 21)) > 0.5
+    orig = mask.mask[:].copy()
+    mask.encode_dataset("mask", "bitpack")
+
+    # The codes should be copied as they are, not cast to the type of the spec
+    ss_copy = ss_container.copy()
+    weight_dset = ss_copy.datasets["vis_weight"]
+    assert weight_dset.dtype == np.uint8
+    assert weight_dset.distributed_axis == 0
+    assert (weight_dset[:].view(np.ndarray) == codes).all()
+    assert weight_dset.attrs["encoding"] == "log8"
+
+    # Packed masks should keep their packed shape
+    mask_copy = mask.copy()
+    assert mask_copy.datasets["mask"].shape == (4, 3)
+    mask_copy.decode_dataset("mask")
+    assert (mask_copy.mask[:] == orig).all()
+
+
+def test_encoded_file(tmp_path_factory):
+
+    from caput import mpiutil
+
+    dirname = None
+    if mpiutil.rank0:
+        dirname = str(tmp_path_factory.mktemp("encoded"))
+    dirname = mpiutil.bcast(dirname, root=0)
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=5)
+    ss.weight[:] = np.arange(1.0, 17.0)
+    weight = ss.weight[:].view(np.ndarray).copy()
+    ss.encode_dataset("vis_weight", "log8")
+    bound = ss.datasets["vis_weight"].attrs["max_rel_error"]
+    ss.save(dirname + "/ss.h5")
+
+    mask = containers.RFIMask(freq=4, time=21, distributed=False)
+    mask.mask[:] = np.random.default_rng(0).random((4, 21)) > 0.5
+    orig = mask.mask[:].copy()
+    mask.encode_dataset("mask", "bitpack")
+    if mpiutil.rank0:
+        mask.save(dirname + "/mask.h5")
+    mpiutil.barrier()
+
+    # The encoded weights should be read as they are in the file, and decode back
+    # to the original values for each way of reading them in
+    for kwargs, ra in [
+        ({"lazy": True}, slice(None)),
+        ({"datasets": ["vis_weight"]}, slice(None)),
+        ({"ra_sel": [1, 3, 5]}, [1, 3, 5]),
+    ]:
+        ss_load = containers.SiderealStream.from_file(
+            dirname + "/ss.h5", distributed=True, **kwargs
+        )
+        assert ss_load.datasets["vis_weight"].dtype == np.uint8
+
+        ss_load.decode_dataset("vis_weight")
+        decoded = ss_load.weight[:].view(np.ndarray)
+        assert (np.abs(decoded / weight[..., ra] - 1) <= bound * (1 + 1e-6)).all()
+
+    # Packed masks keep their packed shape, and can be selected along any axis
+    # except the packed one
+    mask_load = containers.RFIMask.from_file(
+        dirname + "/mask.h5", distributed=False, lazy=True, freq_sel=slice(1, 3)
+    )
+    assert mask_load.datasets["mask"].shape == (2, 3)
+
+    mask_load.decode_dataset("mask")
+    assert (mask_load.mask[:] == orig[1:3]).all()
+
+    with pytest.raises(ValueError):
+        containers.RFIMask.from_file(
+            dirname + "/mask.h5", distributed=False, lazy=True, time_sel=slice(0, 8)
+        )
+
+
+def test_process_grid(tmp_path, monkeypatch):
+
+    from caput import mpiutil
+    from draco.util import decomp
+
+    ngroup = 2 if mpiutil.size % 2 == 0 else 1
+    grid = decomp.process_grid(ngroup)
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=6)
+    ss.redistribute("freq")
+    vis = ss.vis[:]
+    vis[:] = (
+        np.arange(vis.local_offset[0], vis.local_offset[0] + vis.shape[0])[
+            :, np.newaxis, np.newaxis
+        ]
+        + 1j * np.arange(5)[np.newaxis, :, np.newaxis]
+    )
+    ss.weight[:] = 1.0
+
+    sub = grid.scatter(ss, "stack")
+
+    # Each group should hold its range of stacks, distributed over freq
+    start, end = grid.axis_range(5)
+    assert (sub.stack == ss.stack[start:end]).all()
+    assert sub.vis.comm.size == mpiutil.size // ngroup
+    assert decomp.global_shape(sub, "vis") == ss.vis.global_shape
+    assert not sub.is_stacked
+
+    fstart, fend = decomp.tile(sub, "vis")[0]
+    assert (sub.vis[:].real == np.arange(fstart, fend)[:, None, None]).all()
+    assert (sub.vis[:].imag == np.arange(start, end)[None, :, None]).all()
+
+    bi = [b for _, b in decomp.enumerate_axis(sub, "vis", 1)]
+    assert bi == list(range(start, end))
+
+    # Each group only has part of the data, so it shouldn't be saved
+    with pytest.raises(ValueError):
+        sub.save(str(tmp_path / "sub.h5"))
+
+    # Exchanging in many small rounds should give the same result
+    monkeypatch.setattr(decomp, "_MAX_EXCHANGE_BYTES", 64)
+    sub_rounds = grid.scatter(ss, "stack")
+    assert (sub_rounds.vis[:] == sub.vis[:]).all()
+
+    # Recombining should give back the original
+    full = grid.gather(sub)
+    full.redistribute("freq")
+    assert not decomp.is_decomposed(full)
+    assert (full.stack == ss.stack).all()
+    assert (full.vis[:] == ss.vis[:]).all()
+    assert (full.weight[:] == 1.0).all()
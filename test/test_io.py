@@ -1,3 +1,4 @@
+import os
 import pathlib
 import numpy as np
 import pytest
@@ -110,3 +111,286 @@ def test_LoadBasicCont_selection(ss_container, mpi_tmp_path):
     # As we only put one item into the queue, this should end the iterations
     with pytest.raises(pipeline.PipelineStopIteration):
         task.next()
+
+
+def test_LoadBasicCont_prefetch(ss_container, mpi_tmp_path):
+
+    fnames = [str(mpi_tmp_path / f"ss_{ii}.h5") for ii in range(3)]
+    for fname in fnames:
+        ss_container.save(fname)
+
+    task = io.LoadBasicCont()
+    task.files = list(fnames)
+    task.prefetch = 2
+
+    task.setup()
+
+    # The files should come out in order with the right contents
+    for fname in fnames:
+        ss_load = task.next()
+        assert ss_load.attrs["tag"] == pathlib.Path(fname).stem
+        assert (ss_load.vis[:] == ss_container.vis[:]).all()
+
+        # They should be moved onto the task's communicator
+        assert ss_load.comm is task.comm
+        assert ss_load.vis[:].comm is task.comm
+
+    with pytest.raises(pipeline.PipelineStopIteration):
+        task.next()
+
+
+def test_LoadBasicCont_distributed_index(ss_container, mpi_tmp_path):
+
+    # Add a distributed dataset that isn't in the container's spec
+    extra = ss_container.create_dataset(
+        "extra", shape=(5, 16), dtype=np.float64, distributed=True, distributed_axis=0
+    )
+    extra.attrs["axis"] = np.array(["freq", "ra"])
+    freq_local = extra.local_offset[0] + np.arange(extra.local_shape[0])
+    extra[:] = freq_local[:, np.newaxis]
+
+    fname = str(mpi_tmp_path / "ss.h5")
+    ss_container.save(fname)
+
+    freq_index = [0, 2, 3, 4]
+    ra_index = [1, 2, 3, 7, 9, 11]
+
+    task = io.LoadBasicCont()
+    task.files = [fname]
+    task.selections = {"freq_index": freq_index, "ra_index": ra_index}
+
+    task.setup()
+    ss_load = task.next()
+
+    assert ss_load.vis.distributed
+    assert ss_load.vis.global_shape == (4, 5, 6)
+    assert (ss_load.index_map["ra"] == ss_container.index_map["ra"][ra_index]).all()
+
+    # Check the data on each rank came from the right place
+    n, s, e = mpiutil.split_local(len(freq_index), comm=ss_load.comm)
+    vis = ss_load.vis[:]
+    vis_real = np.array(freq_index)[s:e][:, np.newaxis, np.newaxis]
+    assert (vis.real == vis_real).all()
+    assert (vis.imag == np.array(ra_index)[np.newaxis, np.newaxis, :]).all()
+    assert ss_load.vis.attrs["test_attr2"] == "hello2"
+
+    # Distributed datasets outside the spec should only have their local section
+    # read
+    extra = ss_load["extra"]
+    assert extra.distributed
+    assert extra.global_shape == (4, 6)
+    assert (extra[:] == np.array(freq_index)[s:e][:, np.newaxis]).all()
+
+
+def test_LoadBasicCont_lazy_nan_check(ss_container, mpi_tmp_path):
+
+    fname = str(mpi_tmp_path / "ss.h5")
+    ss_container.vis[:] = np.nan
+    ss_container.save(fname)
+
+    # The NaN check should read in the lazily loaded data and find the NaN's in
+    # it, rather than checking the unread placeholders
+    task = io.LoadBasicCont()
+    task.files = [fname]
+    task.lazy = True
+    task.nan_dump = False
+    task.nan_skip = True
+
+    task.setup()
+    assert task.next() is None
+
+
+def test_SelectFiles(ss_container, mpi_tmp_path):
+
+    fnames = [str(mpi_tmp_path / f"ss_{ii}.h5") for ii in range(3)]
+    for lsd, fname in enumerate(fnames):
+        ss_container.attrs["lsd"] = lsd
+        ss_container.save(fname)
+
+    task = io.SelectFiles()
+    task.files = list(fnames)
+    task.index = str(mpi_tmp_path / "index.db")
+    task.container = "draco.core.containers.SiderealStream"
+    task.lsd_range = [1, 2]
+
+    selected = task.setup()
+    assert [pathlib.Path(f).name for f in selected] == ["ss_1.h5", "ss_2.h5"]
+
+    # Nothing has changed, so the index should be reused and give the same result
+    assert task.setup() == selected
+
+    # Selecting on frequencies outside the band gives nothing
+    task.lsd_range = None
+    task.freq_range = [400.0, 500.0]
+    assert task.setup() == []
+
+
+def _write_catalog(fname, ra, dec, z):
+    # Write a minimal catalog file on the first rank
+    from astropy.io import fits
+
+    if mpiutil.rank0:
+        cols = [
+            fits.Column(name=name, format="D", array=arr)
+            for name, arr in [("RA", ra), ("DEC", dec), ("Z", z)]
+        ]
+        fits.BinTableHDU.from_columns(cols).writeto(fname, overwrite=True)
+    mpiutil.barrier()
+
+
+def test_LoadFITSCatalog(mpi_tmp_path):
+
+    pytest.importorskip("astropy")
+
+    rng = np.random.default_rng(0)
+    positions = [rng.uniform(0.0, 1.0, (3, n)) for n in [5, 0, 7, 3]]
+
+    fnames = [str(mpi_tmp_path / f"cat_{ii}.fits") for ii in range(len(positions))]
+    for fname, pos in zip(fnames, positions):
+        _write_catalog(fname, *pos)
+
+    def load(cache_dir=None):
+        task = io.LoadFITSCatalog()
+        task.catalogs = [{"tag": "cat", "files": list(fnames)}]
+        task.z_range = [0.2, 0.8]
+        task.cache_dir = cache_dir
+        return task.process()
+
+    def check(catalog, positions):
+        # The catalog should match a serial read of the files, in order
+        ref = np.concatenate(positions, axis=-1)
+        ref = ref[:, (ref[2] >= 0.2) & (ref[2] <= 0.8)]
+        assert (catalog["position"]["ra"][:] == ref[0]).all()
+        assert (catalog["position"]["dec"][:] == ref[1]).all()
+        assert (catalog["redshift"]["z"][:] == ref[2]).all()
+
+    check(load(), positions)
+
+    # Loading again should use the cache, and give the same result
+    cache_dir = str(mpi_tmp_path / "cache")
+    check(load(cache_dir), positions)
+    check(load(cache_dir), positions)
+
+    # A catalog newer than its cached copy should be read again
+    positions[2] = rng.uniform(0.0, 1.0, (3, 4))
+    _write_catalog(fnames[2], *positions[2])
+    if mpiutil.rank0:
+        cache_file = io._cache_path(cache_dir, fnames[2], ".radecz.npy")
+        mtime = pathlib.Path(cache_file).stat().st_mtime
+        os.utime(fnames[2], (mtime + 10, mtime + 10))
+    mpiutil.barrier()
+    check(load(cache_dir), positions)
+
+
+@pytest.mark.parametrize("prefetch", [False, True])
+def test_LoadMaps(mpi_tmp_path, monkeypatch, prefetch):
+
+    fnames = [str(mpi_tmp_path / f"map_{ii}.h5") for ii in range(3)]
+
+    for ii, fname in enumerate(fnames):
+        m = containers.Map(nside=2, freq=np.linspace(800.0, 700.0, 6))
+        rng = np.random.default_rng([ii, m.map.local_offset[0]])
+        m.map[:] = rng.standard_normal(m.map.local_shape)
+        m.save(fname)
+
+    # Load the maps in full and add them up to compare against
+    ref = containers.Map.from_file(fnames[0], distributed=True)
+    ref.redistribute("freq")
+    for fname in fnames[1:]:
+        m = containers.Map.from_file(fname, distributed=True)
+        m.redistribute("freq")
+        ref.map[:] += m.map[:]
+
+    # Use blocks of one frequency, so each map is read in several blocks
+    row_bytes = ref.map.dtype.itemsize * int(np.prod(ref.map.local_shape[1:]))
+    monkeypatch.setattr(io, "_MAP_BLOCK_SIZE", row_bytes)
+
+    task = io.LoadMaps()
+    task.maps = [{"tag": "maps", "files": list(fnames)}]
+    task.prefetch = prefetch
+
+    stack = task.next()
+
+    assert stack.attrs["tag"] == "maps"
+    assert np.allclose(stack.map[:], ref.map[:])
+
+    with pytest.raises(pipeline.PipelineStopIteration):
+        task.next()
+
+
+def test_prefetch_stop():
+
+    import threading
+
+    def _items():
+        for ii in range(100):
+            yield ii
+
+    # Stopping early shouldn't leave the worker blocked on the full queue, and
+    # the iterable should be closed
+    nthread = threading.active_count()
+    items = _items()
+    prefetched = io._prefetch(items, depth=2)
+    assert next(prefetched) == 0
+    prefetched.close()
+
+    assert threading.active_count() == nthread
+    assert items.gi_frame is None
+
+    # Errors while iterating are raised in the caller
+    def _fail():
+        yield 0
+        raise ValueError("Failed.")
+
+    with pytest.raises(ValueError):
+        list(io._prefetch(_fail()))
+
+
+def test_Truncate(ss_container):
+
+    from draco.util.truncate import bit_truncate_fixed, bit_truncate_weights
+
+    rng = np.random.default_rng(ss_container.vis.local_offset[0])
+    shape = ss_container.vis.local_shape
+    vis = rng.standard_normal(shape) + 1.0j * rng.standard_normal(shape)
+    weight = rng.uniform(0.0, 10.0, shape)
+    weight[weight < 1.0] = 0.0
+
+    ss_container.vis[:] = vis
+    ss_container.weight[:] = weight
+
+    # Truncate a copy one component at a time, as was done before the array
+    # kernels, to compare against
+    vis = ss_container.vis[:].view(np.ndarray).copy()
+    weight = ss_container.weight[:].view(np.ndarray).copy()
+    invvar = weight.reshape(-1) * 2.0 / (3 * 1e-3)
+    flat = vis.reshape(-1)
+    vis.real = bit_truncate_weights(flat.real, invvar, 1e-4).reshape(shape)
+    vis.imag = bit_truncate_weights(flat.imag, invvar, 1e-4).reshape(shape)
+    weight = bit_truncate_fixed(weight.reshape(-1), 1e-4).reshape(shape)
+
+    task = io.Truncate()
+    ss_trunc = task.process(ss_container)
+
+    # The results should be bit identical
+    trunc_vis = ss_trunc.vis[:].view(np.ndarray)
+    trunc_weight = ss_trunc.weight[:].view(np.ndarray)
+    assert (trunc_vis.view(np.uint32) == vis.view(np.uint32)).all()
+    assert (trunc_weight.view(np.uint32) == weight.view(np.uint32)).all()
+
+
+def test_Truncate_encode():
+
+    mask = containers.RFIMask(freq=4, time=21, distributed=False)
+    mask.mask[:] = np.random.default_rng(0).random((4, 21)) > 0.5
+    orig = mask.mask[:].copy()
+
+    # By default RFI masks should be left as plain boolean masks
+    mask = io.Truncate().process(mask)
+    assert (mask.mask[:] == orig).all()
+
+    # Packing them has to be asked for
+    task = io.Truncate()
+    task.encode = {"mask": "bitpack"}
+    mask = task.process(mask)
+    assert mask.datasets["mask"].shape == (4, 3)
@@ -0,0 +1,161 @@
+import numpy as np
+import pytest
+
+from draco.util import masking
+
+
+def test_mask_product():
+
+    rng = np.random.default_rng(12)
+
+    weight = rng.uniform(size=(7, 5, 16))
+    vis = rng.standard_normal((7, 5, 16)) + 1.0j
+    weight_ref = weight.copy()
+    vis_ref = vis.copy()
+
+    baseline = np.array([True, False, True, True, True])
+    rfi = rng.uniform(size=(16, 7)) > 0.2
+    taper = np.linspace(0.0, 1.0, 16)
+    threshold = np.full(5, 0.3)
+
+    mask = masking.MaskProduct(["freq", "stack", "ra"], weight.shape)
+    mask.multiply(["stack"], baseline)
+    mask.multiply(["ra", "freq"], rfi)
+    mask.multiply(["ra"], taper)
+    mask.threshold(["stack"], threshold)
+
+    # Use small blocks so the data is processed in several of them
+    nmasked = mask.apply(weight, vis=vis, block_size=200)
+
+    keep = weight_ref > 0.3
+    m = baseline[None, :, None] * rfi.T[:, None, :] * taper[None, None, :] * keep
+
+    assert nmasked == np.sum(~keep)
+    assert np.allclose(weight, weight_ref * m ** 2)
+    assert np.allclose(vis, vis_ref * m)
+
+
+def test_mask_product_encoded():
+
+    from draco.util import encoding
+
+    weight = np.linspace(0.0, 1.0, 60).reshape(3, 4, 5)
+    codes, attrs = encoding.encode_log(weight, bits=8)
+
+    mask = masking.MaskProduct(["freq", "stack", "time"], weight.shape)
+    mask.threshold(["stack"], np.full(4, 0.5))
+    mask.apply(codes, attrs=attrs)
+
+    # Codes for weights below the threshold should be zeroed exactly
+    assert (codes[weight < 0.49] == 0).all()
+    assert (codes[weight > 0.51] > 0).all()
+
+    # Non-boolean masks can't be applied to encoded weights
+    mask.multiply(["time"], np.linspace(0.0, 1.0, 5))
+    with pytest.raises(ValueError):
+        mask.apply(codes, attrs=attrs)
+
+
+def test_apply_masks():
+
+    from types import SimpleNamespace
+
+    from draco.analysis import flagging
+    from draco.core import containers
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=6)
+    ss.redistribute("freq")
+
+    vis = ss.vis[:]
+    rng = np.random.default_rng(vis.local_offset[0])
+    vis[:] = rng.standard_normal(vis.shape) + 1j * rng.standard_normal(vis.shape)
+    ss.weight[:] = rng.uniform(0.0, 2.0, size=vis.shape)
+
+    telescope = SimpleNamespace(
+        baselines=np.array(
+            [[0.0, 0.0], [0.0, 10.0], [20.0, 5.0], [20.0, 30.0], [40.0, 0.0]]
+        )
+    )
+
+    ref = ss.copy()
+
+    # Run the masks one after another
+    mask_baselines = flagging.MaskBaselines()
+    mask_baselines.telescope = telescope
+    mask_baselines.mask_short = 5.0
+    mask_baselines.mask_long_ns = 20.0
+
+    threshold = flagging.ThresholdVisWeight()
+    threshold.absolute_threshold = 0.1
+    threshold.relative_threshold = 0.5
+
+    day = flagging.DayMask()
+    day.zero_data = False
+    day.remove_average = False
+
+    ref = mask_baselines.process(ref)
+    ref = threshold.process(ref)
+    ref = day.process(ref)
+    ref.redistribute("freq")
+
+    # And all at once. The per baseline threshold is calculated with the data
+    # distributed over frequency rather than baselines
+    task = flagging.ApplyMasks()
+    task.setup()
+    task.telescope = telescope
+    task.mask_short = 5.0
+    task.mask_long_ns = 20.0
+    task.absolute_threshold = 0.1
+    task.relative_threshold = 0.5
+    task.day_start = 90.0
+    task.day_end = 270.0
+
+    out = task.process(ss)
+    assert out.vis.distributed_axis == 0
+
+    weight = out.weight[:].view(np.ndarray)
+    ref_weight = ref.weight[:].view(np.ndarray)
+
+    assert ((weight == 0.0) == (ref_weight == 0.0)).all()
+    assert np.allclose(weight, ref_weight)
+    assert (weight[:, [0, 3]] == 0.0).all()
+    assert (out.vis[:] == ref.vis[:]).all()
+
+
+def test_apply_masks_rfi():
+
+    from draco.analysis import flagging
+    from draco.core import containers
+
+    ts = containers.TimeStream(stack=5, input=3, time=16, freq=6)
+    ts.redistribute("freq")
+
+    weight = ts.weight[:]
+    rng = np.random.default_rng(weight.local_offset[0])
+    weight[:] = rng.uniform(0.0, 2.0, size=weight.shape)
+
+    rfimask = containers.RFIMask(freq=6, time=16, distributed=False)
+    rfimask.mask[:] = np.random.default_rng(1).uniform(size=(6, 16)) > 0.7
+
+    ref = ts.copy()
+
+    # Run the masks one after another
+    threshold = flagging.ThresholdVisWeight()
+    threshold.absolute_threshold = 0.1
+    threshold.relative_threshold = 0.0
+
+    ref = threshold.process(ref)
+    ref = flagging.ApplyRFIMask().process(ref, rfimask)
+
+    # And all at once
+    task = flagging.ApplyMasksRFI()
+    task.setup()
+    task.absolute_threshold = 0.1
+
+    out = task.process(ts, rfimask)
+
+    weight = out.weight[:].view(np.ndarray)
+    ref_weight = ref.weight[:].view(np.ndarray)
+
+    assert ((weight == 0.0) == (ref_weight == 0.0)).all()
+    assert np.allclose(weight, ref_weight)
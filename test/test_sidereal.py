@@ -0,0 +1,51 @@
+import numpy as np
+
+from caput.time import Observer
+
+from draco.analysis.sidereal import SiderealGrouper
+from draco.core import containers
+
+
+def _group(files, observer, incremental):
+    # Run the files through a grouper and return the days it outputs
+
+    grouper = SiderealGrouper()
+    grouper.observer = observer
+    grouper.incremental = incremental
+
+    days = [grouper.process(ts) for ts in files()]
+    days.append(grouper.process_finish())
+
+    return [day for day in days if day is not None]
+
+
+def test_incremental_grouper():
+
+    observer = Observer()
+    t0 = observer.lsd_to_unix(100.5)
+    dt = 600.0
+
+    def files():
+        # Files of 4 hours, running across the end of LSD 100 into LSD 101
+        for i in range(6):
+            time = t0 + dt * np.arange(24 * i, 24 * (i + 1))
+            ts = containers.TimeStream(freq=4, input=3, stack=5, time=time)
+            ts.vis[:] = time[np.newaxis, np.newaxis, :]
+            ts.weight[:] = 1.0
+            yield ts
+
+    concatenated = _group(files, observer, False)
+    incremental = _group(files, observer, True)
+
+    assert len(incremental) == len(concatenated)
+
+    for cat, inc in zip(concatenated, incremental):
+        assert inc.attrs["lsd"] == cat.attrs["lsd"]
+
+        # The incremental day is on a regular grid running to the end of the LSD,
+        # and should match wherever there is data
+        ntime = min(len(inc.time), len(cat.time))
+        assert np.allclose(inc.time[:ntime], cat.time[:ntime])
+        assert (inc.vis[:][..., :ntime] == cat.vis[:][..., :ntime]).all()
+        assert (inc.weight[:][..., :ntime] == 1.0).all()
+        assert (inc.weight[:][..., ntime:] == 0.0).all()
@@ -0,0 +1,352 @@
+import json
+
+import numpy as np
+
+from caput import pipeline
+
+from draco.core import task
+
+
+def test_trace(tmp_path):
+    """Check that traced tasks write a Chrome trace file."""
+
+    trace_file = str(tmp_path / "trace.json")
+
+    testconfig = """
+    pipeline:
+        tasks:
+            - type: draco.util.testing.DummyTask
+              params:
+                tag: trace
+                total_len: 3
+                trace: Yes
+                trace_file: {}
+    """.format(
+        trace_file
+    )
+
+    man = pipeline.Manager.from_yaml_str(testconfig)
+    man.run()
+
+    with open(trace_file, "r") as fh:
+        trace = json.load(fh)
+
+    # There should be one event per call to process, plus the phases within it
+    calls = [ev for ev in trace["traceEvents"] if ev["cat"] == "task"]
+    assert len(calls) == 3
+    assert all(ev["name"] == "DummyTask.process" for ev in calls)
+    assert "barrier_time" in calls[0]["args"]
+
+    summary = trace["otherData"]["summary"]["DummyTask"]
+    assert [s["count"] for s in summary] == [0, 1, 2]
+    assert summary[0]["wall"]["min"] <= summary[0]["wall"]["max"]
+
+
+def test_trace_instances(tmp_path):
+    """Check that tasks of the same type are traced separately."""
+
+    trace_file = str(tmp_path / "trace.json")
+
+    testconfig = """
+    pipeline:
+        tasks:
+            - type: draco.util.testing.DummyTask
+              params:
+                tag: trace
+                total_len: 2
+                trace: Yes
+                trace_file: {0}
+
+            - type: draco.util.testing.DummyTask
+              params:
+                tag: trace
+                total_len: 3
+                trace: Yes
+                trace_file: {0}
+    """.format(
+        trace_file
+    )
+
+    man = pipeline.Manager.from_yaml_str(testconfig)
+    man.run()
+
+    with open(trace_file, "r") as fh:
+        trace = json.load(fh)
+
+    summary = trace["otherData"]["summary"]
+    assert len(summary["DummyTask"]) == 2
+    assert len(summary["DummyTask[1]"]) == 3
+
+    calls = [ev for ev in trace["traceEvents"] if ev["cat"] == "task"]
+    assert sorted(ev["tid"] for ev in calls) == ["DummyTask"] * 2 + ["DummyTask[1]"] * 3
+
+
+def test_trace_rank_mismatch(tmp_path):
+    """Check that calls made by only some ranks are still summarised."""
+
+    def _call(count):
+        return {
+            "name": "process",
+            "count": count,
+            "start": 0.0,
+            "wall": 1.0,
+            "cpu": 1.0,
+            "rss_delta": 0,
+            "phases": {},
+        }
+
+    path = str(tmp_path / "trace.json")
+    task._write_trace(path, "Foo", [[_call(0), _call(1)], [_call(0)]])
+
+    summary = task._trace_summaries[path]["Foo"]
+    assert [s["nranks"] for s in summary] == [2, 1]
+
+
+def test_iter_blocks():
+    """Check the blocks used for NaN checking cover the array."""
+
+    arr = np.arange(10.0)
+    blocks = list(task._iter_blocks(arr, 3))
+    assert [b.size for b in blocks] == [3, 3, 3, 1]
+    assert (np.concatenate(blocks) == arr).all()
+
+    # Non-contiguous arrays get split along the first axis
+    arr = np.arange(24.0).reshape(4, 6)[:, ::2]
+    assert sum(b.size for b in task._iter_blocks(arr, 5)) == arr.size
+
+    # Sampled blocks should rotate with the offset
+    sampled = [list(task._iter_blocks(np.arange(10.0), 3, 2, i)) for i in range(2)]
+    assert (np.sort(np.concatenate(sampled[0] + sampled[1])) == np.arange(10.0)).all()
+
+
+def test_nan_check_counts(caplog):
+    """Check that non-finite values are counted in every dataset."""
+
+    import logging
+
+    from caput import memh5
+
+    cont = memh5.BasicCont(distributed=False)
+    cont.create_dataset("a", data=np.array([np.nan, 1.0, np.nan]))
+    cont.create_dataset("b", data=np.array([np.inf, 2.0, 3.0]))
+    cont.create_dataset("c", data=np.arange(3.0))
+
+    t = task.SingleTask()
+
+    with caplog.at_level(logging.INFO):
+        assert t._nan_check_walk(cont)
+
+    assert "NaN's found in dataset /a [2 of 3 elements]" in caplog.text
+    assert "Inf's found in dataset /b [1 of 3 elements]" in caplog.text
+    assert "/c" not in caplog.text
+
+
+def test_nan_check_spilled(tmp_path):
+    """Check that spilled containers are read back in to be checked."""
+
+    import pytest
+
+    from draco.core import containers
+
+    class Finish(task.SingleTask):
+        def process(self, ss):
+            pass
+
+        def process_finish(self):
+            return self.out
+
+    containers.set_memory_budget(0, str(tmp_path))
+
+    try:
+        ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+        ss.vis[:] = np.nan
+
+        # Creating another container should push the first one out to disk
+        containers.SiderealStream(axes_from=ss)
+        assert ss.is_spilled
+
+        key = task._content_hash(ss)
+        assert not ss.is_spilled
+
+        containers.SiderealStream(axes_from=ss)
+        assert ss.is_spilled
+
+        t = Finish()
+        t.out = ss
+        t.nan_dump = False
+        t.nan_skip = False
+        assert t.finish() is ss
+        assert not ss.is_spilled
+        assert task._content_hash(ss) == key
+    finally:
+        containers.set_memory_budget(None)
+
+    # Errors checking or saving the output shouldn't be mistaken for a missing
+    # `process_finish`
+    def _fail(output):
+        raise AttributeError("Failed.")
+
+    t = Finish()
+    t.out = ss
+    t._nan_process_output = _fail
+    with pytest.raises(AttributeError):
+        t.finish()
+
+
+def test_async_save(tmp_path):
+    """Check that outputs written in the background are flushed at the end."""
+
+    testconfig = """
+    pipeline:
+        tasks:
+            - type: draco.util.testing.DummyTask
+              params:
+                tag: async
+                total_len: 3
+                save: Yes
+                async_save: Yes
+                async_copy: No
+                output_name: "{}/{{tag}}_{{count}}.h5"
+    """.format(
+        str(tmp_path)
+    )
+
+    man = pipeline.Manager.from_yaml_str(testconfig)
+    man.run()
+
+    for count in range(3):
+        assert (tmp_path / "async_{}.h5".format(count)).exists()
+
+
+def test_content_hash():
+    """Check that the content hash changes only when the data does."""
+
+    from draco.core import containers
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+    ss.vis[:] = 1.0
+
+    ss_copy = ss.copy()
+    assert task._content_hash(ss) == task._content_hash(ss_copy)
+
+    ss_copy.vis[:] = 2.0
+    assert task._content_hash(ss) != task._content_hash(ss_copy)
+
+
+def test_needs_redistribute():
+    """Check the test for whether the barrier can be skipped."""
+
+    from draco.core import containers
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+
+    assert not task._needs_redistribute(ss, "freq")
+    assert task._needs_redistribute(ss, "ra")
+    assert task._needs_redistribute(ss, ["prod", "stack"])
+
+    ss.redistribute("stack")
+    assert not task._needs_redistribute(ss, ["prod", "stack"])
+
+    # Things that aren't containers never need redistributing
+    assert not task._needs_redistribute(None, "freq")
+
+
+def test_deferred_redistribute():
+    """Check deferred redistributions go straight to the axis a task needs."""
+
+    from draco.core import containers
+
+    class NeedsStack(task.SingleTask):
+        _input_distributed_axis = "stack"
+
+        def process(self, ss):
+            return ss
+
+    class NeedsNothing(task.SingleTask):
+        def process(self, ss):
+            return ss
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+    ss.redistribute("ra")
+    ss.defer_redistribute("freq")
+    assert ss.vis.distributed_axis == 2
+
+    # The task's own axis takes precedence over the deferred one
+    nbytes = containers.redistributed_nbytes()
+    NeedsStack()._resolve_distribution([ss])
+    assert ss.vis.distributed_axis == 1
+    assert ss.pending_axis is None
+    assert containers.redistributed_nbytes() > nbytes
+
+    # Otherwise the deferred axis is used
+    ss.defer_redistribute("freq")
+    NeedsNothing()._resolve_distribution([ss])
+    assert ss.vis.distributed_axis == 0
+
+    # Redistributing to the current axis moves nothing
+    nbytes = containers.redistributed_nbytes()
+    ss.redistribute("freq")
+    assert containers.redistributed_nbytes() == nbytes
+
+
+def test_concurrent():
+    """Check concurrent tasks pass on their outputs and errors."""
+
+    import pytest
+
+    from draco.core import containers
+
+    class Double(task.SingleTask):
+        def process(self, ss):
+            if (ss.vis[:] < 0).any():
+                raise ValueError("Negative visibilities.")
+            ss.vis[:] *= 2
+            return ss
+
+    class Identity(task.SingleTask):
+        def process(self, ss):
+            return ss
+
+    def _concurrent(copy):
+        t = Double()
+        t.concurrent = True
+        t.concurrent_copy = copy
+        t._start_concurrent()
+        return t
+
+    ss = containers.SiderealStream(stack=5, input=3, ra=16, freq=4)
+    ss.vis[:] = 1.0
+    comm = ss.comm
+
+    # The output is passed on as a placeholder, resolved by the consumer. By
+    # default the input is used in place.
+    t = _concurrent(False)
+    pending = t.next(ss)
+    assert isinstance(pending, task._PendingOutput)
+
+    out = Identity().next(pending)
+    assert out is ss
+    assert (out.vis[:] == 2.0).all()
+    assert out.comm is comm
+
+    t.finish()
+    assert t.comm is comm
+    assert t._executor is None
+
+    # With copying the input is left alone
+    t = _concurrent(True)
+    out = Identity().next(t.next(ss))
+    assert out is not ss
+    assert (out.vis[:] == 4.0).all()
+    assert (ss.vis[:] == 2.0).all()
+    t.finish()
+
+    # Errors in the task's thread are raised by the consumer, and by the next call
+    ss.vis[:] = -1.0
+    t = _concurrent(False)
+    pending = t.next(ss)
+    with pytest.raises(ValueError):
+        Identity().next(pending)
+
+    with pytest.raises(ValueError):
+        t.next(ss)
@@ -0,0 +1,64 @@
+import numpy as np
+
+from draco.analysis.transform import MModeTransform, SelectFreq, _make_marray
+from draco.core import containers
+
+
+def test_mmode_transform():
+
+    ss = containers.SiderealStream(stack=3, input=3, ra=16, freq=6)
+    ss.redistribute("freq")
+
+    vis = ss.vis[:]
+    rng = np.random.default_rng(vis.local_offset[0])
+    vis[:] = rng.standard_normal(vis.shape) + 1j * rng.standard_normal(vis.shape)
+    ss.weight[:] = 2.0
+
+    full = ss.copy()
+    full.redistribute("freq")
+    full_vis = full.vis[:].allgather()
+
+    task = MModeTransform()
+    task.setup()
+    ma = task.process(ss)
+
+    # The modes should match a transform of all of the data, and be distributed
+    # over m
+    ref = _make_marray(full_vis, None)
+    moff = ma.vis[:].local_offset[0]
+
+    assert ma.vis.distributed_axis == 0
+    assert np.allclose(ma.vis[:], ref[moff : moff + ma.vis[:].shape[0]])
+    assert (ma.weight[:] == 32.0).all()
+
+
+def test_select_freq_deferred():
+
+    ss = containers.SiderealStream(stack=3, input=3, ra=16, freq=6)
+    ss.redistribute("freq")
+
+    vis = ss.vis[:]
+    vis[:] = np.arange(vis.local_offset[0], vis.local_offset[0] + vis.shape[0])[
+        :, np.newaxis, np.newaxis
+    ]
+
+    task = SelectFreq()
+    task.channel_range = [1, 4]
+    sf = task.process(ss)
+
+    # Calling process directly should still leave the output to be switched back
+    # to a frequency distribution
+    assert sf.pending_axis == "freq"
+
+    # The input may be used by other tasks, so it should be switched back straight
+    # away
+    assert ss.vis.distributed_axis == 0
+    assert ss.pending_axis is None
+
+    sf.redistribute(sf.pending_axis)
+    sf_vis = sf.vis[:]
+    freq = np.arange(sf_vis.local_offset[0], sf_vis.local_offset[0] + sf_vis.shape[0])
+
+    assert sf.vis.distributed_axis == 0
+    assert sf.vis.global_shape[0] == 3
+    assert (sf_vis == 1 + freq[:, np.newaxis, np.newaxis]).all()